@@ -0,0 +1,906 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import tensorflow as tf
+
+import gnn_estimator
+import gnn_trainer
+import graph_memory
+import launch_workers
+import memory_planner
+import profiling
+import text_processor
+import transformer_model
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_enum("benchmark", default="recompute",
+      enum_values=["recompute", "accumulation", "gnn_step", "engines", "estimator_steps", "trainer_steps",
+                   "checkpoints", "scaling",
+                   "worker_steps", "memory", "suite", "embedding_loading", "question_records", "edge_construction",
+                   "gnn_passes", "transformer_passes", "attention", "fact_batching", "output_layer",
+                   "projections", "graph_memory", "node_scatter"],
+      help="benchmark to run: recompute compares the memory and time of training with and without recompute over "
+           "several recurrence depths, accumulation compares them over several numbers of micro-batches of the same "
+           "batch, gnn_step measures the training steps of the current configuration, engines "
+           "compares the training speed of the estimator and of gnn_trainer with and without XLA, measured by "
+           "estimator_steps and trainer_steps, checkpoints checks that the estimator and gnn_trainer resume each "
+           "other's checkpoints (exiting with an error otherwise), scaling compares the training speed of the multi_worker or "
+           "parameter_server distribution over several numbers of local workers, measured by worker_steps on every "
+           "worker, memory compares the memory of gnn_step over several batch sizes to the estimate of "
+           "memory_planner, suite runs the microbenchmarks (embedding_loading, question_records, edge_construction, "
+           "gnn_passes and transformer_passes, with dense, sparse and chunked attention) on synthetic data and "
+           "compares them to baseline_file, attention compares the time and memory of the transformer with dense, "
+           "top-k and chunked attention over sequence_sweep, fact_batching compares the training speed of the "
+           "transformer on fact records batched at their full length, bucketed by length and bucketed with a token "
+           "budget, output_layer compares the training speed and memory of the transformer with a dense output layer, "
+           "one tied to the embedding, and one tied with a sampled softmax over vocabulary_sweep, projections compares the "
+           "time and memory of the transformer with separate and fused query, key and value projections of its "
+           "self-attentions over sequence_sweep, graph_memory compares the speed at which the graph memory absorbs "
+           "facts, and is read meanwhile, over graph_memory_batch_sweep, node_scatter compares the projection of "
+           "signals onto graph nodes with their duplicates normalized row by row, with map_fn, and for the whole "
+           "batch at once (transformer_model.scatter_unique_mean)")
+flags.DEFINE_integer("benchmark_steps", default=10,
+      help="number of timed training steps, after one warm-up step")
+flags.DEFINE_list("recurrence_sweep", default=["1", "2", "4", "8"],
+      help="recurrence depths compared by the recompute benchmark")
+flags.DEFINE_list("accumulation_sweep", default=["1", "2", "4", "8"],
+      help="numbers of micro-batches compared by the accumulation benchmark")
+flags.DEFINE_list("batch_sweep", default=["4", "8", "16", "32"],
+      help="batch sizes compared by the memory benchmark")
+flags.DEFINE_list("worker_sweep", default=["1", "2", "4"],
+      help="numbers of workers compared by the scaling benchmark")
+flags.DEFINE_integer("vocab_size", default=10000,
+      help="number of words of the synthetic word embedding")
+flags.DEFINE_integer("graph_size", default=512,
+      help="number of nodes of the synthetic knowledge graph")
+flags.DEFINE_integer("graph_degree", default=10,
+      help="average number of edges sent by a node of the synthetic knowledge graph")
+flags.DEFINE_integer("embedding_depth", default=300,
+      help="depth of the synthetic word embedding and graph nodes")
+flags.DEFINE_integer("num_relationships", default=5000,
+      help="number of relationships of the synthetic relationship CSV")
+flags.DEFINE_integer("num_questions", default=1000,
+      help="number of questions of each split of the synthetic OpenBookQA")
+flags.DEFINE_integer("benchmark_repeats", default=3,
+      help="number of times each microbenchmark of the suite is run, the fastest run is reported")
+flags.DEFINE_list("graph_sweep", default=["128", "512", "1024"],
+      help="numbers of graph nodes at which gnn_passes runs the GNN")
+flags.DEFINE_list("sequence_sweep", default=["64", "128", "256"],
+      help="sentence lengths at which transformer_passes runs the transformer")
+flags.DEFINE_integer("transformer_layers", default=2,
+      help="number of encoder and decoder layers of the transformer of transformer_passes")
+flags.DEFINE_integer("transformer_depth", default=256,
+      help="depth of the transformer of transformer_passes")
+flags.DEFINE_integer("transformer_heads", default=8,
+      help="number of attention heads of the transformer of transformer_passes")
+flags.DEFINE_integer("attention_top_k", default=16,
+      help="number of keys attended by each query with the sparse attention of transformer_passes and attention")
+flags.DEFINE_integer("attention_chunk", default=128,
+      help="number of keys of each block of the chunked attention of transformer_passes and attention")
+flags.DEFINE_list("vocabulary_sweep", default=["8192", "32768", "65536"],
+      help="vocabulary sizes at which output_layer trains the transformer")
+flags.DEFINE_integer("num_sampled", default=512,
+      help="number of words sampled by the sampled softmax of output_layer")
+flags.DEFINE_string("fact_records", default="",
+      help="fact TFRecords written by text_processor.text_processor on which fact_batching trains the transformer, "
+           "synthetic facts if empty")
+flags.DEFINE_integer("num_facts", default=5000,
+      help="number of synthetic facts of fact_batching")
+flags.DEFINE_integer("fact_seq_len", default=128,
+      help="length to which the fact records are padded")
+flags.DEFINE_integer("bucket_width", default=8,
+      help="number of lengths of each bucket of the bucketed batches of fact_batching")
+flags.DEFINE_integer("max_tokens", default=2048,
+      help="number of tokens of each batch of the token budget batches of fact_batching")
+flags.DEFINE_list("graph_memory_batch_sweep", default=["16", "256", "4096"],
+      help="maximum numbers of facts written together compared by graph_memory")
+flags.DEFINE_integer("graph_memory_facts", default=65536,
+      help="number of synthetic facts written by graph_memory")
+flags.DEFINE_string("baseline_file", default="benchmark_baseline.json",
+      help="results of an earlier suite to which the suite is compared, written by the first suite run")
+flags.DEFINE_bool("update_baseline", default=False,
+      help="whether the suite replaces baseline_file with its results")
+flags.DEFINE_float("regression_threshold", default=0.2,
+      help="fraction by which a time of the suite may exceed its baseline before it is flagged as a regression")
+
+FLAGS = flags.FLAGS
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def traced_peak_memory_mb(session, fetches):
+    """Runs `fetches` once with tracing, returns the most memory the allocators held at any point of the run."""
+    run_metadata = tf.compat.v1.RunMetadata()
+    session.run(fetches, options=tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata)
+    return max(memory.allocator_bytes_in_use for device in run_metadata.step_stats.dev_stats
+               for node in device.node_stats for memory in node.memory) / 2 ** 20
+
+
+def synthetic_gnn_params(directory, graph_size=None):
+    """Writes a random word embedding and knowledge graph, of graph_size nodes unless `graph_size` is given, to
+    `directory`, returns the params of the GNN model, which splits its training steps into accumulation_steps
+    micro-batches."""
+    graph_size = graph_size or FLAGS.graph_size
+    np.save(os.path.join(directory, "word_embedding.npy"),
+            np.random.normal(size=[FLAGS.vocab_size, FLAGS.embedding_depth]).astype(np.float32))
+    np.save(os.path.join(directory, "graph_nodes.npy"),
+            np.random.normal(size=[graph_size, FLAGS.embedding_depth]).astype(np.float32))
+    graph_edges = np.random.uniform(size=[graph_size, graph_size]) < FLAGS.graph_degree / graph_size
+
+    return {
+        'word_embedding': os.path.join(directory, "word_embedding.npy"),
+        'graph_nodes': os.path.join(directory, "graph_nodes.npy"),
+        'graph_edges': graph_edges,
+        'accumulation_steps': FLAGS.accumulation_steps
+    }
+
+
+def synthetic_questions(batch_size):
+    """A batch of random questions whose words fill the first half of the inputs, the rest is padding."""
+    def words(shape):
+        ids = np.random.randint(2, FLAGS.vocab_size, size=shape)
+        ids[..., shape[-1] // 2:] = 1
+        return tf.constant(ids, tf.int32)
+
+    return {
+        "input_ids": words([batch_size, gnn_estimator.num_choices, FLAGS.seq_len]),
+        "stem_ids": words([batch_size, FLAGS.stem_len]),
+        "choice_ids": words([batch_size, gnn_estimator.num_choices, FLAGS.choice_len]),
+        "answer_id": tf.constant(np.random.randint(gnn_estimator.num_choices, size=[batch_size]), tf.int32)
+    }
+
+
+def synthetic_words():
+    return ["w%d" % i for i in range(FLAGS.vocab_size)]
+
+
+def synthetic_glove(path):
+    """Writes a random word embedding in the text format of GloVe to `path`, one line per word of synthetic_words."""
+    vectors = np.random.normal(size=[FLAGS.vocab_size, FLAGS.embedding_depth])
+    with open(path, "w") as glove:
+        for word, vector in zip(synthetic_words(), vectors):
+            glove.write(word + " " + " ".join("%.5f" % value for value in vector) + "\n")
+
+
+def synthetic_relationships(path):
+    """Writes num_relationships random relationships in the format read by text_processor.relationship_processor to
+    `path`: rows of two to four concepts of one or two words, each pair joined by a connection word, or by nothing
+    to repeat the previous connection."""
+    words = synthetic_words()
+
+    def phrase(max_words):
+        return " ".join(np.random.choice(words, np.random.randint(1, max_words + 1)))
+
+    with open(path, "w", newline='') as relationships:
+        writer = csv.writer(relationships)
+        for _ in range(FLAGS.num_relationships):
+            row = [phrase(2)]
+            for i in range(np.random.randint(1, 4)):
+                row += ["" if i and np.random.uniform() < 0.3 else phrase(1), phrase(2)]
+            writer.writerow(row)
+
+
+def synthetic_openbook(directory):
+    """Writes num_questions random questions for each split of OpenBookQA, in its format, to the data/ directory of
+    `directory`, where text_processor.openbook_question_processor reads them. The stem and a choice together never
+    exceed seq_len words."""
+    words = synthetic_words()
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    for split in ["train", "test", "dev"]:
+        with open(os.path.join(directory, "data", split + ".jsonl"), "w") as questions:
+            for _ in range(FLAGS.num_questions):
+                stem_length = np.random.randint(4, min(FLAGS.stem_len, FLAGS.seq_len - 8))
+                choices = [{"text": " ".join(np.random.choice(words, np.random.randint(1, 8))), "label": label}
+                           for label in "ABCD"]
+                questions.write(json.dumps({
+                    "question": {"stem": " ".join(np.random.choice(words, stem_length)), "choices": choices},
+                    "answerKey": "ABCD"[np.random.randint(4)]}) + "\n")
+
+
+def synthetic_clusters(num_concepts, graph_size):
+    """Random clusters of `num_concepts` concepts and their connections, as kmeans_estimator gets them from
+    text_processor.relationship_processor: relationships of two to four concepts, whose first has no connection."""
+    connections = []
+    while len(connections) < num_concepts:
+        connections += [[]] + [np.zeros([1])] * np.random.randint(1, 4)
+    return np.random.randint(graph_size, size=num_concepts), connections[:num_concepts]
+
+
+def synthetic_facts(path):
+    """Writes num_facts random facts padded to fact_seq_len to `path`, as text_processor.text_processor writes them,
+    whose lengths follow a log-normal distribution of median 16 tokens, like the facts of OpenBookQA."""
+    lengths = np.clip(np.random.lognormal(np.log(16), 0.5, FLAGS.num_facts).astype(int), 3, FLAGS.fact_seq_len)
+    text_processor.write_fact_records(path, [np.random.randint(2, FLAGS.vocab_size, length) for length in lengths],
+                                      [True] * FLAGS.num_facts, FLAGS.fact_seq_len)
+
+
+def fastest_run(function):
+    """The time in ms of the fastest of benchmark_repeats calls of `function`."""
+    times = []
+    for _ in range(FLAGS.benchmark_repeats):
+        start = time.time()
+        function()
+        times.append((time.time() - start) * 1000)
+    return min(times)
+
+
+def benchmark_embedding_loading():
+    """Times text_processor.relationship_processor, which loads a GloVe embedding and embeds the concepts and
+    connections of a relationship CSV, on a synthetic embedding and relationships."""
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        glove_path = os.path.join(directory, "glove.txt")
+        relationships_path = os.path.join(directory, "relationships.csv")
+        synthetic_glove(glove_path)
+        synthetic_relationships(relationships_path)
+        return {"embedding_loading_ms": fastest_run(
+            lambda: text_processor.relationship_processor(glove_path, relationships_path))}
+
+
+def benchmark_question_records():
+    """Times text_processor.openbook_question_processor, which loads a GloVe embedding and writes the question
+    TFRecords of the three splits of OpenBookQA, on a synthetic embedding and questions."""
+    np.random.seed(0)
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        glove_path = os.path.join(directory, "glove.txt")
+        synthetic_glove(glove_path)
+        synthetic_openbook(directory)
+        runs = iter(range(FLAGS.benchmark_repeats))
+
+        def write_records():
+            # The processor skips the records that already exist, so every run writes to a new directory
+            text_processor.openbook_question_processor(glove_path, os.path.join(directory, "run%d" % next(runs)),
+                                                       FLAGS.seq_len, FLAGS.stem_len, FLAGS.choice_len)
+
+        # The processor reads the questions from data/ of the working directory
+        os.chdir(directory)
+        try:
+            return {"question_records_ms": fastest_run(write_records)}
+        finally:
+            os.chdir(working_directory)
+
+
+def benchmark_edge_construction():
+    """Times text_processor.relationship_edges, the edges of the knowledge graph built by kmeans_estimator, for as
+    many concepts as num_relationships relationships have."""
+    np.random.seed(0)
+    cluster_indices, connections = synthetic_clusters(3 * FLAGS.num_relationships, FLAGS.graph_size)
+    return {"edge_construction_ms": fastest_run(
+        lambda: text_processor.relationship_edges(cluster_indices, connections, FLAGS.graph_size))}
+
+
+def benchmark_gnn_passes():
+    """Times the forward pass (the loss) and the forward and backward pass (a training step) of model_fn on a batch
+    of random questions, for knowledge graphs of each size of graph_sweep."""
+    results = {}
+    for graph_size in FLAGS.graph_sweep:
+        np.random.seed(0)
+        with tempfile.TemporaryDirectory() as directory:
+            params = synthetic_gnn_params(directory, int(graph_size))
+            with tf.Graph().as_default():
+                tf.compat.v1.set_random_seed(0)
+                features = synthetic_questions(FLAGS.batch_size)
+                spec = gnn_estimator.model_fn(features, None, tf.estimator.ModeKeys.TRAIN, params)
+                with tf.compat.v1.Session(config=gnn_estimator.session_config()) as session:
+                    session.run([tf.compat.v1.global_variables_initializer(),
+                                 tf.compat.v1.local_variables_initializer()])
+                    session.run([spec.train_op, spec.loss])
+                    results["gnn_forward_ms@%s" % graph_size] = fastest_run(lambda: session.run(spec.loss))
+                    results["gnn_train_step_ms@%s" % graph_size] = fastest_run(lambda: session.run(spec.train_op))
+
+    return results
+
+
+# The attentions of the transformer, and the prefix of their results in the suite
+ATTENTIONS = {"dense": "transformer", "top_k": "sparse_transformer", "chunked": "chunked_transformer"}
+# The output layers of the transformer
+OUTPUTS = ["dense", "tied", "sampled"]
+
+
+def transformer_step(sequence_length, attention="dense", measure_memory=False, vocab_size=None, output="dense",
+                     fused_qkv=False):
+    """Times the forward pass and a training step of the transformer of transformer_model, with the `attention` of
+    ATTENTIONS, the `output` layer of OUTPUTS and, with `fused_qkv`, fused projections of its self-attentions, on a
+    batch of random sentences of `sequence_length` tokens of a vocabulary of vocab_size words unless `vocab_size` is
+    given; with `measure_memory`, also returns the most memory held by TensorFlow during a training step."""
+    vocab_size = vocab_size or FLAGS.vocab_size
+    hyperparameters = types.SimpleNamespace(layers=FLAGS.transformer_layers, depth=FLAGS.transformer_depth,
+                                            heads=FLAGS.transformer_heads, feedforward=2 * FLAGS.transformer_depth,
+                                            dropout=0.1, sparse_lim=FLAGS.attention_top_k)
+    np.random.seed(0)
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(0)
+        sentences = tf.constant(np.random.randint(2, vocab_size, size=[FLAGS.batch_size, sequence_length]), tf.int32)
+        chunk_size = FLAGS.attention_chunk if attention == "chunked" else 0
+        model = transformer_model.TED_generator(vocab_size, hyperparameters, sparse=attention == "top_k",
+                                                chunk_size=chunk_size, return_attention=not chunk_size,
+                                                tied_output=output != "dense",
+                                                num_sampled=FLAGS.num_sampled if output == "sampled" else 0,
+                                                max_length=sequence_length, fused_qkv=fused_qkv)
+        loss = model(sentences, True, with_loss=True)[0]
+        train_op = tf.compat.v1.train.AdamOptimizer().minimize(loss)
+        with tf.compat.v1.Session(config=gnn_estimator.session_config()) as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            session.run([train_op, loss])
+            result = {"forward_ms": fastest_run(lambda: session.run(loss)),
+                      "train_step_ms": fastest_run(lambda: session.run(train_op))}
+            if measure_memory:
+                result["step_memory_mb"] = traced_peak_memory_mb(session, train_op)
+
+    return result
+
+
+def benchmark_transformer_passes(attention="dense"):
+    """Times the forward pass and a training step of the transformer on a batch of random sentences of each length
+    of sequence_sweep, with dense attention, which grows with the square of the length, or with top-k or chunked
+    attention."""
+    prefix = ATTENTIONS[attention]
+    results = {}
+    for sequence_length in FLAGS.sequence_sweep:
+        result = transformer_step(int(sequence_length), attention)
+        results["%s_forward_ms@%s" % (prefix, sequence_length)] = result["forward_ms"]
+        results["%s_train_step_ms@%s" % (prefix, sequence_length)] = result["train_step_ms"]
+
+    return results
+
+
+def benchmark_attention():
+    print("%-8s %-10s %12s %14s %16s" % ("length", "attention", "forward ms", "train step ms", "step memory MB"))
+    for sequence_length in FLAGS.sequence_sweep:
+        for attention in ATTENTIONS:
+            result = transformer_step(int(sequence_length), attention, measure_memory=True)
+            print("%-8s %-10s %12.1f %14.1f %16.0f" % (sequence_length, attention, result["forward_ms"],
+                                                       result["train_step_ms"], result["step_memory_mb"]))
+            sys.stdout.flush()
+
+
+def fact_training_speed(path, bucket_width=0, max_tokens=0, monitor=None):
+    """Trains the transformer on the fact records of `path`, batched by text_processor.fact_input_fn_builder with
+    `bucket_width` and `max_tokens`, for benchmark_steps steps after as many warm-up steps, which a
+    profiling.StepMonitor can follow. Returns the speed in tokens of the facts, and the fraction of the batches that
+    is padding."""
+    hyperparameters = types.SimpleNamespace(layers=FLAGS.transformer_layers, depth=FLAGS.transformer_depth,
+                                            heads=FLAGS.transformer_heads, feedforward=2 * FLAGS.transformer_depth,
+                                            dropout=0.1)
+    monitor = monitor or profiling.StepMonitor()
+    with tf.Graph().as_default():
+        tf.compat.v1.set_random_seed(0)
+        input_fn = text_processor.fact_input_fn_builder(path, FLAGS.fact_seq_len, FLAGS.batch_size, True,
+                                                        bucket_width, max_tokens)
+        features = tf.compat.v1.data.make_one_shot_iterator(input_fn()).get_next()
+        # The time the batch of a step left the input pipeline, taken before any computation on it like
+        # gnn_estimator.model_fn does
+        with tf.control_dependencies(tf.nest.flatten(features)):
+            input_ready = tf.timestamp()
+        with tf.control_dependencies([input_ready]):
+            features = {name: tf.identity(feature) for name, feature in features.items()}
+        sentences = features["input_ids"]
+        model = transformer_model.TED_generator(FLAGS.vocab_size, hyperparameters, max_length=FLAGS.fact_seq_len)
+        logits = model(sentences, True)[0]
+        loss = tf.compat.v1.losses.sparse_softmax_cross_entropy(sentences[:, 1:], logits,
+                                                                weights=tf.sign(sentences[:, 1:]))
+        train_op = tf.compat.v1.train.AdamOptimizer().minimize(loss)
+        tokens = [tf.reduce_sum(features["input_len"]), tf.size(sentences)]
+        fetches = [train_op, tokens, input_ready, tf.shape(sentences)[0]]
+
+        with tf.compat.v1.Session(config=gnn_estimator.session_config()) as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            fact_tokens = batch_tokens = 0
+            for step in range(2 * FLAGS.benchmark_steps):
+                if step == FLAGS.benchmark_steps:
+                    # The speed leaves out the warm-up steps
+                    fact_tokens = batch_tokens = 0
+                    start = time.time()
+                monitor.begin_step()
+                _, (step_fact_tokens, step_batch_tokens), step_input_ready, batch_facts = session.run(fetches)
+                monitor.end_step(batch_facts, step_input_ready)
+                fact_tokens += step_fact_tokens
+                batch_tokens += step_batch_tokens
+
+    return fact_tokens / (time.time() - start), 1 - fact_tokens / batch_tokens
+
+
+def benchmark_fact_batching():
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        path = FLAGS.fact_records
+        if not path:
+            path = os.path.join(directory, "facts.tfrecords")
+            synthetic_facts(path)
+
+        print("%-14s %12s %10s" % ("batches", "tokens/s", "padding"))
+        for name, bucket_width, max_tokens in [("padded", 0, 0), ("bucketed", FLAGS.bucket_width, 0),
+                                               ("token budget", FLAGS.bucket_width, FLAGS.max_tokens)]:
+            monitor = profiling.step_monitor(name.replace(" ", "_"))
+            speed, padding = fact_training_speed(path, bucket_width, max_tokens, monitor)
+            monitor.close()
+            print("%-14s %12.1f %10.3f" % (name, speed, padding))
+            sys.stdout.flush()
+
+
+def benchmark_output_layer():
+    sequence_length = int(FLAGS.sequence_sweep[0])
+    print("%-10s %-8s %14s %16s" % ("vocabulary", "output", "train step ms", "step memory MB"))
+    for vocab_size in FLAGS.vocabulary_sweep:
+        for output in OUTPUTS:
+            result = transformer_step(sequence_length, measure_memory=True, vocab_size=int(vocab_size), output=output)
+            print("%-10s %-8s %14.1f %16.0f" % (vocab_size, output, result["train_step_ms"], result["step_memory_mb"]))
+            sys.stdout.flush()
+
+
+def benchmark_projections():
+    print("%-8s %-10s %12s %14s %16s" % ("length", "qkv", "forward ms", "train step ms", "step memory MB"))
+    for sequence_length in FLAGS.sequence_sweep:
+        for fused_qkv in [False, True]:
+            result = transformer_step(int(sequence_length), measure_memory=True, fused_qkv=fused_qkv)
+            print("%-8s %-10s %12.1f %14.1f %16.0f" % (sequence_length, "fused" if fused_qkv else "separate",
+                                                       result["forward_ms"], result["train_step_ms"],
+                                                       result["step_memory_mb"]))
+            sys.stdout.flush()
+
+
+def benchmark_graph_memory():
+    """Writes random facts of the depth of the transformer to a graph memory of graph_size random nodes, in writes
+    of graph_memory_write_size facts read by graph_memory_readers threads, batched up to each size of
+    graph_memory_batch_sweep."""
+    np.random.seed(0)
+    nodes = np.random.normal(size=[FLAGS.graph_size, FLAGS.transformer_depth]).astype(np.float32)
+    vectors = np.random.normal(size=[FLAGS.graph_memory_facts, FLAGS.transformer_depth]).astype(np.float32)
+
+    print("%-8s %10s %12s %16s %14s" % ("batch", "versions", "facts/s", "update facts/s", "snapshots/s"))
+    for max_batch_size in FLAGS.graph_memory_batch_sweep:
+        memory = graph_memory.GraphMemory(nodes, FLAGS.graph_memory_alpha, int(max_batch_size),
+                                          FLAGS.graph_memory_timeout_ms / 1000)
+        speed, reads, versions = graph_memory.absorb(memory, vectors, FLAGS.graph_memory_write_size,
+                                                     FLAGS.graph_memory_readers)
+        print("%-8s %10d %12.0f %16.0f %14.0f" % (max_batch_size, versions, speed, memory.throughput(), reads))
+        sys.stdout.flush()
+
+
+def map_fn_normalize_unique(indices):
+    """The normalization of the duplicates of debug.py before transformer_model.normalize_unique: those of each row
+    of `indices` are counted by unique_with_counts on the CPU, under map_fn."""
+    def normalize_unique(x):
+        with tf.device('/cpu:0'):
+            ___, idx, count = tf.unique_with_counts(x)
+        return tf.cast(1 / tf.gather(count, idx), tf.float32)
+
+    return tf.map_fn(normalize_unique, indices, dtype=tf.float32)
+
+
+def map_fn_node_scatter(nodes, indices, signals):
+    """The projection of debug.py before transformer_model.scatter_unique_mean: the `signals` normalized by
+    map_fn_normalize_unique added to a copy of the `nodes` per example."""
+    norm_duplicate = tf.expand_dims(map_fn_normalize_unique(indices), -1)
+    batched_nodes = tf.tile(tf.expand_dims(nodes, 0), [tf.shape(indices)[0], 1, 1])
+    positions = tf.stack([tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1), [1, tf.shape(indices)[1]]),
+                          indices], -1)
+    return tf.tensor_scatter_nd_add(batched_nodes, positions, signals * norm_duplicate)
+
+
+def benchmark_node_scatter():
+    """Times the normalization of the duplicates of batch_size examples of seq_len random node indices of a graph
+    of graph_size nodes, and the projection onto the nodes of random signals of the depth of the transformer at those
+    indices, with map_fn and for the whole batch at once."""
+    np.random.seed(0)
+    with tf.Graph().as_default():
+        nodes = tf.constant(np.random.normal(size=[FLAGS.graph_size, FLAGS.transformer_depth]), tf.float32)
+        indices = tf.constant(np.random.randint(FLAGS.graph_size, size=[FLAGS.batch_size, FLAGS.seq_len]), tf.int32)
+        signals = tf.constant(np.random.normal(size=[FLAGS.batch_size, FLAGS.seq_len, FLAGS.transformer_depth]),
+                              tf.float32)
+        ops = {("normalize", "map_fn"): map_fn_normalize_unique(indices),
+               ("normalize", "batched"): transformer_model.normalize_unique(indices, FLAGS.graph_size),
+               ("project", "map_fn"): map_fn_node_scatter(nodes, indices, signals),
+               ("project", "batched"): transformer_model.scatter_unique_mean(indices, signals, FLAGS.graph_size,
+                                                                             nodes)}
+
+        with tf.compat.v1.Session(config=gnn_estimator.session_config()) as session:
+            results = session.run(ops)
+            print("max difference: %g" % max(np.max(np.abs(results[(op, "map_fn")] - results[(op, "batched")]))
+                                             for op in ["normalize", "project"]))
+            print("%-10s %-8s %10s" % ("op", "scatter", "ms"))
+            for (op, scatter), tensor in ops.items():
+                print("%-10s %-8s %10.2f" % (op, scatter, fastest_run(lambda: session.run(tensor.op))))
+                sys.stdout.flush()
+
+
+def suite_config():
+    """The flags that set the sizes of the suite; results are only comparable to a baseline of the same sizes."""
+    names = ["vocab_size", "embedding_depth", "graph_size", "graph_degree", "num_relationships", "num_questions",
+             "graph_sweep", "sequence_sweep", "transformer_layers", "transformer_depth", "transformer_heads",
+             "attention_top_k", "attention_chunk",
+             "batch_size", "seq_len", "stem_len", "choice_len", "recurrences", "split_stem"]
+    return {name: FLAGS[name].value for name in names}
+
+
+def benchmark_suite():
+    """Runs every microbenchmark and compares its times to those of baseline_file, flagging those slower than the
+    baseline by more than regression_threshold. Writes the results as the baseline when there is none yet or
+    update_baseline is set. Returns whether no time regressed."""
+    results = {}
+    for benchmark in [benchmark_embedding_loading, benchmark_question_records, benchmark_edge_construction,
+                      benchmark_gnn_passes, benchmark_transformer_passes,
+                      lambda: benchmark_transformer_passes("top_k"), lambda: benchmark_transformer_passes("chunked")]:
+        results.update(benchmark())
+
+    baseline = {}
+    if tf.io.gfile.exists(FLAGS.baseline_file):
+        with tf.io.gfile.GFile(FLAGS.baseline_file) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['config'] != suite_config():
+            print("Warning: the baseline was measured with other sizes: " + json.dumps(baseline['config']))
+
+    print("%-32s %12s %12s %10s" % ("benchmark", "ms", "baseline ms", "change"))
+    regressions = []
+    for name, value in results.items():
+        baseline_value = baseline.get('results', {}).get(name)
+        if baseline_value is None:
+            print("%-32s %12.1f %12s %10s" % (name, value, "-", "-"))
+            continue
+        change = value / baseline_value - 1
+        regressed = change > FLAGS.regression_threshold
+        if regressed:
+            regressions.append(name)
+        print("%-32s %12.1f %12.1f %9.0f%%%s" % (name, value, baseline_value, 100 * change,
+                                                  "  REGRESSION" if regressed else ""))
+
+    if not baseline or FLAGS.update_baseline:
+        with tf.io.gfile.GFile(FLAGS.baseline_file, "w") as baseline_file:
+            json.dump({'config': suite_config(), 'results': results}, baseline_file, indent=1)
+        print("Baseline written to " + FLAGS.baseline_file)
+    if regressions:
+        print("Regressions over %.0f%%: %s" % (100 * FLAGS.regression_threshold, ", ".join(regressions)))
+    return not regressions
+
+
+def benchmark_gnn_step():
+    """Trains the GNN on a fixed batch of random questions, returns the step time, the most memory held by TensorFlow
+    during a step, its estimate by memory_planner and the peak memory of the process."""
+    with tempfile.TemporaryDirectory() as directory:
+        params = synthetic_gnn_params(directory)
+        estimate = memory_planner.estimate_memory(params, gnn_estimator.num_choices, FLAGS.batch_size,
+                                                  params['accumulation_steps'])
+        with tf.Graph().as_default():
+            features = synthetic_questions(FLAGS.batch_size)
+            spec = gnn_estimator.model_fn(features, None, tf.estimator.ModeKeys.TRAIN, params)
+            with tf.compat.v1.Session(config=gnn_estimator.session_config()) as session:
+                session.run([tf.compat.v1.global_variables_initializer(),
+                             tf.compat.v1.local_variables_initializer()])
+                session.run(spec.train_op)
+
+                start = time.time()
+                for _ in range(FLAGS.benchmark_steps):
+                    session.run(spec.train_op)
+                step_time = (time.time() - start) / FLAGS.benchmark_steps
+                step_memory = traced_peak_memory_mb(session, spec.train_op)
+
+    return {
+        "step_ms": step_time * 1000,
+        "examples_per_sec": FLAGS.batch_size / step_time,
+        "step_memory_mb": step_memory,
+        "estimated_memory_mb": estimate['total'],
+        "peak_memory_mb": peak_memory_mb()
+    }
+
+
+class StepTimesHook(tf.estimator.SessionRunHook):
+    """Records the time at which every training step of an estimator ends."""
+
+    def __init__(self):
+        self.step_times = []
+
+    def after_run(self, run_context, run_values):
+        self.step_times.append(time.time())
+
+
+def benchmark_estimator_steps():
+    """Trains the GNN estimator on a repeated batch of random questions for one call of train, returns how long the
+    call took until its first step ended (building the graph, starting the session and restoring the checkpoint
+    included), the speed of the other steps and the speed of the whole call."""
+    with tempfile.TemporaryDirectory() as directory:
+        params = synthetic_gnn_params(directory)
+        estimator = tf.estimator.Estimator(model_fn=gnn_estimator.model_fn, model_dir=os.path.join(directory, "model"),
+                                           params=params,
+                                           config=tf.estimator.RunConfig(session_config=gnn_estimator.session_config()))
+
+        def input_fn(params):
+            return tf.data.Dataset.from_tensors(synthetic_questions(FLAGS.batch_size)).repeat()
+
+        estimator.train(input_fn, steps=1)
+        hook = StepTimesHook()
+        start = time.time()
+        estimator.train(input_fn, steps=FLAGS.benchmark_steps + 1, hooks=[hook])
+        end = time.time()
+
+    return {
+        "first_step_sec": hook.step_times[0] - start,
+        "steps_per_sec": FLAGS.benchmark_steps / (hook.step_times[-1] - hook.step_times[0]),
+        "call_steps_per_sec": (FLAGS.benchmark_steps + 1) / (end - start)
+    }
+
+
+def benchmark_trainer_steps():
+    """Like benchmark_estimator_steps, with the training loop of gnn_trainer; its first step traces and, with
+    jit_compile, compiles the training step."""
+    with tempfile.TemporaryDirectory() as directory:
+        params = synthetic_gnn_params(directory)
+        trainer = gnn_trainer.GraphNetworkTrainer(params, params['accumulation_steps'])
+        features = synthetic_questions(FLAGS.batch_size)
+        trainer.build(features)
+
+        start = time.time()
+        trainer.train_step(features).numpy()
+        first_step = time.time()
+        for _ in range(FLAGS.benchmark_steps):
+            loss = trainer.train_step(features)
+        loss.numpy()
+        end = time.time()
+
+    return {
+        "first_step_sec": first_step - start,
+        "steps_per_sec": FLAGS.benchmark_steps / (end - first_step),
+        "call_steps_per_sec": (FLAGS.benchmark_steps + 1) / (end - start)
+    }
+
+
+def check_checkpoints():
+    """Trains the GNN estimator for two steps, then resumes its checkpoint with gnn_trainer for a step and predicts
+    with the estimator from the checkpoint of the trainer. Checks that both checkpoints hold the same variables (the
+    network, the Adam slots and powers and the global step) with the same shapes, that the trainer restores the
+    values of the estimator, and that the estimator scores the questions like the trainer from its checkpoint.
+    Returns whether every check passed."""
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        params = synthetic_gnn_params(directory)
+        # gnn_trainer saves to and restores from model_dir
+        FLAGS.model_dir = os.path.join(directory, "model")
+        estimator = tf.estimator.Estimator(model_fn=gnn_estimator.model_fn, model_dir=FLAGS.model_dir, params=params,
+                                           config=tf.estimator.RunConfig(session_config=gnn_estimator.session_config()))
+        # As arrays, which the graphs of the estimator and the functions of the trainer can both take
+        questions = {name: feature.numpy() for name, feature in synthetic_questions(FLAGS.batch_size).items()}
+
+        def input_fn(params):
+            return tf.data.Dataset.from_tensors(questions).repeat()
+
+        estimator.train(input_fn, steps=2)
+        estimator_checkpoint = tf.train.load_checkpoint(tf.train.latest_checkpoint(FLAGS.model_dir))
+        estimator_shapes = estimator_checkpoint.get_variable_to_shape_map()
+
+        trainer = gnn_trainer.GraphNetworkTrainer(params, params['accumulation_steps'])
+        trainer.build(questions)
+        errors = ["%s is not in the estimator checkpoint" % name
+                  for name in sorted(set(trainer.named_variables) - set(estimator_shapes))]
+        errors += ["%s is not in the trainer checkpoint" % name
+                   for name in sorted(set(estimator_shapes) - set(trainer.named_variables))]
+        if errors:
+            # The trainer cannot restore the checkpoint at all
+            return report_checkpoint_errors(errors)
+        trainer.restore()
+        errors += ["%s was not restored from the estimator checkpoint" % name
+                   for name, variable in sorted(trainer.named_variables.items())
+                   if not np.array_equal(variable.numpy(), estimator_checkpoint.get_tensor(name))]
+
+        trainer.train_step(questions)
+        trainer.save()
+        trainer_shapes = tf.train.load_checkpoint(tf.train.latest_checkpoint(FLAGS.model_dir)).get_variable_to_shape_map()
+        errors += ["%s has shape %s in the trainer checkpoint, %s in that of the estimator" % (
+            name, trainer_shapes[name], shape) for name, shape in sorted(estimator_shapes.items())
+            if name in trainer_shapes and trainer_shapes[name] != shape]
+
+        trainer_logits = trainer.network(questions)['logits'].numpy()
+        estimator_logits = np.stack([prediction['logits'] for prediction in estimator.predict(
+            lambda: tf.data.Dataset.from_tensors(questions), yield_single_examples=True)])
+        difference = np.max(np.abs(trainer_logits - estimator_logits))
+        if difference > 1e-4:
+            errors.append("the estimator scores differ from those of the trainer by %g" % difference)
+
+    return report_checkpoint_errors(errors)
+
+
+def report_checkpoint_errors(errors):
+    for error in errors:
+        print(error)
+    print("Checkpoints are compatible" if not errors else "%d checkpoint errors" % len(errors))
+    return not errors
+
+
+def benchmark_worker_steps():
+    """Trains the GNN estimator on a repeated batch of random questions as one worker of the cluster in TF_CONFIG,
+    returns how many steps it ran after its first one and when they started and ended. Every worker builds the same
+    synthetic graph."""
+    np.random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        params = synthetic_gnn_params(directory)
+        estimator = tf.estimator.Estimator(model_fn=gnn_estimator.model_fn, model_dir=FLAGS.model_dir,
+                                           params=params, config=gnn_estimator.build_run_config())
+
+        def input_fn(params, input_context=None):
+            return tf.data.Dataset.from_tensors(synthetic_questions(FLAGS.batch_size)).repeat()
+
+        hook = StepTimesHook()
+        tf.estimator.train_and_evaluate(estimator,
+                                        tf.estimator.TrainSpec(input_fn, max_steps=FLAGS.benchmark_steps + 1,
+                                                               hooks=[hook]),
+                                        tf.estimator.EvalSpec(input_fn))
+
+    # With parameter servers the workers share the global steps, so a worker that starts late runs fewer of them,
+    # possibly none; the speed of the cluster is measured over the steps of all the workers, see benchmark_scaling.
+    if not hook.step_times:
+        return {"steps": 0}
+    return {
+        "steps": len(hook.step_times) - 1,
+        "first_step_end": hook.step_times[0],
+        "last_step_end": hook.step_times[-1]
+    }
+
+
+def run_isolated(overrides, benchmark="gnn_step"):
+    """Runs `benchmark` in a new process with the flags of this one and `overrides`, so that its peak memory is not
+    shared with other runs."""
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--benchmark=" + benchmark] + [
+        "--%s=%s" % (name, value) for name, value in overrides.items()]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_recompute():
+    print("%-12s %-10s %10s %12s %16s %16s" % ("recurrences", "recompute", "step ms", "examples/s", "step memory MB",
+                                               "peak memory MB"))
+    for recurrences in FLAGS.recurrence_sweep:
+        for recompute in [False, True]:
+            result = run_isolated({"recurrences": recurrences, "recompute": recompute})
+            print("%-12s %-10s %10.1f %12.1f %16.0f %16.0f" % (recurrences, recompute, result["step_ms"],
+                                                               result["examples_per_sec"], result["step_memory_mb"],
+                                                               result["peak_memory_mb"]))
+            sys.stdout.flush()
+
+
+def benchmark_accumulation():
+    print("%-13s %-16s %10s %12s %16s %16s" % ("micro-batches", "micro-batch size", "step ms", "examples/s",
+                                               "step memory MB", "peak memory MB"))
+    for accumulation_steps in FLAGS.accumulation_sweep:
+        result = run_isolated({"accumulation_steps": accumulation_steps})
+        print("%-13s %-16d %10.1f %12.1f %16.0f %16.0f" % (accumulation_steps,
+                                                           FLAGS.batch_size // int(accumulation_steps),
+                                                           result["step_ms"], result["examples_per_sec"],
+                                                           result["step_memory_mb"], result["peak_memory_mb"]))
+        sys.stdout.flush()
+
+
+def benchmark_memory():
+    print("%-10s %16s %20s %10s" % ("batch size", "step memory MB", "estimated memory MB", "error"))
+    for batch_size in FLAGS.batch_sweep:
+        result = run_isolated({"batch_size": batch_size})
+        print("%-10s %16.0f %20.0f %9.0f%%" % (batch_size, result["step_memory_mb"], result["estimated_memory_mb"],
+                                               100 * (result["estimated_memory_mb"] / result["step_memory_mb"] - 1)))
+        sys.stdout.flush()
+
+
+def benchmark_engines():
+    print("%-22s %14s %12s %16s" % ("engine", "first step s", "steps/s", "steps/s of call"))
+    runs = [("estimator", "estimator_steps", {}),
+            ("trainer", "trainer_steps", {"jit_compile": False}),
+            ("trainer (XLA)", "trainer_steps", {"jit_compile": True})]
+    for name, benchmark, overrides in runs:
+        result = run_isolated(overrides, benchmark)
+        print("%-22s %14.1f %12.2f %16.2f" % (name, result["first_step_sec"], result["steps_per_sec"],
+                                               result["call_steps_per_sec"]))
+        sys.stdout.flush()
+
+
+def run_workers(num_workers, base_port):
+    """Runs worker_steps on a local cluster of `num_workers` workers, returns the results of the training workers."""
+    with tempfile.TemporaryDirectory() as directory:
+        cluster = launch_workers.local_cluster(num_workers, FLAGS.num_ps, FLAGS.distribution, base_port)
+        command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + [
+            "--benchmark=worker_steps", "--model_dir=" + os.path.join(directory, "model")]
+        log_dir = os.path.join(directory, "logs")
+        exit_codes = launch_workers.wait_for_tasks(*launch_workers.start_tasks(command, cluster, log_dir))
+        if max(exit_codes):
+            raise RuntimeError("A worker failed, see the logs of a run with launch_workers.py")
+
+        results = []
+        for task_type in ["chief", "worker"]:
+            for index in range(len(cluster.get(task_type, []))):
+                with open(os.path.join(log_dir, "%s-%d.log" % (task_type, index))) as log:
+                    lines = [line for line in log.read().splitlines() if line.startswith("{")]
+                results.append(json.loads(lines[-1]))
+
+    return results
+
+
+def benchmark_scaling():
+    """Reports the examples per second of each number of workers and its scaling efficiency, the ratio of that
+    speed to the number of workers times the speed of one worker.
+
+    The speed of a cluster is the number of steps its workers ran after their first one over the time from the end
+    of the earliest first step to the end of the latest last step.
+    """
+    if FLAGS.distribution == "mirrored":
+        raise ValueError("Choose the multi_worker or parameter_server distribution to compare numbers of workers")
+
+    print("%-8s %14s %18s %12s" % ("workers", "examples/s", "examples/s/worker", "efficiency"))
+    single_worker_speed = None
+    for i, num_workers in enumerate(FLAGS.worker_sweep):
+        num_workers = int(num_workers)
+        results = [result for result in run_workers(num_workers, FLAGS.base_port + 100 * i) if result["steps"]]
+        duration = max(result["last_step_end"] for result in results) - min(
+            result["first_step_end"] for result in results)
+        speed = sum(result["steps"] for result in results) * FLAGS.batch_size / duration
+        if single_worker_speed is None:
+            single_worker_speed = speed / num_workers
+        print("%-8d %14.1f %18.1f %12.2f" % (num_workers, speed, speed / num_workers,
+                                             speed / (num_workers * single_worker_speed)))
+        sys.stdout.flush()
+
+
+def main(argv):
+    if FLAGS.benchmark == "gnn_step":
+        print(json.dumps(benchmark_gnn_step()))
+    elif FLAGS.benchmark == "recompute":
+        benchmark_recompute()
+    elif FLAGS.benchmark == "accumulation":
+        benchmark_accumulation()
+    elif FLAGS.benchmark == "estimator_steps":
+        print(json.dumps(benchmark_estimator_steps()))
+    elif FLAGS.benchmark == "trainer_steps":
+        print(json.dumps(benchmark_trainer_steps()))
+    elif FLAGS.benchmark == "engines":
+        benchmark_engines()
+    elif FLAGS.benchmark == "worker_steps":
+        print(json.dumps(benchmark_worker_steps()))
+    elif FLAGS.benchmark == "scaling":
+        benchmark_scaling()
+    elif FLAGS.benchmark == "memory":
+        benchmark_memory()
+    elif FLAGS.benchmark == "embedding_loading":
+        print(json.dumps(benchmark_embedding_loading()))
+    elif FLAGS.benchmark == "question_records":
+        print(json.dumps(benchmark_question_records()))
+    elif FLAGS.benchmark == "edge_construction":
+        print(json.dumps(benchmark_edge_construction()))
+    elif FLAGS.benchmark == "gnn_passes":
+        print(json.dumps(benchmark_gnn_passes()))
+    elif FLAGS.benchmark == "transformer_passes":
+        print(json.dumps(benchmark_transformer_passes()))
+    elif FLAGS.benchmark == "attention":
+        benchmark_attention()
+    elif FLAGS.benchmark == "fact_batching":
+        benchmark_fact_batching()
+    elif FLAGS.benchmark == "output_layer":
+        benchmark_output_layer()
+    elif FLAGS.benchmark == "projections":
+        benchmark_projections()
+    elif FLAGS.benchmark == "graph_memory":
+        benchmark_graph_memory()
+    elif FLAGS.benchmark == "node_scatter":
+        benchmark_node_scatter()
+    elif FLAGS.benchmark == "checkpoints":
+        if not check_checkpoints():
+            sys.exit(1)
+    elif FLAGS.benchmark == "suite":
+        if not benchmark_suite():
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
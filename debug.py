@@ -1,14 +1,7 @@
 import tensorflow as tf
 import numpy as np
 
-
-def normalize_unique(x):
-    print("normalize_unique: " + str(x))
-    with tf.device('/cpu:0'):
-        ___, idx, count = tf.unique_with_counts(x)
-    counts = tf.gather(count, idx)
-    print("counts: " + str(tf.cast(1 / counts, tf.float32)))
-    return tf.cast(1 / counts, tf.float32)
+import transformer_model
 
 
 # attention: the attention weights
@@ -100,22 +93,13 @@ if __name__ == '__main__':
         print("graphNodes: " + str(graphNodes))
         print("Difference: " + str(tf.not_equal(oldGraph, graphNodes)))
 
-        # Project signal to the same nodes for added expressiveness
-        closest_words_ind_batched = tf.reshape(closest_words_ind, [-1, seq])  # Need to turn it into [batch, graph_len] so that map_fn can work on each sample
-        norm_duplicate = tf.expand_dims(tf.map_fn(normalize_unique, closest_words_ind_batched, dtype=tf.float32), -1)
-        print("norm_duplicate: "  + str(norm_duplicate.shape))
-        batched_nodes = tf.reshape(tf.tile(graphNodes, [tf.shape(x)[0], 1]), [-1] + graphNodes.get_shape().as_list())
-        print("batched_nodes: " + str(batched_nodes.shape))
-        print("closest_words_ind_batched: " + str(closest_words_ind_batched.shape))
-        positions = tf.where(tf.not_equal(closest_words_ind_batched, 99999))
-        positions = tf.slice(positions, [0, 0], [-1, 1])  # we only want the first 2 dimensions, since the last dimension is incorrect
-        positions = tf.cast(positions, tf.int32)
-        positions = tf.concat([positions, tf.reshape(closest_words_ind, [-1, 1])], -1)
-        print("compressed: " + str(compressed.shape))
-        print("norm_duplicate: " + str(tf.reshape(norm_duplicate, [-1, 1]).shape))
-        projection_signal = tf.reshape(projection(compressed), [-1, d_model]) * tf.reshape(norm_duplicate, [-1, 1])
+        # Project signal to the same nodes for added expressiveness, the duplicates of each sample averaged
+        closest_words_ind_batched = tf.reshape(closest_words_ind, [-1, seq])
+        projection_signal = tf.reshape(projection(compressed), [-1, seq, d_model])
         print("projection_signal: " + str(projection_signal.shape))
-        print("positions: " + str(positions))
+        norm_duplicate = transformer_model.normalize_unique(closest_words_ind_batched, graph_size)
+        print("norm_duplicate: " + str(norm_duplicate))
 
-        encodedGraph = tf.tensor_scatter_nd_add(batched_nodes, positions, projection_signal) # [batch_size, graph_size, FLAGS.d_model]
-        print("encodedGraph: " + str(encodedGraph))
\ No newline at end of file
+        encodedGraph = transformer_model.scatter_unique_mean(closest_words_ind_batched, projection_signal, graph_size,
+                                                             graphNodes)  # [batch_size, graph_size, FLAGS.d_model]
+        print("encodedGraph: " + str(encodedGraph))
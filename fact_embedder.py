@@ -0,0 +1,282 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import time
+import types
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+import profiling
+import transformer_model
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_string("encoder_checkpoint", default="",
+      help="checkpoint of the transformer whose encoder is used, random weights if empty")
+flags.DEFINE_integer("encoder_vocab_size", default=0,
+      help="vocabulary size of the transformer; if 0, that of encoder_checkpoint")
+flags.DEFINE_integer("encoder_layers", default=4,
+      help="number of layers of the transformer encoder")
+flags.DEFINE_integer("encoder_depth", default=512,
+      help="depth of the transformer encoder")
+flags.DEFINE_integer("encoder_heads", default=8,
+      help="number of attention heads of the transformer encoder")
+flags.DEFINE_integer("encoder_feedforward", default=1024,
+      help="depth of the feed forward layers of the transformer encoder")
+flags.DEFINE_integer("encoder_max_length", default=1024,
+      help="most tokens of a sentence the transformer encoder takes, the size of its positional encoding")
+flags.DEFINE_string("fact_source", default="processed/facts_only_training.tfrecords",
+      help="facts to embed: TFRecords written by text_processor.text_processor, or a text file of one fact per line")
+flags.DEFINE_string("fact_tokenizer", default="processed/tokenizer",
+      help="subword tokenizer saved by text_processor.text_processor, which tokenizes the facts of a text fact_source "
+           "and the validation questions of the precision report")
+flags.DEFINE_string("fact_vectors_dir", default="fact_vectors/",
+      help="directory of the memory-mapped fact vectors and of their index of fact hashes")
+flags.DEFINE_enum("fact_pooling", default="mean", enum_values=["mean", "max", "first"],
+      help="how the encodings of the tokens of a fact are pooled into its vector: their mean or maximum over the "
+           "tokens that are not padding, or the encoding of the first (start) token")
+flags.DEFINE_integer("fact_max_tokens", default=65536,
+      help="number of tokens of each batch of facts run through the encoder, padding included")
+
+FLAGS = flags.FLAGS
+
+# The variable of the embedding, whose shape gives the vocabulary size of a checkpoint
+EMBEDDING_VARIABLE = "transformer/encoder/embedding/embeddings"
+# Number of new facts encoded between two writes of the cache, so that an interrupted run keeps most of its work
+CACHE_WRITE_FACTS = 16384
+
+
+def encoder_hyperparameters():
+    return types.SimpleNamespace(layers=FLAGS.encoder_layers, depth=FLAGS.encoder_depth, heads=FLAGS.encoder_heads,
+                                 feedforward=FLAGS.encoder_feedforward, dropout=0.0)
+
+
+def checkpoint_vocab_size(checkpoint):
+    if not checkpoint:
+        raise ValueError("encoder_vocab_size is needed without an encoder_checkpoint")
+    return dict(tf.train.list_variables(checkpoint))[EMBEDDING_VARIABLE][0]
+
+
+def fact_hash(tokens):
+    """The 64 bits hash of the tokens of a fact, the same whether the fact was read from records or from text."""
+    return int.from_bytes(hashlib.blake2b(np.asarray(tokens, np.int32).tobytes(), digest_size=8).digest(), "little")
+
+
+def read_record_facts(path):
+    """The tokens of the facts of the TFRecords of `path` written by text_processor.text_processor, without their
+    padding."""
+    name_to_features = {
+        "input_ids": tf.io.VarLenFeature(tf.int64),
+        "input_len": tf.io.FixedLenFeature([1], tf.int64)
+    }
+    d = tf.data.TFRecordDataset(tf.io.gfile.glob(path)).batch(4096)
+    d = d.map(lambda records: tf.io.parse_example(records, name_to_features))
+    for batch in d:
+        for tokens, length in zip(tf.sparse.to_dense(batch["input_ids"]).numpy(), batch["input_len"].numpy()[:, 0]):
+            yield tokens[:length]
+
+
+def encode_text_facts(lines, tokenizer_path):
+    """The tokens of the facts of `lines`, the empty ones left out, between the start and end tokens as
+    text_processor.text_processor encodes them with the tokenizer of `tokenizer_path`."""
+    tokenizer = tfds.features.text.SubwordTextEncoder.load_from_file(tokenizer_path)
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield [tokenizer.vocab_size] + tokenizer.encode(line) + [tokenizer.vocab_size + 1]
+
+
+def read_text_facts(path, tokenizer_path):
+    """The tokens of the facts of the text file of `path`, one per line (see encode_text_facts)."""
+    with open(path, "r") as facts:
+        for tokens in encode_text_facts(facts, tokenizer_path):
+            yield tokens
+
+
+def pool(encoded, sentences, pooling):
+    """Pools the encodings (batch_size, seq_len, depth) of the tokens of `sentences` into a vector per sentence, the
+    padding left out."""
+    if pooling == "first":
+        return encoded[:, 0]
+    real = tf.expand_dims(tf.cast(tf.not_equal(sentences, 0), tf.float32), -1)
+    if pooling == "max":
+        return tf.reduce_max(encoded + (real - 1) * 1e9, 1)
+    return tf.reduce_sum(encoded * real, 1) / tf.maximum(tf.reduce_sum(real, 1), 1)
+
+
+class FactEmbedder(object):
+    """Encodes facts into vectors of the depth of the transformer with only its encoder (the decoder is never built),
+    with the weights of `checkpoint`, and pools the encodings of the tokens of each fact. Facts are at most
+    `max_length` tokens."""
+
+    def __init__(self, vocab_size, hyperparameters, checkpoint="", pooling="mean", max_tokens=65536,
+                 max_length=1024):
+        self.depth = hyperparameters.depth
+        self.max_tokens = max_tokens
+        graph = tf.Graph()
+        with graph.as_default():
+            if not checkpoint:
+                # The random weights are then the same in every run, as are the vectors of the cache
+                tf.keras.utils.set_random_seed(0)
+            self.sentences = tf.compat.v1.placeholder(tf.int32, [None, None], "sentences")
+            model = transformer_model.TED_generator(vocab_size, hyperparameters, encoder_only=True,
+                                                    return_attention=False, max_length=max_length)
+            encoded, _, _ = model(self.sentences, False)
+            self.vectors = pool(encoded, self.sentences, pooling)
+
+            self.session = tf.compat.v1.Session()
+            self.session.run(tf.compat.v1.global_variables_initializer())
+            if checkpoint:
+                tf.compat.v1.train.Saver().restore(self.session, checkpoint)
+        graph.finalize()
+
+    def embed(self, facts, monitor=None):
+        """The vectors (len(facts), depth) of `facts`, lists of tokens. The facts are encoded from the shortest to the
+        longest, in batches of as many facts as fit in max_tokens tokens once padded to the longest of the batch.
+        Each batch is a step of the profiling.StepMonitor `monitor`, whose input is the padded batch."""
+        monitor = monitor or profiling.StepMonitor()
+        order = np.argsort([len(fact) for fact in facts], kind="stable")
+        vectors = np.zeros([len(facts), self.depth], np.float32)
+        start = 0
+        while start < len(order):
+            monitor.begin_step()
+            end = start + 1
+            while end < len(order) and (end + 1 - start) * len(facts[order[end]]) <= self.max_tokens:
+                end += 1
+
+            batch = np.zeros([end - start, len(facts[order[end - 1]])], np.int32)
+            for i, fact in enumerate(order[start:end]):
+                batch[i, :len(facts[fact])] = facts[fact]
+            input_ready = time.time()
+            vectors[order[start:end]] = self.session.run(self.vectors, {self.sentences: batch})
+            monitor.end_step(end - start, input_ready)
+            start = end
+
+        return vectors
+
+
+class VectorCache(object):
+    """The vectors of facts in a memory-mapped matrix, vectors.npy of `directory`, whose rows are keyed by the hashes
+    of the facts in hashes.npy. The `config` of the encoder that made the vectors is kept in config.json, the cache
+    cannot be used with another one.
+
+    Rows are only ever appended: the matrix is reallocated at twice its size when it is full, and the hashes are
+    written after their vectors, so that an interrupted run never leaves hashes without their vectors.
+    """
+
+    def __init__(self, directory, config):
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.hashes_path = os.path.join(directory, "hashes.npy")
+        config_path = os.path.join(directory, "config.json")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if os.path.exists(config_path):
+            with open(config_path, "r") as config_file:
+                if json.load(config_file) != config:
+                    raise ValueError("The fact vectors of " + directory + " were made by another encoder")
+        else:
+            with open(config_path, "w") as config_file:
+                json.dump(config, config_file)
+
+        if os.path.exists(self.hashes_path):
+            self.hashes = np.load(self.hashes_path)
+            self.vectors = np.load(self.vectors_path, mmap_mode="r+")
+        else:
+            self.hashes = np.zeros([0], np.uint64)
+            self.vectors = np.lib.format.open_memmap(self.vectors_path, "w+", np.float32,
+                                                     (CACHE_WRITE_FACTS, config["depth"]))
+        self.rows = dict(zip(self.hashes.tolist(), range(len(self.hashes))))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, hashes):
+        """The row of each of `hashes`, -1 for those not in the cache."""
+        return np.array([self.rows.get(fact_hash, -1) for fact_hash in hashes], np.int64)
+
+    def add(self, hashes, vectors):
+        """Appends the `vectors` of the facts of `hashes`, none of which is in the cache yet."""
+        count = len(self.hashes)
+        if count + len(vectors) > len(self.vectors):
+            self.grow(max(2 * len(self.vectors), count + len(vectors)))
+        self.vectors[count:count + len(vectors)] = vectors
+        self.vectors.flush()
+
+        self.hashes = np.concatenate([self.hashes, np.asarray(hashes, np.uint64)])
+        np.save(self.hashes_path + ".tmp.npy", self.hashes)
+        os.replace(self.hashes_path + ".tmp.npy", self.hashes_path)
+        self.rows.update(zip(hashes, range(count, len(self.hashes))))
+
+    def grow(self, capacity):
+        vectors = np.lib.format.open_memmap(self.vectors_path + ".tmp.npy", "w+", np.float32,
+                                            (capacity, self.vectors.shape[1]))
+        vectors[:len(self.hashes)] = self.vectors[:len(self.hashes)]
+        vectors.flush()
+        del vectors, self.vectors
+        os.replace(self.vectors_path + ".tmp.npy", self.vectors_path)
+        self.vectors = np.load(self.vectors_path, mmap_mode="r+")
+
+
+def read_cached_vectors(directory):
+    """The vectors of the VectorCache of `directory`, in the order they were added, without the rows of the matrix
+    that are not filled yet."""
+    count = len(np.load(os.path.join(directory, "hashes.npy")))
+    return np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")[:count]
+
+
+def embed_facts(embedder, cache, facts, monitor=None):
+    """Adds the vectors of `facts` to `cache`, encoding only those that are not in it yet (each once), in the batches
+    of FactEmbedder.embed that `monitor` follows. Returns the row of the vector of each fact and the number of facts
+    encoded."""
+    hashes = [fact_hash(fact) for fact in facts]
+    new_facts = {}
+    for fact, fact_hash_, row in zip(facts, hashes, cache.lookup(hashes)):
+        if row < 0:
+            new_facts.setdefault(fact_hash_, fact)
+
+    # The new facts are sorted by length first, so that each write of the cache gets facts of similar lengths
+    new_hashes = sorted(new_facts, key=lambda fact_hash_: len(new_facts[fact_hash_]))
+    for start in range(0, len(new_hashes), CACHE_WRITE_FACTS):
+        chunk = new_hashes[start:start + CACHE_WRITE_FACTS]
+        cache.add(chunk, embedder.embed([new_facts[fact_hash_] for fact_hash_ in chunk], monitor))
+        print("Encoded %d of %d new facts" % (start + len(chunk), len(new_hashes)))
+
+    return cache.lookup(hashes), len(new_hashes)
+
+
+def main(argv=None):
+    if FLAGS.fact_source.endswith(".tfrecords"):
+        facts = list(read_record_facts(FLAGS.fact_source))
+    else:
+        facts = list(read_text_facts(FLAGS.fact_source, FLAGS.fact_tokenizer))
+
+    vocab_size = FLAGS.encoder_vocab_size or checkpoint_vocab_size(FLAGS.encoder_checkpoint)
+    hyperparameters = encoder_hyperparameters()
+    config = dict(vars(hyperparameters), vocab_size=vocab_size, checkpoint=FLAGS.encoder_checkpoint,
+                  pooling=FLAGS.fact_pooling)
+    cache = VectorCache(FLAGS.fact_vectors_dir, config)
+    embedder = FactEmbedder(vocab_size, hyperparameters, FLAGS.encoder_checkpoint, FLAGS.fact_pooling,
+                            FLAGS.fact_max_tokens, FLAGS.encoder_max_length)
+
+    # The batches of the encoder are the steps of step_stats_file and profile_dir
+    monitor = profiling.step_monitor()
+    start = time.time()
+    rows, num_encoded = embed_facts(embedder, cache, facts, monitor)
+    elapsed = time.time() - start
+    monitor.close()
+    # The row in vectors.npy of the vector of each fact of the source, in its order
+    np.save(os.path.join(FLAGS.fact_vectors_dir, os.path.basename(FLAGS.fact_source) + ".rows.npy"), rows)
+    print("%d facts: %d encoded in %.1f s (%.1f facts/s), the others were cached or duplicates" % (
+        len(facts), num_encoded, elapsed, num_encoded / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
@@ -17,17 +17,23 @@ from __future__ import print_function
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from graph_nets import blocks
+from graph_nets import graphs
 from graph_nets import modules
 from graph_nets import utils_tf
 import sonnet as snt
 import functools
+import json
 import os
+import time
 
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import numpy as np
 import matplotlib.pyplot as plt
 
+import memory_planner
+import profiling
 import text_processor
 
 flags = tf.compat.v1.flags
@@ -39,6 +45,19 @@ flags.DEFINE_string("model_dir", default="gnn_model/",
       help="directory of model")
 flags.DEFINE_string("graph_dir", default="graph_model/",
       help="directory of graph")
+flags.DEFINE_string("question_dir", default="question_data",
+      help="directory of the question records, which may be split into several shards per split")
+flags.DEFINE_integer("num_readers", default=4,
+      help="number of question record files read in parallel")
+flags.DEFINE_integer("shuffle_buffer", default=10000,
+      help="number of questions in the shuffle buffer during training")
+flags.DEFINE_bool("cache_input", default=True,
+      help="whether to keep the serialized question records in memory after the first epoch")
+flags.DEFINE_integer("timing_steps", default=100,
+      help="number of training steps over which input and compute time are reported, 0 to disable")
+flags.DEFINE_enum("distribution", default="mirrored", enum_values=["mirrored", "multi_worker", "parameter_server"],
+      help="how training is distributed: over the local devices, or over the workers of the cluster in TF_CONFIG "
+           "with synchronous all-reduce or with parameter servers (see launch_workers.py); batch_size is per worker")
 flags.DEFINE_integer("train_steps", default=100000,
       help="number of training steps")
 flags.DEFINE_float("dropout", default=0.3,
@@ -47,10 +66,37 @@ flags.DEFINE_integer("global_size", default=300,
       help="the depth of the global state")
 flags.DEFINE_integer("seq_len", default=80,
       help="length of the each fact")
+flags.DEFINE_bool("split_stem", default=False,
+      help="whether to encode the question stem once and the choices separately")
+flags.DEFINE_integer("stem_len", default=64,
+      help="length of the question stem when split_stem is used")
+flags.DEFINE_integer("choice_len", default=16,
+      help="length of each choice when split_stem is used")
 flags.DEFINE_integer("batch_size", default=128,
       help="batch size for training")
+flags.DEFINE_integer("eval_batch_size", default=256,
+      help="batch size for evaluation and prediction")
 flags.DEFINE_integer("recurrences", default=5,
       help="number of times graph is processed through gnn")
+flags.DEFINE_enum("halting", default="none", enum_values=["none", "delta", "learned"],
+      help="how a graph stops its recurrent passes early: never, when its globals stop changing, or when a learned "
+           "halting unit says so; the graphs that have halted go through no more passes, except in the XLA-compiled "
+           "steps of gnn_trainer, where they are masked out of the passes until every graph of the batch halts")
+flags.DEFINE_float("halt_threshold", default=1e-3,
+      help="change of the globals below which a graph halts, or halting slack of the learned halting unit")
+flags.DEFINE_float("ponder_cost", default=1e-3,
+      help="weight of the number of passes in the loss with the learned halting unit")
+flags.DEFINE_bool("recompute", default=False,
+      help="whether to recompute the activations of every recurrent pass and question encoder chunk during "
+           "backpropagation instead of keeping them, which makes training memory roughly constant in depth")
+flags.DEFINE_integer("encoder_chunk", default=16,
+      help="number of question tokens encoded per recomputed chunk when recompute is used")
+flags.DEFINE_integer("accumulation_steps", default=1,
+      help="number of micro-batches a training batch is split into; their gradients are summed into a single "
+           "update, so that the memory of a step is that of a micro-batch")
+flags.DEFINE_bool("bfloat16", default=False,
+      help="whether grappler runs the matmuls, the LSTM and the other ops it can in bfloat16 on CPU (with oneDNN), "
+           "keeping the variables and the loss in float32")
 flags.DEFINE_float("learning_rate", default=1e-5,
       help="learning rate for ADAM optimizer")
 
@@ -58,8 +104,12 @@ flags.DEFINE_bool("train", default=True,
       help="whether to train")
 flags.DEFINE_bool("predict", default=True,
       help="whether to predict")
+flags.DEFINE_bool("debug_predictions", default=False,
+      help="whether to also compute the intermediate tensors of the model as predictions")
 flags.DEFINE_integer("predict_samples", default=10,
       help="the number of samples to predict")
+flags.DEFINE_string("results_file", default="",
+      help="file the per-question predictions are written to, predictions.npz in model_dir by default")
 flags.DEFINE_string("description", default="",
       help="description of experiment")
 
@@ -70,155 +120,651 @@ for i, key in enumerate(flags.keys()):
         print(key + ": " + str(flags[key]))
 
 SIGNATURE_NAME = "serving_default"
+INPUT_READY_COLLECTION = "input_ready_time"
 num_choices = 4
 
 
-def model_fn(features, labels, mode, params):
-    sentences = features["input_ids"]
-    word_embedding = tf.constant(params['word_embedding'])
-    graph_nodes = params['graph_nodes']
-    graph_edges = params['graph_edges']
-    depth = graph_nodes.shape[1]
-    training = mode == tf.estimator.ModeKeys.TRAIN
+class StepTimingHook(tf.estimator.SessionRunHook):
+    """Splits the wall time of the training steps into the time spent waiting for the input pipeline and the time
+    spent computing, and reports both every `every_n_steps` steps.
+
+    The model records a timestamp as soon as the features of a step are available (see INPUT_READY_COLLECTION);
+    everything before it counts as input wait. Given a `stats_file`, the times of every step are also written to it
+    at the end of training, as JSON or CSV according to its extension, so that runs can be compared.
+    """
+
+    def __init__(self, batch_size, every_n_steps, stats_file=None):
+        self._batch_size = batch_size
+        self._every_n_steps = every_n_steps
+        self._stats_file = stats_file
+
+    def begin(self):
+        self._input_ready = tf.compat.v1.get_collection(INPUT_READY_COLLECTION)
+        self._step_stats = []
+        self._reset()
+
+    def _reset(self):
+        self._steps = 0
+        self._input_time = 0.0
+        self._total_time = 0.0
+
+    def before_run(self, run_context):
+        self._start = time.time()
+        return tf.estimator.SessionRunArgs(self._input_ready)
+
+    def after_run(self, run_context, run_values):
+        end = time.time()
+        # With several replicas the step can only start once the last of them received its features.
+        input_ready = max(run_values.results) if run_values.results else self._start
+        stats = profiling.step_stats(len(self._step_stats) + 1, self._start, input_ready, end, self._batch_size)
+        self._input_time += stats['input_ms'] / 1000
+        self._total_time += end - self._start
+        self._steps += 1
+
+        if self._stats_file:
+            self._step_stats.append(stats)
+
+        if self._steps == self._every_n_steps:
+            step_time = self._total_time / self._steps
+            input_time = self._input_time / self._steps
+            input_fraction = self._input_time / self._total_time
+            print("Step time: %.1f ms (input %.1f ms, compute %.1f ms), %.1f examples/sec, %s-bound" % (
+                step_time * 1000, input_time * 1000, (step_time - input_time) * 1000, self._batch_size / step_time,
+                "input" if input_fraction > 0.5 else "compute"))
+            self._reset()
+
+    def end(self, session):
+        if self._stats_file and self._step_stats:
+            profiling.write_step_stats(self._stats_file, self._step_stats)
+
+
+class ProfilerTraceHook(tf.estimator.SessionRunHook):
+    """Captures a TensorFlow profiler trace of `num_steps` training steps, after the first `start_step` steps of the
+    training call. The ops of the stages of the model are in the name scopes of QuestionGraphNetwork.__call__."""
+
+    def __init__(self, log_dir, start_step, num_steps):
+        self._log_dir = log_dir
+        self._start_step = start_step
+        self._num_steps = num_steps
+
+    def begin(self):
+        self._trace = profiling.TraceWindow(self._log_dir, self._start_step, self._num_steps)
+
+    def before_run(self, run_context):
+        self._trace.before_step()
+
+    def after_run(self, run_context, run_values):
+        self._trace.after_step()
+
+    def end(self, session):
+        self._trace.stop()
+
+
+def load_table(name, path):
+    """Creates a non-trainable variable holding the float32 array saved in the .npy file at `path`.
+
+    In a graph, only the path is part of it; the values are read from the file when the variable is initialized, so
+    building the graph, the meta-graphs of the checkpoints and the exports do not grow with the table. It is a local
+    variable, so it is not saved in the checkpoints either. Exports copy the file as an asset. The array is read as
+    a single record that holds the whole table, so initializing the variable holds about two copies of the table at
+    its peak: the bytes read and the values decoded from them, which the variable then keeps.
+
+    Executing eagerly (gnn_trainer), the variable is initialized from the memory-mapped file, and the tf.function
+    steps capture the variable, not its values.
+    """
+    array = np.load(path, mmap_mode='r')  # only the header is read
+    if array.dtype != np.float32 or not array.flags.c_contiguous:
+        raise ValueError(path + " does not hold a C-ordered float32 array")
+    if tf.executing_eagerly():
+        return tf.Variable(array, trainable=False, name=name)
+
+    path = tf.constant(path)
+    tf.compat.v1.add_to_collection(tf.compat.v1.GraphKeys.ASSET_FILEPATHS, path)
+    # The record starts after the header of the .npy file, its bytes are the values of the table
+    values = tf.data.experimental.get_single_element(
+        tf.data.FixedLengthRecordDataset(path, array.nbytes, header_bytes=array.offset))
+    values = tf.reshape(tf.io.decode_raw(values, tf.float32), array.shape)
+
+    return tf.compat.v1.get_variable(name, initializer=values, trainable=False,
+                                     collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+
+
+def batch_template_graph(senders, receivers, num_nodes, depth, num_graphs):
+    """Builds a GraphsTuple with `num_graphs` copies of the template graph, with empty nodes and globals and unit
+    edges. `num_graphs` can be a tensor, so the batch size does not have to be known when the graph is built."""
+    num_edges = len(senders)
+    offsets = tf.reshape(tf.range(num_graphs) * num_nodes, [-1, 1])
+
+    return graphs.GraphsTuple(
+        nodes=tf.zeros([num_graphs * num_nodes, depth]),
+        edges=tf.ones([num_graphs * num_edges, 1]),
+        globals=tf.zeros([num_graphs, FLAGS.global_size]),
+        senders=tf.reshape(offsets + tf.constant(senders, tf.int32), [-1]),
+        receivers=tf.reshape(offsets + tf.constant(receivers, tf.int32), [-1]),
+        n_node=tf.fill([num_graphs], num_nodes),
+        n_edge=tf.fill([num_graphs], num_edges))
+
+
+def recompute_grad(function):
+    """Wraps `function` so that its activations are not kept for backpropagation but recomputed from its inputs.
+
+    Unlike tf.recompute_grad, the recomputation waits for the gradients of the outputs, so that the graph optimizer
+    can neither run it early nor merge it back into the forward computation.
+
+    It is a tf.custom_gradient, which in graph mode takes as variables of `function` every variable it finds walking
+    back from the outputs through differentiable ops, stopping only at the inputs. So a tensor that `function` closes
+    over instead of taking it as an input must not depend differentiably on any other variable: the walk would reach
+    it, and fail on the local tables of model_fn or compute gradients for variables of earlier layers. Callers wrap
+    such tensors in tf.stop_gradient (see the graph nodes in _message_passing and the batch size in __call__).
+    """
+    @tf.custom_gradient
+    def recomputed(*inputs):
+        def grad_fn(*output_grads, variables=None):
+            # The inputs are cut from the graph before them, which may read the same variables
+            with tf.control_dependencies(output_grads):
+                inputs_again = [tf.stop_gradient(value) for value in inputs]
+            outputs = tf.nest.flatten(function(*inputs_again))
+            grads = tf.gradients(outputs, inputs_again + list(variables or []), grad_ys=list(output_grads))
+            if variables is None:
+                return grads
+            return grads[:len(inputs)], grads[len(inputs):]
+
+        return function(*inputs), grad_fn
+
+    return recomputed
+
+
+class QuestionGraphNetwork(object):
+    """The network of the GNN, shared by model_fn and the tf.function training loop of gnn_trainer.
+
+    Every token of a question, encoded by an LSTM, is written onto the node of the knowledge graph closest to it, and
+    the graph of each choice goes through the recurrent message passing passes before its globals are read out as
+    the logit of the choice. The layers are created once and have fixed names, so that both training paths build
+    the same variables and can read each other's checkpoints.
+
+    With adaptive halting and `compact_halting`, each pass only runs on the graphs that have not halted, a number only
+    known at run time; without it (for XLA), halted graphs are masked out of passes over the whole batch.
+    """
+
+    def __init__(self, word_embedding, graph_nodes, graph_edges, recompute=False, compact_halting=True):
+        self.word_embedding = word_embedding
+        self.graph_nodes = graph_nodes
+        self.num_nodes, self.depth = graph_nodes.shape
+        self.senders, self.receivers = np.nonzero(graph_edges)
+        self.num_edges = len(self.senders)
+        self.recompute = recompute
+        self.compact_halting = compact_halting
+
+        # With recompute the input dropout of the question encoder is applied by _encode. The LSTM is a generic RNN
+        # over an LSTMCell: XLA recompiles the function of tf.keras.layers.LSTM for every new value of its weights.
+        self.question_encoder = tf.keras.layers.RNN(
+            tf.keras.layers.LSTMCell(self.depth, dropout=0.0 if recompute else FLAGS.dropout),
+            return_sequences=True, return_state=True, name="question_encoder")
+        self.global_dense = tf.keras.layers.Dense(self.depth, activation='relu', name="global_dense")
+        self.global_layernorm = tf.keras.layers.LayerNormalization(epsilon=1e-6, name="global_layernorm")
+        # Without recurrent passes the node MLP is never built
+        self.node_mlp = snt.allow_empty_variables(snt.nets.MLP(output_sizes=[self.depth], name="node_mlp"))
+        self.node_layernorm = tf.keras.layers.LayerNormalization(epsilon=1e-6, name="node_layernorm")
+        self.node_dropout = tf.keras.layers.Dropout(FLAGS.dropout)
+        self.halting_unit = tf.keras.layers.Dense(1, activation='sigmoid', name="halting_unit")
+        self.output_dropout = tf.keras.layers.Dropout(FLAGS.dropout)
+        self.readout = tf.keras.layers.Dense(1, name="readout")
+
+        # The layers are built here, as they would be by their first call, because the name scopes of the stages of
+        # __call__ would otherwise become part of the names of their variables.
+        input_shapes = [(self.question_encoder, [None, None, self.depth]), (self.global_dense, [None, self.depth]),
+                        (self.global_layernorm, [None, self.depth]), (self.readout, [None, self.depth])]
+        if FLAGS.recurrences > 0:
+            input_shapes.append((self.node_layernorm, [None, self.depth]))
+        if FLAGS.halting == "learned":
+            input_shapes.append((self.halting_unit, [None, self.depth]))
+        for layer, input_shape in input_shapes:
+            with tf.name_scope(layer.name):
+                layer.build(tf.TensorShape(input_shape))
+
+    @property
+    def variables(self):
+        """The variables of the layers, once they have been built by a first call."""
+        layers = [self.question_encoder, self.global_dense, self.global_layernorm, self.node_mlp, self.node_layernorm,
+                  self.halting_unit, self.readout]
+        return [variable for layer in layers for variable in layer.variables]
+
+    def _encode(self, inputs, training, recompute, mask=None, initial_state=None):
+        """Runs the question encoder over the embedded inputs, returns its outputs and its final state.
+
+        With recompute the inputs are encoded in chunks of encoder_chunk tokens and only the state between the chunks
+        is kept for backpropagation. The input dropout of the encoder is then drawn here, once per sequence like the
+        LSTM does, so that a recomputed chunk sees the same dropout mask as its forward pass.
+        """
+        if not recompute:
+            return self.question_encoder(inputs, mask=mask, initial_state=initial_state, training=training)
+
+        inputs = tf.nn.dropout(inputs, FLAGS.dropout, noise_shape=[tf.shape(inputs)[0], 1, self.depth])
+        if initial_state is None:
+            initial_state = [tf.zeros([tf.shape(inputs)[0], self.depth])] * 2
+        state_h, state_c = initial_state
+
+        def encode_chunk(chunk_mask, chunk, state_h, state_c):
+            return self.question_encoder(chunk, mask=chunk_mask, initial_state=[state_h, state_c], training=training)
+
+        outputs = []
+        for start in range(0, inputs.shape[1], FLAGS.encoder_chunk):
+            end = start + FLAGS.encoder_chunk
+            encode_step = functools.partial(encode_chunk, None if mask is None else mask[:, start:end])
+            if start > 0:  # the first chunk creates the variables of the encoder
+                encode_step = recompute_grad(encode_step)
+            chunk_outputs, state_h, state_c = encode_step(inputs[:, start:end], state_h, state_c)
+            outputs.append(chunk_outputs)
+        return tf.concat(outputs, 1), state_h, state_c
+
+    def _encode_question(self, features, training, recompute):
+        """Encodes the four choices of every question, returns the encoded tokens [batch * 4, question_len, depth]
+        and their padding mask [batch * 4, question_len, 1]."""
+        depth = self.depth
+        if FLAGS.split_stem:
+            # The stem is shared by all choices of a question, so it is encoded once and its final state is used as
+            # the initial state of the four (short) choice encodings. Masked (padding) steps carry the LSTM state
+            # forward, so every choice sees exactly the state it would have had after the stem in the unsplit input.
+            question_len = FLAGS.stem_len + FLAGS.choice_len
+            stems = tf.cast(features["stem_ids"], tf.int32)
+            choices = tf.reshape(tf.cast(features["choice_ids"], tf.int32), [-1, FLAGS.choice_len])
+            stem_mask = tf.not_equal(stems, 1)
+            choice_mask = tf.not_equal(choices, 1)
+
+            encoded_stem, stem_h, stem_c = self._encode(tf.nn.embedding_lookup(self.word_embedding, stems),
+                                                        training, recompute, mask=stem_mask)
+            initial_state = [tf.repeat(stem_h, num_choices, axis=0), tf.repeat(stem_c, num_choices, axis=0)]
+            encoded_choices, _, _ = self._encode(tf.nn.embedding_lookup(self.word_embedding, choices),
+                                                 training, recompute, mask=choice_mask, initial_state=initial_state)
+
+            encoded_question = tf.concat([tf.repeat(encoded_stem, num_choices, axis=0), encoded_choices], 1)
+            padding_mask = tf.concat([tf.repeat(stem_mask, num_choices, axis=0), choice_mask], 1)
+            padding_mask = tf.reshape(tf.cast(padding_mask, tf.int32), [-1, question_len, 1])
+        else:
+            question_len = FLAGS.seq_len
+            sentences = features["input_ids"]
+            padding_mask = tf.cast(tf.not_equal(tf.cast(sentences, tf.int32), tf.constant([[1]])),
+                                   tf.int32)  # 0 means the token needs to be masked. 1 means it is not masked.
+            padding_mask = tf.reshape(padding_mask, [-1, question_len, 1])
+            sentences = tf.nn.embedding_lookup(self.word_embedding, sentences)
+            sentences = tf.reshape(sentences, [-1, question_len, depth])
+            encoded_question, _, _ = self._encode(sentences, training, recompute)
+
+        return encoded_question, padding_mask
+
+    def _nodes_to_globals(self, graphs):
+        """The mean of the nodes of every graph.
+
+        Like the aggregators of graph_nets, but every graph has all the nodes of the template. The aggregators count
+        the nodes of the graphs from n_node, which XLA cannot do inside the conditional passes of adaptive halting.
+        """
+        return tf.reduce_mean(tf.reshape(graphs.nodes, [-1, self.num_nodes, self.depth]), 1)
+
+    def _message_passing(self, previous_graphs, training, debug, dropout_seed=None):
+        """Runs one recurrent pass over the graphs, returns the new graphs and the debug tensors of the pass.
+
+        Given a `dropout_seed`, the dropout mask of the pass is a function of the seed, see recompute_grad.
+        """
+        num_nodes, num_edges, depth = self.num_nodes, self.num_edges, self.depth
+        diagnostics = {}
 
-    padding_mask = tf.cast(tf.not_equal(tf.cast(sentences, tf.int32), tf.constant([[1]])),
-                           tf.int32)  # 0 means the token needs to be masked. 1 means it is not masked.
-    padding_mask = tf.reshape(padding_mask, [-1, FLAGS.seq_len, 1])
-    sentences = tf.nn.embedding_lookup(word_embedding, sentences)
-    sentences = tf.reshape(sentences, [-1, FLAGS.seq_len, depth])
-    # print("sentences: " + str(sentences))
-    # print("padding_mask: " + str(padding_mask))
-    question_encoder = tf.keras.layers.LSTM(depth, dropout=FLAGS.dropout, return_sequences=True)
-    encoded_question = question_encoder(sentences, training=training)
-    encoded_question = tf.cast(padding_mask, tf.float32) * tf.cast(encoded_question, tf.float32)
-    encoded_question = tf.reshape(tf.cast(encoded_question, tf.float32), [-1, depth])
-
-    # The template graph
-    nodes = graph_nodes.astype(np.float32)
-    edges = np.ones([int(np.sum(graph_edges)), 1]).astype(np.float32)
-    senders, receivers = np.nonzero(graph_edges)
-    globals = np.zeros(FLAGS.global_size).astype(np.float32)
-
-    graph_dict = {"globals": globals,
-                  "nodes": nodes,
-                  "edges": edges,
-                  "senders": senders,
-                  "receivers": receivers}
-    original_graph = utils_tf.data_dicts_to_graphs_tuple([graph_dict])
-    graph_dict["nodes"] = nodes * 0
-    # print("encoded_question.shape[0]: " + str(encoded_question.shape[0]))
-    batch_of_tensor_data_dicts = [graph_dict for i in range(sentences.shape[0])]
-
-    batch_of_graphs = utils_tf.data_dicts_to_graphs_tuple(batch_of_tensor_data_dicts)
-    batch_of_nodes = batch_of_graphs.nodes
-    # print("batch_of_nodes: " + str(batch_of_nodes))
-
-    # Euclidean distance to identify closest nodes
-    na = tf.reduce_sum(tf.square(tf.math.l2_normalize(encoded_question, -1)), 1)
-    nb = tf.reduce_sum(tf.square(tf.math.l2_normalize(nodes, -1)), 1)
-
-    # na as a row and nb as a column vectors
-    na = tf.reshape(na, [-1, 1])
-    nb = tf.reshape(nb, [1, -1])
-
-    # return pairwise euclidead difference matrix
-    distance = tf.sqrt(tf.maximum(na - 2 * tf.matmul(encoded_question, nodes, False, True) + nb, 0.0))
-
-    # calculate attention over the graph
-    closest_nodes = tf.cast(tf.argmin(distance, -1), tf.int32)
-    # print("closest_nodes: " + str(closest_nodes))
-
-    # # Write the signals onto these nodes
-    positions = tf.where(tf.not_equal(tf.reshape(closest_nodes, [-1, FLAGS.seq_len]), 99999))
-    # print("positions: " + str(positions))
-    positions = tf.slice(positions, [0, 0], [-1, 1])  # we only want the first 2 dimensions, since the last dimension is incorrect
-    # print("positions: " + str(positions))
-    positions = tf.cast(positions, tf.int32)
-    # print("positions: " + str(positions))
-    positions = tf.concat([positions, tf.reshape(closest_nodes, [-1, 1])], -1)
-    # print("positions: " + str(positions))
-    # print("compressed: " + str(compressed1))
-    # print("norm_duplicate: " + str(tf.reshape(norm_duplicate, [-1, 1])))
-    projection_signal = tf.reshape(encoded_question, [-1, depth])
-    # print("projection_signal: " + str(projection_signal))
-    batch_of_nodes = tf.tensor_scatter_nd_add(tf.reshape(batch_of_nodes, [-1, 512, depth]), positions, projection_signal)
-    # print("batch_of_nodes: " + str(batch_of_nodes))
-    batch_of_graphs = batch_of_graphs.replace(nodes=tf.reshape(batch_of_nodes, [-1, depth]))
-
-    global_block = blocks.NodesToGlobalsAggregator(tf.math.unsorted_segment_mean)
-    global_dense = tf.keras.layers.Dense(depth, activation='relu')
-
-    num_recurrent_passes = FLAGS.recurrences
-    previous_graphs = batch_of_graphs
-    original_nodes = tf.reshape(original_graph.nodes, [1, 512, depth])
-    dropout = tf.keras.layers.Dropout(FLAGS.dropout)
-    layernorm_global = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-    layernorm_node = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-    new_global = global_block(previous_graphs)
-    previous_graphs = previous_graphs.replace(globals=global_dense(new_global))
-    previous_graphs = previous_graphs.replace(globals=layernorm_global(previous_graphs.globals))
-    initial_global = previous_graphs.globals
-
-    model_fn = snt.nets.MLP(output_sizes=[depth])
-
-    for unused_pass in range(num_recurrent_passes):
         # Update the node features with the function
-        updated_nodes = model_fn(previous_graphs.nodes)
-        updated_nodes = layernorm_node(updated_nodes)
+        updated_nodes = self.node_mlp(previous_graphs.nodes)
+        updated_nodes = self.node_layernorm(updated_nodes)
         temporary_graph = previous_graphs.replace(nodes=updated_nodes)
-        graph_sum0 = tf.reduce_sum(tf.reshape(tf.math.abs(temporary_graph.nodes), [-1, 4 * 512 * 300]), -1)
+        if debug:
+            diagnostics['graph_sum0'] = tf.reduce_sum(tf.reshape(tf.math.abs(temporary_graph.nodes),
+                                                                 [-1, 4 * num_nodes * depth]), -1)
 
         # Send the node features to the edges that are being sent by that node.
         nodes_at_edges = blocks.broadcast_sender_nodes_to_edges(temporary_graph)
-        graph_sum1 = tf.reduce_sum(tf.reshape(tf.math.abs(nodes_at_edges), [-1, 4 * 5551 * 300]), -1)
+        if debug:
+            diagnostics['graph_sum1'] = tf.reduce_sum(tf.reshape(tf.math.abs(nodes_at_edges),
+                                                                 [-1, 4 * num_edges * depth]), -1)
 
         temporary_graph = temporary_graph.replace(edges=nodes_at_edges)
 
         # Aggregate the all of the edges received by every node.
-        nodes_with_aggregated_edges = blocks.ReceivedEdgesToNodesAggregator(tf.math.unsorted_segment_mean)(
-            temporary_graph)
-        graph_sum2 = tf.reduce_sum(tf.reshape(tf.math.abs(nodes_with_aggregated_edges), [-1, 4 * 512 * 300]), -1)
+        nodes_with_aggregated_edges = tf.math.unsorted_segment_mean(nodes_at_edges, temporary_graph.receivers,
+                                                                    tf.shape(temporary_graph.nodes)[0])
+        if debug:
+            diagnostics['graph_sum2'] = tf.reduce_sum(tf.reshape(tf.math.abs(nodes_with_aggregated_edges),
+                                                                 [-1, 4 * num_nodes * depth]), -1)
         previous_graphs = previous_graphs.replace(nodes=nodes_with_aggregated_edges)
 
         current_nodes = previous_graphs.nodes
-        current_nodes = tf.reshape(current_nodes, [-1, 512, depth])
-        current_nodes = dropout(current_nodes, training=training)
-        new_nodes = current_nodes * original_nodes
+        current_nodes = tf.reshape(current_nodes, [-1, num_nodes, depth])
+        if dropout_seed is None:
+            current_nodes = self.node_dropout(current_nodes, training=training)
+        else:
+            current_nodes = tf.nn.experimental.stateless_dropout(current_nodes, FLAGS.dropout, dropout_seed)
+        # The graph nodes are a constant table; stopping their gradient also keeps recompute_grad from looking for a
+        # trainable variable behind them.
+        new_nodes = current_nodes * tf.stop_gradient(tf.reshape(self.graph_nodes, [1, num_nodes, depth]))
         previous_graphs = previous_graphs.replace(nodes=tf.reshape(new_nodes, [-1, depth]))
-        old_global = previous_graphs.globals
-        new_global = global_block(previous_graphs)
-        previous_graphs = previous_graphs.replace(globals=global_dense(new_global))
-        previous_graphs = previous_graphs.replace(globals=layernorm_global(previous_graphs.globals))
+        new_global = self._nodes_to_globals(previous_graphs)
+        if debug:
+            diagnostics['old_global'] = previous_graphs.globals
+            diagnostics['new_global'] = new_global
+        previous_graphs = previous_graphs.replace(globals=self.global_dense(new_global))
+        previous_graphs = previous_graphs.replace(globals=self.global_layernorm(previous_graphs.globals))
+
+        return previous_graphs, diagnostics
+
+    def __call__(self, features, training=False, debug=False):
+        """Scores the choices of a batch of questions.
+
+        Returns a dict with the `logits` of the choices [batch, 4], and for every choice the number of `passes` it
+        went through and the `remainders` of the learned halting unit (both None without halting). With `debug`,
+        the intermediate tensors of the network are added, see model_fn.
+        """
+        num_nodes, depth = self.num_nodes, self.depth
+        recompute = self.recompute and training
+
+        # The stages are named scopes, so that the ops of each can be told apart in profiler traces
+        with tf.name_scope("encode_question"):
+            encoded_question, padding_mask = self._encode_question(features, training, recompute)
+        question_len = padding_mask.shape[1]
+
+        # The structure of the graphs only depends on the batch size; stopping the gradient here lets the recomputed
+        # passes share it (see recompute_grad, which follows differentiable inputs looking for variables).
+        num_graphs = tf.stop_gradient(tf.shape(encoded_question)[0])
+        if recompute:
+            # With a known batch size, the graph optimizer folds the parts of the recomputed passes that only depend
+            # on shapes into constants, which stay in memory for every pass.
+            num_graphs = tf.compat.v1.placeholder_with_default(num_graphs, [])
+        encoded_question = tf.cast(padding_mask, tf.float32) * tf.cast(encoded_question, tf.float32)
+        encoded_question = tf.reshape(tf.cast(encoded_question, tf.float32), [-1, depth])
+
+        # The template graph
+        nodes = self.graph_nodes
+        batch_of_graphs = batch_template_graph(self.senders, self.receivers, num_nodes, depth, num_graphs)
+        batch_of_nodes = batch_of_graphs.nodes
+
+        with tf.name_scope("find_nearest_nodes"):
+            # Euclidean distance to identify closest nodes
+            na = tf.reduce_sum(tf.square(tf.math.l2_normalize(encoded_question, -1)), 1)
+            nb = tf.reduce_sum(tf.square(tf.math.l2_normalize(nodes, -1)), 1)
+
+            # na as a row and nb as a column vectors
+            na = tf.reshape(na, [-1, 1])
+            nb = tf.reshape(nb, [1, -1])
+
+            # return pairwise euclidead difference matrix
+            distance = tf.sqrt(tf.maximum(na - 2 * tf.matmul(encoded_question, nodes, False, True) + nb, 0.0))
+
+            # calculate attention over the graph
+            closest_nodes = tf.cast(tf.argmin(distance, -1), tf.int32)
+
+        with tf.name_scope("scatter_tokens"):
+            # Write the signals onto these nodes: every token goes to its closest node in the graph of its choice.
+            # The positions are built from the shapes alone, so that they have a static size (which XLA requires).
+            positions = tf.stack([tf.repeat(tf.range(num_graphs), question_len), closest_nodes], -1)
+            projection_signal = tf.reshape(encoded_question, [-1, depth])
+            batch_of_nodes = tf.tensor_scatter_nd_add(tf.reshape(batch_of_nodes, [-1, num_nodes, depth]), positions,
+                                                      projection_signal)
+            batch_of_graphs = batch_of_graphs.replace(nodes=tf.reshape(batch_of_nodes, [-1, depth]))
+
+        num_recurrent_passes = FLAGS.recurrences
+        previous_graphs = batch_of_graphs
+        new_global = self._nodes_to_globals(previous_graphs)
+        previous_graphs = previous_graphs.replace(globals=self.global_dense(new_global))
+        previous_graphs = previous_graphs.replace(globals=self.global_layernorm(previous_graphs.globals))
+        initial_global = previous_graphs.globals
+
+        # Each pass on the graphs still running only, gathered out of the batch, or with `compact_halting` off (XLA
+        # needs static shapes) or `debug` (whose tensors are per question), on the whole batch
+        compact = FLAGS.halting != "none" and self.compact_halting and not debug
+
+        def recurrent_pass(previous_graphs, pass_index):
+            """Runs message passing once. With recompute only the inputs of the pass are kept for backpropagation
+            and its activations are recomputed from them, except for the first pass, which creates the variables.
+            The conditional passes of adaptive halting without compact_halting are not recomputed; the gradient of
+            tf.cond cannot replay them."""
+            with tf.name_scope("message_passing"):
+                if not recompute or pass_index == 0 or (FLAGS.halting != "none" and not compact):
+                    return self._message_passing(previous_graphs, training, debug)
+
+                @recompute_grad
+                def recomputed_pass(nodes, globals_, dropout_seed):
+                    graphs, _ = self._message_passing(previous_graphs.replace(nodes=nodes, globals=globals_),
+                                                      training, False, dropout_seed)
+                    return graphs.nodes, graphs.globals
+
+                dropout_seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+                nodes, globals_ = recomputed_pass(previous_graphs.nodes, previous_graphs.globals, dropout_seed)
+                return previous_graphs.replace(nodes=nodes, globals=globals_), {}
+
+        passes, remainders = None, None
+        if FLAGS.halting == "none":
+            for pass_index in range(num_recurrent_passes):
+                previous_graphs, diagnostics = recurrent_pass(previous_graphs, pass_index)
+            output_globals = previous_graphs.globals
+        else:
+            # Adaptive depth: every graph stops being updated once it halts. With compact passes, a graph that has
+            # halted goes through no more passes; otherwise it is masked out of the passes of the whole batch, and a
+            # pass is only skipped once all graphs of the batch have halted. With "delta" a graph halts when its
+            # globals change by less than halt_threshold, with "learned" when the sum of the outputs of a halting unit
+            # reaches 1 - halt_threshold (adaptive computation time); its output is then the halting-weighted mean of
+            # the globals of its passes.
+            def adaptive_pass(state, pass_index):
+                graphs, running, passes, halted_sum, output_globals, remainders, diagnostics = state
+                graph_nodes = tf.reshape(graphs.nodes, [-1, num_nodes, depth])
+                if compact:
+                    indices = tf.cast(tf.where(running)[:, 0], tf.int32)
+                    pass_graphs = batch_template_graph(self.senders, self.receivers, num_nodes, depth,
+                                                       tf.size(indices))
+                    pass_graphs = pass_graphs.replace(
+                        nodes=tf.reshape(tf.gather(graph_nodes, indices), [-1, depth]),
+                        globals=tf.gather(graphs.globals, indices))
+                else:
+                    pass_graphs = graphs
+
+                def take(values):
+                    """The `values` of the graphs of the pass."""
+                    return tf.gather(values, indices) if compact else values
+
+                def put(values, pass_values):
+                    """`values` with those of the graphs of the pass replaced by `pass_values`."""
+                    return tf.tensor_scatter_nd_update(values, indices[:, None], pass_values) if compact \
+                        else pass_values
+
+                active = take(running)
+                new_graphs, diagnostics = recurrent_pass(pass_graphs, pass_index)
+
+                if FLAGS.halting == "delta":
+                    change = tf.reduce_mean(tf.abs(new_graphs.globals - pass_graphs.globals), -1)
+                    halts = change < FLAGS.halt_threshold
+                    output_globals = put(output_globals,
+                                         tf.where(active[:, None], new_graphs.globals, take(output_globals)))
+                else:
+                    halting = tf.squeeze(self.halting_unit(new_graphs.globals), -1)
+                    pass_halted_sum = take(halted_sum)
+                    halts = pass_halted_sum + halting >= 1 - FLAGS.halt_threshold
+                    if pass_index == num_recurrent_passes - 1:
+                        halts = tf.ones_like(halts)
+                    weight = tf.where(halts, 1 - pass_halted_sum, halting) * tf.cast(active, tf.float32)
+                    remainders = put(remainders, tf.where(active & halts, 1 - pass_halted_sum, take(remainders)))
+                    halted_sum = put(halted_sum, pass_halted_sum + weight)
+                    output_globals = put(output_globals, take(output_globals) + weight[:, None] * new_graphs.globals)
+
+                new_nodes = tf.where(active[:, None, None], tf.reshape(new_graphs.nodes, [-1, num_nodes, depth]),
+                                     take(graph_nodes))
+                graphs = graphs.replace(
+                    nodes=tf.reshape(put(graph_nodes, new_nodes), [-1, depth]),
+                    globals=put(graphs.globals, tf.where(active[:, None], new_graphs.globals, take(graphs.globals))))
+                passes = put(passes, take(passes) + tf.cast(active, tf.float32))
+                running = put(running, active & tf.logical_not(halts))
+
+                return graphs, running, passes, halted_sum, output_globals, remainders, diagnostics
+
+            batch_size = tf.shape(previous_graphs.globals)[0]
+            state = (previous_graphs, tf.ones([batch_size], tf.bool), tf.zeros([batch_size]),
+                     tf.zeros([batch_size]), tf.zeros_like(previous_graphs.globals), tf.zeros([batch_size]), {})
+            state = adaptive_pass(state, 0)
+            for pass_index in range(1, num_recurrent_passes):
+                if compact:
+                    # A pass of no graph is empty, there is nothing to skip
+                    state = adaptive_pass(state, pass_index)
+                else:
+                    state = tf.cond(tf.reduce_any(state[1]),
+                                    functools.partial(adaptive_pass, state, pass_index),
+                                    lambda: state)
+            previous_graphs, _, passes, _, output_globals, remainders, diagnostics = state
+
+        with tf.name_scope("read_out"):
+            output_global = self.output_dropout(output_globals, training=training)
+            logits = self.readout(output_global)
+            logits = tf.reshape(logits, [-1, num_choices])
+
+        outputs = {
+            'logits': logits,
+            'passes': passes,
+            'remainders': remainders
+        }
+        if debug:
+            outputs.update(diagnostics)
+            outputs.update({
+                'output_global': output_global,
+                'initial_global': initial_global,
+                'closest_nodes': tf.reshape(closest_nodes, [-1, num_choices, question_len]),
+                'mask': tf.reshape(padding_mask, [-1, num_choices, question_len]),
+                'encoded_question': tf.reshape(encoded_question, [-1, num_choices, question_len, depth])
+            })
+
+        return outputs
+
+
+def question_loss(features, outputs):
+    """The loss of every question: the cross entropy of its answer, plus the ponder cost of its choices with the
+    learned halting unit."""
+    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(tf.reshape(features["answer_id"], [-1]), outputs['logits'])
+    if FLAGS.halting == "learned":
+        # Penalize the computation of each of the choices of the question
+        ponder = tf.reduce_sum(tf.reshape(outputs['passes'] + outputs['remainders'], [-1, num_choices]), -1)
+        loss += FLAGS.ponder_cost * ponder
+    return loss
+
+
+def example_weights(features):
+    """Weights of the questions of a batch in the loss and the metrics: padding examples (see
+    file_based_input_fn_builder) are left out."""
+    if "is_real_example" in features:
+        return tf.cast(features["is_real_example"], tf.float32)
+    return tf.ones_like(tf.cast(tf.reshape(features["answer_id"], [-1]), tf.float32))
+
+
+def accumulate_gradients(features, loss_and_gradients, accumulation_steps=1):
+    """Splits a training batch into `accumulation_steps` micro-batches and sums their gradients.
+
+    `loss_and_gradients(micro_batch, total_weight)` returns the loss of a micro-batch, the sum of the weighted losses
+    of its questions divided by `total_weight` (the weight of the whole batch), its gradients and the outputs of the
+    network, so that the summed losses and gradients are those of the mean loss of the batch. Each micro-batch only
+    starts once the gradients of the previous one are computed, so that the activations of a single micro-batch are
+    held at a time. Every micro-batch draws its own dropout masks, which are per question like in the whole batch.
+
+    Returns the mean loss of the batch, the summed gradients and the outputs of the network for the whole batch.
+    """
+    batch_size = features["answer_id"].shape[0]
+    if batch_size is not None and batch_size % accumulation_steps:
+        raise ValueError("The batch size (%d) is not a multiple of accumulation_steps (%d)" % (
+            batch_size, accumulation_steps))
+
+    weights = example_weights(features)
+    total_weight = tf.maximum(tf.reduce_sum(weights), 1.0)
+    names = list(features.keys())
+    splits = zip(*[tf.split(features[name], accumulation_steps) for name in names])
+
+    mean_loss, gradients, outputs = 0.0, None, []
+    for values in splits:
+        micro_batch = dict(zip(names, values))
+        if gradients is not None:
+            with tf.control_dependencies([gradient for gradient in gradients if gradient is not None]):
+                micro_batch = {name: tf.identity(value) for name, value in micro_batch.items()}
+
+        loss, micro_gradients, micro_outputs = loss_and_gradients(micro_batch, total_weight)
+        mean_loss += loss
+        if gradients is None:
+            gradients = micro_gradients
+        else:
+            gradients = [gradient if micro_gradient is None else micro_gradient if gradient is None
+                         else gradient + micro_gradient
+                         for gradient, micro_gradient in zip(gradients, micro_gradients)]
+        outputs.append(micro_outputs)
+
+    outputs = {name: None if outputs[0][name] is None else tf.concat([output[name] for output in outputs], 0)
+               for name in outputs[0]}
+
+    return mean_loss, gradients, outputs
+
+
+def model_fn(features, labels, mode, params):
+    word_embedding = load_table("word_embedding", params['word_embedding'])
+    graph_nodes = load_table("graph_nodes", params['graph_nodes'])
+    depth = graph_nodes.shape[1]
+    training = mode == tf.estimator.ModeKeys.TRAIN
+    debug = FLAGS.debug_predictions and mode == tf.estimator.ModeKeys.PREDICT
+
+    # Marks the moment the features of this step left the input pipeline, see StepTimingHook. The features are
+    # routed through the timestamp so that no computation on them can start before it is taken.
+    with tf.control_dependencies(tf.nest.flatten(features)):
+        input_ready = tf.timestamp()
+    tf.compat.v1.add_to_collection(INPUT_READY_COLLECTION, input_ready)
+    with tf.control_dependencies([input_ready]):
+        features = {name: tf.identity(feature) for name, feature in features.items()}
+
+    network = QuestionGraphNetwork(word_embedding, graph_nodes, params['graph_edges'], recompute=FLAGS.recompute)
+    if training:
+        optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=FLAGS.learning_rate, beta2=0.98, epsilon=1e-9)
 
-    output_global = tf.keras.layers.Dropout(FLAGS.dropout)(previous_graphs.globals, training=training)
-    dense_layer = tf.keras.layers.Dense(1)
-    logits = dense_layer(output_global)
-    logits = tf.reshape(logits, [-1, num_choices])
+        def loss_and_gradients(micro_batch, total_weight):
+            outputs = network(micro_batch, training=True)
+            loss = tf.reduce_sum(question_loss(micro_batch, outputs) * example_weights(micro_batch)) / total_weight
+            variables = [variable for variable in network.variables if variable.trainable]
+            return loss, [gradient for gradient, _ in optimizer.compute_gradients(loss, variables)], outputs
 
-    def loss_function(real, pred):
-        return tf.nn.sparse_softmax_cross_entropy_with_logits(tf.reshape(real, [-1]), pred)
+        mean_loss, gradients, outputs = accumulate_gradients(features, loss_and_gradients,
+                                                             params.get('accumulation_steps', 1))
+    else:
+        outputs = network(features, training=False, debug=debug)
+    logits = outputs['logits']
+    passes = outputs['passes']
 
-    # Calculate the loss
-    loss = loss_function(features["answer_id"], logits)
+    # Calculate the loss (served questions come without an answer)
+    loss = None
+    if "answer_id" in features:
+        loss = question_loss(features, outputs)
 
+    # Only the scores are computed by default; the intermediate tensors are expensive (the encoded question alone
+    # is [batch, 4, question_len, depth]) and are only added for debugging.
     predictions = {
-        'original': features["input_ids"],
         'prediction': tf.argmax(logits, -1),
-        'correct': features["answer_id"],
-        'logits': logits,
-        'loss': loss,
-        'output_global': tf.reshape(output_global, [-1, 4, 300]),
-        'initial_global': tf.reshape(initial_global, [-1, 4, 300]),
-        'old_global': tf.reshape(old_global, [-1, 4, 300]),
-        'new_global': tf.reshape(new_global, [-1, 4, 300]),
-        'graph_sum0': graph_sum0,
-        'graph_sum1': graph_sum1,
-        'graph_sum2': graph_sum2,
-        'closest_nodes': tf.reshape(closest_nodes, [-1, 4, FLAGS.seq_len]),
-        'input_id': features["input_ids"],
-        'mask': tf.reshape(padding_mask, [-1, 4, FLAGS.seq_len]),
-        'encoded_question': tf.reshape(encoded_question, [-1, 4, FLAGS.seq_len, depth])
+        'logits': logits
     }
+    if "answer_id" in features:
+        predictions['correct'] = features["answer_id"]
+    if "is_real_example" in features:
+        predictions['is_real_example'] = features["is_real_example"]
+    if FLAGS.halting != "none":
+        predictions['passes'] = tf.reshape(passes, [-1, num_choices])
+
+    if debug:
+        predictions.update({
+            'original': features["input_ids"],
+            'output_global': tf.reshape(outputs['output_global'], [-1, 4, depth]),
+            'initial_global': tf.reshape(outputs['initial_global'], [-1, 4, depth]),
+            'old_global': tf.reshape(outputs['old_global'], [-1, 4, depth]),
+            'new_global': tf.reshape(outputs['new_global'], [-1, 4, depth]),
+            'graph_sum0': outputs['graph_sum0'],
+            'graph_sum1': outputs['graph_sum1'],
+            'graph_sum2': outputs['graph_sum2'],
+            'closest_nodes': outputs['closest_nodes'],
+            'input_id': features["input_ids"],
+            'mask': outputs['mask'],
+            'encoded_question': outputs['encoded_question']
+        })
+        if loss is not None:
+            predictions['loss'] = loss
 
     if mode == tf.estimator.ModeKeys.PREDICT:
         export_outputs = {
@@ -226,165 +772,340 @@ def model_fn(features, labels, mode, params):
         }
         return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions, export_outputs=export_outputs)
 
+    weights = example_weights(features)
+
     if mode == tf.estimator.ModeKeys.TRAIN:
         global_step = tf.compat.v1.train.get_or_create_global_step()
-
-        optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=FLAGS.learning_rate, beta2=0.98, epsilon=1e-9)
+        if FLAGS.halting != "none":
+            tf.compat.v1.summary.scalar("average_passes", tf.reduce_mean(passes))
 
         # Batch norm requires update ops to be added as a dependency to the train_op
         update_ops = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
-            train_op = optimizer.minimize(tf.reduce_mean(loss), global_step)
+            # A single update for all the micro-batches
+            variables = [variable for variable in network.variables if variable.trainable]
+            train_op = optimizer.apply_gradients(zip(gradients, variables), global_step)
     else:
+        mean_loss = tf.reduce_sum(loss * weights) / tf.maximum(tf.reduce_sum(weights), 1.0)
         train_op = None
 
+    eval_metric_ops = None
+    if mode == tf.estimator.ModeKeys.EVAL:
+        eval_metric_ops = {
+            'accuracy': tf.compat.v1.metrics.accuracy(tf.reshape(features["answer_id"], [-1]),
+                                                      predictions['prediction'], weights=weights),
+            'mean_loss': tf.compat.v1.metrics.mean(loss, weights=weights)
+        }
+        if FLAGS.halting != "none":
+            eval_metric_ops['average_passes'] = tf.compat.v1.metrics.mean(
+                predictions['passes'], weights=tf.tile(weights[:, None], [1, num_choices]))
+
     return tf.estimator.EstimatorSpec(
         mode=mode,
         predictions=predictions,
-        loss=tf.reduce_mean(loss),
-        train_op=train_op)
+        loss=mean_loss,
+        train_op=train_op,
+        eval_metric_ops=eval_metric_ops)
 
-def file_based_input_fn_builder(input_file, sequence_length, batch_size, is_training, drop_remainder):
+def file_based_input_fn_builder(input_file, sequence_length, batch_size, is_training, drop_remainder,
+                                stem_length=None, choice_length=None):
 
     name_to_features = {
         "input_ids": tf.io.FixedLenFeature([4, sequence_length], tf.int64),
         "answer_id": tf.io.FixedLenFeature([1], tf.int64)
     }
+    if stem_length and choice_length:
+        name_to_features["stem_ids"] = tf.io.FixedLenFeature([stem_length], tf.int64)
+        name_to_features["choice_ids"] = tf.io.FixedLenFeature([4, choice_length], tf.int64)
 
-    def _decode_record(record, name_to_features):
-        """Decodes a record to a TensorFlow example."""
-        example = tf.io.parse_single_example(record, name_to_features)
+    def _decode_record(records, name_to_features):
+        """Decodes a batch of records to a TensorFlow example."""
+        example = tf.io.parse_example(records, name_to_features)
 
         # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
         # So cast all int64 to int32.
         for name in list(example.keys()):
             t = example[name]
-        if t.dtype == tf.int64:
-            t = tf.cast(t, tf.int32)
+            if t.dtype == tf.int64:
+                t = tf.cast(t, tf.int32)
+            example[name] = t
+
+        example["is_real_example"] = tf.ones_like(example["answer_id"][:, 0])
+
+        return example
+
+    def _pad_batch(example):
+        """Pads a partial (final) batch to batch_size with examples marked by is_real_example = 0."""
+        padding = batch_size - tf.shape(example["is_real_example"])[0]
+        for name in list(example.keys()):
+            t = example[name]
+            t = tf.pad(t, [[0, padding]] + [[0, 0]] * (len(t.shape) - 1))
+            t.set_shape([batch_size] + t.shape.as_list()[1:])
             example[name] = t
 
         return example
 
-    def input_fn(params):
+    def input_fn(params, input_context=None):
         """The actual input function."""
+        input_files = tf.io.gfile.glob(os.path.join(FLAGS.question_dir, input_file + "*.tfrecords"))
+        if not input_files:
+            raise ValueError("No question records found for " + input_file + " in " + FLAGS.question_dir)
+
+        # With several workers each one reads its own shard of the questions: whole files when there are enough of
+        # them, every n-th question otherwise.
+        num_shards, shard = 1, 0
+        if input_context:
+            num_shards, shard = input_context.num_input_pipelines, input_context.input_pipeline_id
+        shard_files = len(input_files) >= num_shards
 
         # For training, we want a lot of parallel reading and shuffling.
         # For eval, we want no shuffling and parallel reading doesn't matter.
-        d = tf.data.TFRecordDataset("question_data/" + input_file + ".tfrecords")
+        d = tf.data.Dataset.from_tensor_slices(input_files)
+        if shard_files:
+            d = d.shard(num_shards, shard)
         if is_training:
-            d = d.shuffle(buffer_size=1024)
+            d = d.shuffle(buffer_size=len(input_files))
+        d = d.interleave(tf.data.TFRecordDataset, cycle_length=min(FLAGS.num_readers, len(input_files)),
+                         num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if not shard_files:
+            d = d.shard(num_shards, shard)
+
+        # The serialized records of the question splits are small enough to be kept in memory after the first epoch.
+        if FLAGS.cache_input:
+            d = d.cache()
+
+        if is_training:
+            d = d.shuffle(buffer_size=FLAGS.shuffle_buffer)
             d = d.repeat()
 
-        d = d.map(lambda record: _decode_record(record, name_to_features)).batch(batch_size=batch_size,
-                                                                                 drop_remainder=drop_remainder)
+        # Batch the serialized records first so that a whole batch is decoded by a single parse_example call.
+        d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        d = d.map(lambda records: _decode_record(records, name_to_features),
+                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        # Instead of being dropped, the last batch is padded so that every batch has the same size.
+        if not drop_remainder:
+            d = d.map(_pad_batch)
+        d = d.prefetch(tf.data.experimental.AUTOTUNE)
 
         return d
 
     return input_fn
 
 
+def serving_input_receiver_fn():
+    """Receives batches of already tokenized questions, see gnn_server.QuestionTokenizer."""
+    features = {"input_ids": tf.compat.v1.placeholder(tf.int32, [None, num_choices, FLAGS.seq_len], "input_ids")}
+    if FLAGS.split_stem:
+        features["stem_ids"] = tf.compat.v1.placeholder(tf.int32, [None, FLAGS.stem_len], "stem_ids")
+        features["choice_ids"] = tf.compat.v1.placeholder(tf.int32, [None, num_choices, FLAGS.choice_len],
+                                                          "choice_ids")
+
+    return tf.estimator.export.ServingInputReceiver(features, features)
+
+
+def prepare_data():
+    """Prepares the question data and the knowledge graph if needed.
+
+    Returns the params of the model, in which the embedding and the graph nodes are passed as files (see load_table),
+    and the decoder, the list of words of the question vocabulary. A training step is split into the number of
+    micro-batches of params['accumulation_steps'], which the caller adds (see memory_planner.plan), or none.
+    """
+    word_embedding_path = os.path.join(FLAGS.question_dir, "word_embedding.npy")
+    graph_nodes_path = os.path.join(FLAGS.question_dir, "graph_nodes.npy")
+
+    if not os.path.exists(FLAGS.question_dir):
+        word_embedding, decoder = text_processor.openbook_question_processor("data/glove.6B.300d.txt",
+                                                                            FLAGS.question_dir, FLAGS.seq_len,
+                                                                            FLAGS.stem_len, FLAGS.choice_len)
+        np.save(word_embedding_path, word_embedding.astype(np.float32))
+        np.save(os.path.join(FLAGS.question_dir, "decoder"), np.array(decoder))
+    else:
+        decoder = list(np.load(os.path.join(FLAGS.question_dir, "decoder.npy")))
+    # Written again at every start, so that the nodes are always those of the clustering GraphEdges.npy is built on
+    cluster_estimator = tf.compat.v1.estimator.experimental.KMeans(model_dir="knowledge_graph", num_clusters=512)
+    np.save(graph_nodes_path, cluster_estimator.cluster_centers().astype(np.float32))
+    graph_edges = np.load("GraphEdges.npy")
+
+    params = {'word_embedding': word_embedding_path,
+              'graph_nodes': graph_nodes_path,
+              'graph_edges': graph_edges}
+
+    return params, decoder
+
+
+def bfloat16_session_config():
+    """A session configuration with which grappler rewrites the float32 graph to compute in bfloat16 wherever oneDNN
+    has a bfloat16 kernel, and casts back where it does not."""
+    config = tf.compat.v1.ConfigProto()
+    config.graph_options.rewrite_options.auto_mixed_precision_onednn_bfloat16 = rewriter_config_pb2.RewriterConfig.ON
+    return config
+
+
+def session_config():
+    """The session configuration of the bfloat16 flag."""
+    return bfloat16_session_config() if FLAGS.bfloat16 else None
+
+
+def build_run_config():
+    """The run configuration of the distribution strategy chosen by the distribution flag.
+
+    The workers of multi_worker and parameter_server are given by the TF_CONFIG environment variable; each of them
+    runs this script and reads its own shard of the training questions (see file_based_input_fn_builder).
+    """
+    if FLAGS.distribution == "mirrored":
+        mirrored_strategy = tf.distribute.MirroredStrategy()
+        return tf.estimator.RunConfig(train_distribute=mirrored_strategy, eval_distribute=mirrored_strategy,
+                                      session_config=session_config())
+
+    if FLAGS.distribution == "multi_worker":
+        strategy = tf.compat.v1.distribute.experimental.MultiWorkerMirroredStrategy()
+    else:
+        strategy = tf.compat.v1.distribute.experimental.ParameterServerStrategy()
+    # The evaluation runs on the chief alone once training is done, see main
+    return tf.estimator.RunConfig(train_distribute=strategy, session_config=session_config())
+
+
+def is_chief():
+    """Whether this process is the chief of the cluster in TF_CONFIG: the chief task, or the first worker if there is
+    none. Without a cluster the process is its own chief."""
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {})
+    if not task:
+        return True
+    if "chief" in tf_config.get("cluster", {}):
+        return task["type"] == "chief"
+    return task["type"] == "worker" and task["index"] == 0
+
+
+def build_estimator(config=None):
+    """Prepares the question data and the knowledge graph if needed and builds the GNN estimator.
+
+    Returns the estimator and the decoder, the list of words of the question vocabulary.
+    """
+    params, decoder = prepare_data()
+    gnn_estimator = tf.estimator.Estimator(model_fn=model_fn, model_dir=FLAGS.model_dir, params=params, config=config)
+
+    return gnn_estimator, decoder
+
+
 def main(argv=None):
     flags = tf.compat.v1.flags.FLAGS.flag_values_dict()
     for i, key in enumerate(flags.keys()):
         if i > 18:
             print(key + ": " + str(flags[key]))
 
-    mirrored_strategy = tf.distribute.MirroredStrategy()
-    config = tf.estimator.RunConfig(
-        train_distribute=mirrored_strategy, eval_distribute=mirrored_strategy)
+    # The batch is planned before the estimator is built, which takes the number of micro-batches in its params
+    params, decoder = prepare_data()
+    batch_size, params['accumulation_steps'] = memory_planner.plan(params, num_choices, FLAGS.batch_size,
+                                                                   FLAGS.accumulation_steps)
+    gnn_estimator = tf.estimator.Estimator(model_fn=model_fn, model_dir=FLAGS.model_dir, params=params,
+                                           config=build_run_config())
 
-    if not os.path.exists("question_data"):
-        word_embedding, decoder = text_processor.openbook_question_processor("data/glove.6B.300d.txt", "question_data", FLAGS.seq_len)
-        np.save("question_data/word_embedding", word_embedding)
-        np.save("question_data/decoder", np.array(decoder))
-    else:
-        word_embedding = np.load("question_data/word_embedding.npy")
-        decoder = list(np.load("question_data/decoder.npy"))
-    cluster_estimator = tf.compat.v1.estimator.experimental.KMeans(model_dir="knowledge_graph", num_clusters=512)
-    graph_clusters = cluster_estimator.cluster_centers()
-    graph_edges = np.load("GraphEdges.npy")
-
-    gnn_estimator = tf.estimator.Estimator(model_fn=model_fn, model_dir=FLAGS.model_dir,
-                                       params={'word_embedding': word_embedding,
-                                               'graph_nodes': graph_clusters,
-                                               'graph_edges': graph_edges}, config=config)
+    stem_length, choice_length = (FLAGS.stem_len, FLAGS.choice_len) if FLAGS.split_stem else (None, None)
 
     train_input_fn = file_based_input_fn_builder(
         input_file="training_questions",
         sequence_length=FLAGS.seq_len,
-        batch_size=FLAGS.batch_size,
+        batch_size=batch_size,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        stem_length=stem_length,
+        choice_length=choice_length)
 
     eval_input_fn = file_based_input_fn_builder(
         input_file="validating_questions",
         sequence_length=FLAGS.seq_len,
-        batch_size=16,
+        batch_size=FLAGS.eval_batch_size,
         is_training=False,
-        drop_remainder=True)
+        drop_remainder=False,
+        stem_length=stem_length,
+        choice_length=choice_length)
 
     test_input_fn = file_based_input_fn_builder(
         input_file="testing_questions",
         sequence_length=FLAGS.seq_len,
-        batch_size=1,
+        batch_size=FLAGS.eval_batch_size,
         is_training=False,
-        drop_remainder=True)
+        drop_remainder=False,
+        stem_length=stem_length,
+        choice_length=choice_length)
 
     if FLAGS.train:
         print("***************************************")
         print("Training")
         print("***************************************")
 
+        hooks = []
+        if FLAGS.timing_steps > 0 or FLAGS.step_stats_file:
+            hooks.append(StepTimingHook(batch_size, FLAGS.timing_steps,
+                                        FLAGS.step_stats_file if is_chief() else None))
+        if FLAGS.profile_dir and is_chief():
+            hooks.append(ProfilerTraceHook(FLAGS.profile_dir, FLAGS.profile_start_step, FLAGS.profile_steps))
+
         trainspec = tf.estimator.TrainSpec(
             input_fn=train_input_fn,
-            max_steps=FLAGS.train_steps)
+            max_steps=FLAGS.train_steps,
+            hooks=hooks)
 
         evalspec = tf.estimator.EvalSpec(
             input_fn=eval_input_fn)
 
         tf.estimator.train_and_evaluate(gnn_estimator, trainspec, evalspec)
 
-    if FLAGS.predict:
+    if FLAGS.predict and is_chief():
         print("***************************************")
-        print("Predicting")
+        print("Evaluating")
         print("***************************************")
 
+        metrics = gnn_estimator.evaluate(input_fn=eval_input_fn)
+        print("Accuracy: " + str(metrics['accuracy']) + "     loss: " + str(metrics['mean_loss']))
+        if FLAGS.halting != "none":
+            print("Average passes: " + str(metrics['average_passes']))
+
+        predict_keys = ['prediction', 'correct', 'logits', 'is_real_example']
+        if FLAGS.halting != "none":
+            predict_keys += ['passes']
+        if FLAGS.debug_predictions:
+            predict_keys += ['original', 'loss', 'output_global', 'initial_global', 'new_global', 'old_global',
+                             'graph_sum0', 'graph_sum1', 'graph_sum2', 'closest_nodes', 'mask', 'input_id',
+                             'encoded_question']
+
         results = gnn_estimator.predict(
             input_fn=eval_input_fn,
-            predict_keys=['original', 'prediction', 'correct', 'logits', 'loss',
-                          'output_global', 'initial_global', 'new_global', 'old_global', 'graph_sum0', 'graph_sum1', 'graph_sum2',
-                          'closest_nodes', 'mask', 'input_id', 'encoded_question'])
-        total = 0
-        correct = 0
-
-        for i, result in enumerate(results):
-            predicted_choice = result['prediction']
-            correct_choice = result['correct']
-            if i + 1 < FLAGS.predict_samples:
-                print("------------------------------------")
-                input_question = result['original']
-                for choice in input_question:
-                    print([decoder[word] for word in choice if word != 1])
-
-                print("predicted_choice: " + str(predicted_choice))
-                print("correct_choice: " + str(correct_choice[0]))
-            total += 1
-            if correct_choice[0] == predicted_choice:
-                correct += 1
-            print("Logits: " + str(result['logits']) + "     loss: " + str(result['loss']))
-            # print("output_global: " + str(np.mean(result['output_global'], -1)))
-            # print("initial_global: " + str(result['initial_global']))
-            # print("new_global: " + str(result['new_global']))
-            # print("old_global: " + str(result['old_global']))
-            # print("graph_sum0: " + str(result['graph_sum0']))
-            # print("graph_sum1: " + str(result['graph_sum1']))
-            # print("graph_sum2: " + str(result['graph_sum2']))
-            print("closest_nodes: " + str(result['closest_nodes']))
-            # print("mask: " + str(result['mask']))
-            # print("input_id: " + str(result['input_id']))
-            # print("encoded_question: " + str(np.sum(np.abs(result['encoded_question']), -1)))
-
-        print("Accuracy: " + str(correct / total))
+            predict_keys=predict_keys,
+            yield_single_examples=False)
+        columns = {name: [] for name in ['prediction', 'correct', 'logits', 'passes'] if name in predict_keys}
+        printed = 0
+
+        for batch in results:
+            real_examples = batch['is_real_example'] == 1
+            for name in columns:
+                columns[name].append(batch[name][real_examples])
+
+            if FLAGS.debug_predictions:
+                for i in np.nonzero(real_examples)[0]:
+                    if printed + 1 >= FLAGS.predict_samples:
+                        break
+                    printed += 1
+                    print("------------------------------------")
+                    for choice in batch['original'][i]:
+                        print([decoder[word] for word in choice if word != 1])
+
+                    print("predicted_choice: " + str(batch['prediction'][i]))
+                    print("correct_choice: " + str(batch['correct'][i][0]))
+                    print("Logits: " + str(batch['logits'][i]) + "     loss: " + str(batch['loss'][i]))
+                    # print("output_global: " + str(np.mean(batch['output_global'][i], -1)))
+                    # print("graph_sum0: " + str(batch['graph_sum0'][i]))
+                    # print("graph_sum1: " + str(batch['graph_sum1'][i]))
+                    # print("graph_sum2: " + str(batch['graph_sum2'][i]))
+                    print("closest_nodes: " + str(batch['closest_nodes'][i]))
+
+        # One array per column, one row per question of the evaluation split
+        results_file = FLAGS.results_file or os.path.join(FLAGS.model_dir, "predictions.npz")
+        columns = {name: np.concatenate(column) for name, column in columns.items()}
+        columns['correct'] = columns['correct'][:, 0]
+        np.savez(results_file, **columns)
+        print("Predictions written to " + results_file)
 
 def find_similarities(similarity, query_sentence, compare_sentence, tokenizer):
     fig = plt.figure(figsize=(16, 8))
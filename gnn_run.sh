@@ -23,14 +23,38 @@ python3 gnn_estimator.py \
   --data_dir=data/ \
   --graph_dir=knowledge_graph/ \
   --model_dir=gnn_model/ \
+  --question_dir=question_data \
+  --num_readers=4 \
+  --shuffle_buffer=10000 \
+  --cache_input=True \
+  --timing_steps=100 \
+  --step_stats_file="" \
+  --profile_dir="" \
+  --profile_start_step=10 \
+  --profile_steps=5 \
+  --distribution=mirrored \
   --train_steps=50000 \
   --dropout=0.5 \
   --seq_len=80 \
+  --split_stem=False \
+  --stem_len=64 \
+  --choice_len=16 \
   --recurrences=5 \
+  --halting=none \
+  --halt_threshold=1e-3 \
+  --ponder_cost=1e-3 \
+  --recompute=False \
+  --encoder_chunk=16 \
+  --accumulation_steps=1 \
+  --bfloat16=False \
+  --memory_budget_mb=0 \
+  --auto_batch_size=none \
   --batch_size=32 \
+  --eval_batch_size=256 \
   --learning_rate=1e-5 \
   --train=True \
   --predict=True \
+  --debug_predictions=False \
   --predict_samples=10 \
   --description="Put experiment description here" \
 
@@ -0,0 +1,307 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request
+from urllib.error import URLError
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import gnn_estimator
+import text_processor
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_string("export_dir", default="gnn_export/",
+      help="directory of the exported scoring models")
+flags.DEFINE_bool("export", default=False,
+      help="whether to export the latest checkpoint of model_dir before serving")
+flags.DEFINE_bool("quantize", default=False,
+      help="whether to serve the int8 TensorFlow Lite conversion of the export instead of the export itself")
+flags.DEFINE_integer("port", default=8500,
+      help="port of the scoring service")
+flags.DEFINE_integer("max_batch_size", default=64,
+      help="maximum number of questions scored together")
+flags.DEFINE_float("batch_timeout_ms", default=5.0,
+      help="how long the first question of a batch waits for more questions")
+flags.DEFINE_bool("load_test", default=False,
+      help="whether to run the load generator against the service and exit")
+flags.DEFINE_integer("load_clients", default=16,
+      help="number of concurrent clients of the load generator")
+flags.DEFINE_integer("load_requests", default=2000,
+      help="total number of requests sent by the load generator")
+
+FLAGS = flags.FLAGS
+
+
+class QuestionScorer(object):
+    """Scores batches of tokenized questions with the latest SavedModel exported to `export_dir`, in a session
+    configured by `config` (see gnn_estimator.session_config)."""
+
+    def __init__(self, export_dir, config=None):
+        versions = [version for version in tf.io.gfile.listdir(export_dir) if version.strip("/").isdigit()]
+        if not versions:
+            raise ValueError("No exported model found in " + export_dir)
+        model_path = os.path.join(export_dir, max(versions, key=lambda version: int(version.strip("/"))))
+        print("Loading " + model_path)
+        self.model_path = model_path
+
+        self._graph = tf.Graph()
+        self._session = tf.compat.v1.Session(graph=self._graph, config=config)
+        with self._graph.as_default():
+            meta_graph = tf.compat.v1.saved_model.loader.load(
+                self._session, [tf.saved_model.SERVING], model_path)
+        signature = meta_graph.signature_def[gnn_estimator.SIGNATURE_NAME]
+        self._inputs = {name: tensor.name for name, tensor in signature.inputs.items()}
+        self._outputs = {name: tensor.name for name, tensor in signature.outputs.items()}
+
+    def score(self, features):
+        feed_dict = {self._inputs[name]: features[name] for name in self._inputs}
+        return self._session.run(self._outputs, feed_dict)
+
+    def to_tflite(self, quantize):
+        """Converts the signature of the model, its variables and tables frozen, to a TensorFlow Lite flatbuffer.
+
+        With `quantize`, the weights and the tables are stored in int8 and the fully connected layers run on int8
+        weights, their inputs quantized on the fly (dynamic range quantization). The loops of the LSTM and of the
+        halting are kept as TensorFlow ops, which the interpreter of the TensorFlow package runs.
+        """
+        with self._graph.as_default():
+            converter = tf.compat.v1.lite.TFLiteConverter.from_session(
+                self._session, [self._graph.get_tensor_by_name(name) for name in self._inputs.values()],
+                [self._graph.get_tensor_by_name(name) for name in self._outputs.values()])
+        if quantize:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+        return converter.convert(), self._inputs, self._outputs
+
+
+class TFLiteScorer(object):
+    """Scores batches like a QuestionScorer with its TensorFlow Lite conversion (see QuestionScorer.to_tflite)."""
+
+    def __init__(self, model_content, inputs, outputs):
+        self.model_content = model_content
+        self._interpreter = tf.lite.Interpreter(model_content=model_content)
+        # The tensors of the interpreter keep the names of the graph tensors, without the output index
+        details = {detail['name']: detail['index'] for detail in
+                   self._interpreter.get_input_details() + self._interpreter.get_output_details()}
+        self._inputs = {name: details[tensor.split(":")[0]] for name, tensor in inputs.items()}
+        self._outputs = {name: details[tensor.split(":")[0]] for name, tensor in outputs.items()}
+        self._batch_size = None
+
+    def score(self, features):
+        batch_size = len(next(iter(features.values())))
+        if batch_size != self._batch_size:
+            for name, index in self._inputs.items():
+                self._interpreter.resize_tensor_input(index, features[name].shape)
+            self._interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+        for name, index in self._inputs.items():
+            self._interpreter.set_tensor(index, features[name].astype(np.int32))
+        self._interpreter.invoke()
+        return {name: self._interpreter.get_tensor(index) for name, index in self._outputs.items()}
+
+
+class DynamicBatcher(object):
+    """Groups concurrent requests into batches.
+
+    A batch is run as soon as it holds `max_batch_size` requests or `timeout` seconds after its first request
+    arrived, whichever comes first, so no request waits more than `timeout` for others. When a batch fails, its
+    requests are rerun one by one, so that the error only reaches the requests that caused it.
+    """
+
+    def __init__(self, run_batch, max_batch_size, timeout):
+        self._run_batch = run_batch
+        self._max_batch_size = max_batch_size
+        self._timeout = timeout
+        self._requests = queue.Queue()
+
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, features):
+        """Queues the features of one example, returns a future of its outputs."""
+        future = futures.Future()
+        self._requests.put((features, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.time() + self._timeout
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._run(batch)
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                    continue
+                # A bad request must not fail the others of its batch: each is run on its own, so that only those
+                # that fail get the error
+                for request in batch:
+                    try:
+                        self._run([request])
+                    except Exception as request_error:
+                        request[1].set_exception(request_error)
+
+    def _run(self, batch):
+        features = {name: np.stack([example[name] for example, _ in batch]) for name in batch[0][0]}
+        outputs = self._run_batch(features)
+        for i, (_, future) in enumerate(batch):
+            future.set_result({name: output[i] for name, output in outputs.items()})
+
+
+def make_handler(vocabulary, batcher):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        """POST /score with {"question": ..., "choices": [...]} returns the predicted choice and the logits, or
+        {"error": ...} with status 400 for a bad request and 500 when the model fails."""
+
+        def do_POST(self):
+            if self.path != "/score":
+                self.send_json(404, {"error": "unknown path " + self.path})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if not isinstance(body["question"], str):
+                    raise TypeError("the question must be a string")
+                if not isinstance(body["choices"], list) or not all(isinstance(c, str) for c in body["choices"]):
+                    raise TypeError("the choices must be a list of strings")
+                if len(body["choices"]) != gnn_estimator.num_choices:
+                    raise ValueError("expected " + str(gnn_estimator.num_choices) + " choices")
+                features = text_processor.tokenize_question(body["question"], body["choices"], vocabulary,
+                                                            FLAGS.seq_len, FLAGS.stem_len, FLAGS.choice_len)
+            except (KeyError, TypeError, ValueError) as error:
+                self.send_json(400, {"error": str(error)})
+                return
+
+            try:
+                outputs = batcher.submit(features).result()
+            except (ValueError, tf.errors.InvalidArgumentError) as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            except Exception as error:
+                self.send_json(500, {"error": str(error)})
+                return
+
+            self.send_json(200, {"prediction": int(outputs["prediction"]),
+                                 "logits": [float(logit) for logit in outputs["logits"]]})
+
+        def send_json(self, status, body):
+            response = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def load_questions(decoder):
+    """Questions to send during the load test: the validation questions if available, random words otherwise."""
+    if os.path.exists("data/dev.jsonl"):
+        data = pd.read_json("data/dev.jsonl", lines=True)
+        return [(question['stem'], [choice['text'] for choice in question['choices']])
+                for question in data['question']]
+
+    words = decoder[2:]
+    return [(" ".join(np.random.choice(words, 12)),
+             [" ".join(np.random.choice(words, 3)) for _ in range(gnn_estimator.num_choices)])
+            for _ in range(100)]
+
+
+def run_load_test(url, questions, num_clients, num_requests):
+    """Sends `num_requests` questions from `num_clients` concurrent clients and reports latency and throughput, over
+    the requests that succeeded, and the number of those that failed."""
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def client(client_index):
+        for i in range(client_index, num_requests, num_clients):
+            question, choices = questions[i % len(questions)]
+            body = json.dumps({"question": question, "choices": choices}).encode()
+            start = time.time()
+            try:
+                request.urlopen(request.Request(url, body, {"Content-Type": "application/json"})).read()
+            except (URLError, ConnectionError, socket.timeout):
+                with lock:
+                    failures[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duration = time.time() - start
+
+    latencies = np.array(latencies) * 1000
+    print("Requests: %d, clients: %d" % (len(latencies), num_clients))
+    if len(latencies):
+        print("Latency p50: %.1f ms, p99: %.1f ms, failed requests: %d" % (np.percentile(latencies, 50),
+                                                                            np.percentile(latencies, 99), failures[0]))
+    else:
+        print("Latency: no request succeeded, failed requests: %d" % failures[0])
+    print("Throughput: %.1f questions/sec" % (len(latencies) / duration))
+
+
+def main(argv=None):
+    if FLAGS.export:
+        estimator, _ = gnn_estimator.build_estimator()
+        estimator.export_saved_model(FLAGS.export_dir, gnn_estimator.serving_input_receiver_fn)
+
+    decoder = list(np.load(os.path.join(FLAGS.question_dir, "decoder.npy")))
+    vocabulary = {}
+    for index, word in enumerate(decoder):
+        vocabulary.setdefault(word, index)
+
+    scorer = QuestionScorer(FLAGS.export_dir, gnn_estimator.session_config())
+    if FLAGS.quantize:
+        scorer = TFLiteScorer(*scorer.to_tflite(quantize=True))
+    batcher = DynamicBatcher(scorer.score, FLAGS.max_batch_size, FLAGS.batch_timeout_ms / 1000)
+    server = ThreadingHTTPServer(("", FLAGS.port), make_handler(vocabulary, batcher))
+
+    if not FLAGS.load_test:
+        print("Serving on port " + str(FLAGS.port))
+        server.serve_forever()
+        return
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    run_load_test("http://localhost:%d/score" % FLAGS.port, load_questions(decoder), FLAGS.load_clients,
+                  FLAGS.load_requests)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
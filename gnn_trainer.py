@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import tensorflow as tf
+
+import gnn_estimator
+import memory_planner
+import profiling
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_bool("jit_compile", default=True,
+      help="whether to compile the training and evaluation steps with XLA")
+flags.DEFINE_integer("save_steps", default=1000,
+      help="number of training steps between checkpoints")
+
+FLAGS = flags.FLAGS
+
+
+class AdamOptimizer(object):
+    """The update of tf.compat.v1.train.AdamOptimizer, with its slots and accumulators named like the ones it creates.
+
+    The slots of a variable are saved as <variable>/Adam and <variable>/Adam_1 and the accumulators as beta1_power
+    and beta2_power, so that training can continue from the checkpoints of the estimator and the other way around.
+    """
+
+    def __init__(self, variables, learning_rate, beta1=0.9, beta2=0.98, epsilon=1e-9):
+        self._learning_rate = learning_rate
+        self._beta1 = beta1
+        self._beta2 = beta2
+        self._epsilon = epsilon
+        self._slots = [(tf.Variable(tf.zeros_like(variable), trainable=False),
+                        tf.Variable(tf.zeros_like(variable), trainable=False)) for variable in variables]
+        self.beta1_power = tf.Variable(beta1, trainable=False)
+        self.beta2_power = tf.Variable(beta2, trainable=False)
+
+    def apply_gradients(self, grads_and_vars):
+        for (gradient, variable), (m, v) in zip(grads_and_vars, self._slots):
+            tf.raw_ops.ResourceApplyAdam(var=variable.handle, m=m.handle, v=v.handle, beta1_power=self.beta1_power,
+                                         beta2_power=self.beta2_power, lr=self._learning_rate, beta1=self._beta1,
+                                         beta2=self._beta2, epsilon=self._epsilon, grad=gradient)
+        self.beta1_power.assign(self.beta1_power * self._beta1)
+        self.beta2_power.assign(self.beta2_power * self._beta2)
+
+    def named_variables(self, variables):
+        """The slots of `variables` and the accumulators, by their names in the checkpoints."""
+        named = {"beta1_power": self.beta1_power, "beta2_power": self.beta2_power}
+        for variable, (m, v) in zip(variables, self._slots):
+            named[variable_name(variable) + "/Adam"] = m
+            named[variable_name(variable) + "/Adam_1"] = v
+        return named
+
+
+def variable_name(variable):
+    return variable.name.split(":")[0]
+
+
+class GraphNetworkTrainer(object):
+    """Trains the network of gnn_estimator in a tf.function instead of an estimator.
+
+    The training step (forward pass, gradients and update) is a single function, which can be compiled with XLA. The
+    checkpoints are written to model_dir under the names the estimator uses, so that either can resume, evaluate or
+    export the training of the other. Each training step is split into `accumulation_steps` micro-batches, see
+    gnn_estimator.accumulate_gradients.
+    """
+
+    def __init__(self, params, accumulation_steps=1):
+        # The eager counterpart of gnn_estimator.session_config; XLA-compiled steps are left as they are.
+        tf.config.optimizer.set_experimental_options({"auto_mixed_precision_onednn_bfloat16": FLAGS.bfloat16})
+        word_embedding = gnn_estimator.load_table("word_embedding", params['word_embedding'])
+        graph_nodes = gnn_estimator.load_table("graph_nodes", params['graph_nodes'])
+        self.network = gnn_estimator.QuestionGraphNetwork(word_embedding, graph_nodes, params['graph_edges'],
+                                                          recompute=FLAGS.recompute,
+                                                          compact_halting=not FLAGS.jit_compile)
+        self.accumulation_steps = accumulation_steps
+        self.global_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.variables = None
+        self.optimizer = None
+        self.named_variables = None
+        self.saver = None
+
+        self._train_step = tf.function(self._train_step_fn, jit_compile=FLAGS.jit_compile)
+        self._eval_step = tf.function(self._eval_step_fn, jit_compile=FLAGS.jit_compile)
+
+    def build(self, features):
+        """Creates the variables of the network, the optimizer and the checkpoint saver for batches like `features`."""
+        # The variables are created by a first, uncompiled pass; XLA cannot initialize them.
+        tf.function(self.network)(features)
+        self.variables = [variable for variable in self.network.variables if variable.trainable]
+        self.optimizer = AdamOptimizer(self.variables, FLAGS.learning_rate)
+
+        # The variables under their names in the checkpoints
+        self.named_variables = {variable_name(variable): variable for variable in self.network.variables}
+        self.named_variables.update(self.optimizer.named_variables(self.variables))
+        self.named_variables["global_step"] = self.global_step
+        self.saver = tf.compat.v1.train.Saver(var_list=self.named_variables, max_to_keep=5)
+
+    def restore(self):
+        """Restores the latest checkpoint of model_dir, if there is one."""
+        checkpoint = tf.train.latest_checkpoint(FLAGS.model_dir)
+        if checkpoint:
+            print("Restoring " + checkpoint)
+            self.saver.restore(None, checkpoint)
+
+    def save(self):
+        self.saver.save(None, os.path.join(FLAGS.model_dir, "model.ckpt"), global_step=int(self.global_step.numpy()))
+
+    def train_step(self, features):
+        """Runs one training step on the batch `features` (the network must be built), returns its loss."""
+        return self._train_step(features)
+
+    def _train_step_fn(self, features):
+        def loss_and_gradients(micro_batch, total_weight):
+            with tf.GradientTape() as tape:
+                outputs = self.network(micro_batch, training=True)
+                loss = gnn_estimator.question_loss(micro_batch, outputs)
+                loss = tf.reduce_sum(loss * gnn_estimator.example_weights(micro_batch)) / total_weight
+            return loss, tape.gradient(loss, self.variables), outputs
+
+        mean_loss, gradients, _ = gnn_estimator.accumulate_gradients(features, loss_and_gradients,
+                                                                self.accumulation_steps)
+        self.optimizer.apply_gradients(zip(gradients, self.variables))
+        self.global_step.assign_add(1)
+
+        return mean_loss
+
+    def _eval_step_fn(self, features):
+        outputs = self.network(features)
+        weights = gnn_estimator.example_weights(features)
+        correct = tf.cast(tf.equal(tf.argmax(outputs['logits'], -1, output_type=tf.int32),
+                                   tf.reshape(features["answer_id"], [-1])), tf.float32)
+        loss = gnn_estimator.question_loss(features, outputs)
+
+        return tf.reduce_sum(correct * weights), tf.reduce_sum(loss * weights), tf.reduce_sum(weights)
+
+    def train(self, dataset, steps):
+        """Trains until global_step reaches `steps`, reporting the loss and the speed every timing_steps steps. The
+        stats of the steps and a profiler trace are written as step_stats_file and profile_dir ask."""
+        iterator = iter(dataset)
+        if self.variables is None:
+            self.build(next(iterator))
+            self.restore()
+
+        monitor = profiling.step_monitor()
+        start = time.time()
+        step = int(self.global_step.numpy())
+        first_step = True
+        while step < steps:
+            monitor.begin_step()
+            features = next(iterator)
+            input_ready = time.time()
+            loss = self.train_step(features)
+            monitor.end_step(features["answer_id"].shape[0], input_ready)
+            step += 1
+            if first_step:
+                # The first step traces (and compiles) the training step, which is left out of the speed.
+                print("First step (trace and compile): %.1f s" % (time.time() - start))
+                first_step, start, start_step = False, time.time(), step
+            elif FLAGS.timing_steps > 0 and (step - start_step) % FLAGS.timing_steps == 0:
+                duration = time.time() - start
+                batch_size = features["answer_id"].shape[0]
+                print("Step %d: loss %.4f, %.2f steps/sec, %.1f examples/sec" % (
+                    step, loss, FLAGS.timing_steps / duration, FLAGS.timing_steps * batch_size / duration))
+                start = time.time()
+            if step % FLAGS.save_steps == 0:
+                self.save()
+
+        monitor.close()
+        self.save()
+
+    def evaluate(self, dataset):
+        """Returns the accuracy and the mean loss of the questions of `dataset`, leaving out padding examples. Both are
+        NaN when `dataset` has no question."""
+        correct, loss, count = 0.0, 0.0, 0.0
+        for features in dataset:
+            if self.variables is None:
+                self.build(features)
+                self.restore()
+            batch_correct, batch_loss, batch_count = self._eval_step(features)
+            correct, loss, count = correct + batch_correct, loss + batch_loss, count + batch_count
+
+        if count == 0:
+            return {'accuracy': float('nan'), 'mean_loss': float('nan')}
+        return {'accuracy': float(correct / count), 'mean_loss': float(loss / count)}
+
+
+def main(argv=None):
+    params, _ = gnn_estimator.prepare_data()
+    batch_size, accumulation_steps = memory_planner.plan(params, gnn_estimator.num_choices, FLAGS.batch_size,
+                                                         FLAGS.accumulation_steps)
+    stem_length, choice_length = (FLAGS.stem_len, FLAGS.choice_len) if FLAGS.split_stem else (None, None)
+
+    train_input_fn = gnn_estimator.file_based_input_fn_builder(
+        input_file="training_questions",
+        sequence_length=FLAGS.seq_len,
+        batch_size=batch_size,
+        is_training=True,
+        drop_remainder=True,
+        stem_length=stem_length,
+        choice_length=choice_length)
+
+    eval_input_fn = gnn_estimator.file_based_input_fn_builder(
+        input_file="validating_questions",
+        sequence_length=FLAGS.seq_len,
+        batch_size=FLAGS.eval_batch_size,
+        is_training=False,
+        drop_remainder=False,
+        stem_length=stem_length,
+        choice_length=choice_length)
+
+    trainer = GraphNetworkTrainer(params, accumulation_steps)
+    # What sets these steps apart from those of gnn_estimator, with the same flags
+    print("The trainer runs on a single device, the distribution flag (%s) only applies to gnn_estimator"
+          % FLAGS.distribution)
+    if FLAGS.jit_compile and FLAGS.halting != "none":
+        print("With jit_compile, halted graphs are masked out of passes over the whole batch, which gnn_estimator "
+              "only runs on the graphs still running (compact_halting)" +
+              (", and the passes are not recomputed" if FLAGS.recompute else ""))
+
+    if FLAGS.train:
+        print("***************************************")
+        print("Training")
+        print("***************************************")
+        trainer.train(train_input_fn(params), FLAGS.train_steps)
+
+    if FLAGS.predict:
+        print("***************************************")
+        print("Evaluating")
+        print("***************************************")
+        metrics = trainer.evaluate(eval_input_fn(params))
+        print("Accuracy: " + str(metrics['accuracy']) + "     loss: " + str(metrics['mean_loss']))
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
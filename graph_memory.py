@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import queue
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+import tensorflow as tf
+
+import fact_embedder
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_string("graph_memory_nodes", default="",
+      help="initial nodes of the graph memory (.npy), the first graph_memory_size fact vectors if empty")
+flags.DEFINE_integer("graph_memory_size", default=512,
+      help="number of nodes of the graph memory when they are not given by graph_memory_nodes")
+flags.DEFINE_string("graph_memory_output", default="GraphNodes.npy",
+      help="where the nodes of the graph memory are saved once every fact is written")
+flags.DEFINE_float("graph_memory_alpha", default=0.98,
+      help="decay of the moving average of the nodes: a node moves (1 - alpha) of the way to the facts closest to it")
+flags.DEFINE_integer("graph_memory_batch", default=4096,
+      help="maximum number of facts written together, in one new version of the nodes")
+flags.DEFINE_float("graph_memory_timeout_ms", default=5.0,
+      help="how long the first write of a batch waits for more writes")
+flags.DEFINE_integer("graph_memory_write_size", default=16,
+      help="number of facts of each write of main, as they would arrive from the fact embedder")
+flags.DEFINE_integer("graph_memory_readers", default=2,
+      help="number of threads of main that read the nodes while the facts are written, as inference would")
+
+FLAGS = flags.FLAGS
+
+# The nodes of the graph memory at a version, which are never changed once published
+Snapshot = collections.namedtuple("Snapshot", ["version", "nodes"])
+
+
+def nearest_nodes(nodes, vectors):
+    """The index of the node of `nodes` closest to each of `vectors` in euclidean distance."""
+    # |v - n|^2 = |v|^2 - 2 v.n + |n|^2, of which |v|^2 is the same for every node
+    return np.argmin(np.sum(np.square(nodes), 1) - 2 * np.matmul(vectors, nodes.T), 1)
+
+
+def ema_update(nodes, vectors, alpha):
+    """The update of debug.py, in place: each node of `nodes` closest to some of `vectors` becomes
+    alpha * node + (1 - alpha) * the mean of those vectors, the duplicates normalized by their count as
+    unique_with_counts does there. Returns the indices of the updated nodes."""
+    closest = nearest_nodes(nodes, vectors)
+    updated, assignment, counts = np.unique(closest, return_inverse=True, return_counts=True)
+    # The vectors sorted by node, so that the sum of those of each node is one segment
+    order = np.argsort(assignment, kind="stable")
+    sums = np.add.reduceat(vectors[order], np.cumsum(counts) - counts)
+    nodes[updated] = alpha * nodes[updated] + (1 - alpha) * sums / counts[:, np.newaxis]
+    return updated
+
+
+class GraphMemory(object):
+    """The nodes of the knowledge graph, which absorb encoded facts online while they are read.
+
+    Writes are queued and applied by a single writer thread, in batches like those of gnn_server.DynamicBatcher: a
+    batch is closed once it holds `max_batch_size` facts or `timeout` seconds after its first write. Each batch is
+    applied to a copy of the nodes (see ema_update), published as the next version. Readers take the latest Snapshot,
+    which is never changed afterwards (its nodes are read-only), so they never wait for a write and every read of a
+    snapshot sees the same nodes.
+    """
+
+    def __init__(self, nodes, alpha=0.98, max_batch_size=4096, timeout=0.005):
+        nodes = np.array(nodes, np.float32)
+        nodes.setflags(write=False)
+        self._snapshot = Snapshot(0, nodes)
+        self._alpha = alpha
+        self._max_batch_size = max_batch_size
+        self._timeout = timeout
+        self._writes = queue.Queue()
+        self.facts_written = 0
+        self.update_seconds = 0.0
+
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def snapshot(self):
+        """The latest Snapshot of the nodes."""
+        return self._snapshot
+
+    def write(self, vectors):
+        """Queues the encoded facts `vectors` (num_facts, depth), returns a future of the version of the first
+        snapshot that contains them."""
+        future = futures.Future()
+        self._writes.put((np.asarray(vectors, np.float32).reshape([-1, self._snapshot.nodes.shape[1]]), future))
+        return future
+
+    def throughput(self):
+        """Facts absorbed per second of update, copies of the nodes included."""
+        return self.facts_written / max(self.update_seconds, 1e-9)
+
+    def _loop(self):
+        while True:
+            batch = [self._writes.get()]
+            size = len(batch[0][0])
+            deadline = time.time() + self._timeout
+            while size < self._max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+
+            start = time.time()
+            try:
+                vectors = np.concatenate([vectors for vectors, _ in batch])
+                nodes = self._snapshot.nodes.copy()
+                ema_update(nodes, vectors, self._alpha)
+                nodes.setflags(write=False)
+                self._snapshot = Snapshot(self._snapshot.version + 1, nodes)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.update_seconds += time.time() - start
+            self.facts_written += len(vectors)
+            for _, future in batch:
+                future.set_result(self._snapshot.version)
+
+
+def absorb(memory, vectors, write_size, num_readers):
+    """Writes `vectors` to `memory` in writes of `write_size` facts while `num_readers` threads look up the nearest
+    nodes of facts in the latest snapshot. Returns the facts absorbed per second, the snapshots read per second and
+    the number of versions written."""
+    done = threading.Event()
+    reads = [0] * num_readers
+
+    def reader(index):
+        queries = vectors[index * write_size:(index + 1) * write_size]
+        version = 0
+        while not done.is_set():
+            snapshot = memory.snapshot()
+            if snapshot.version < version:
+                raise AssertionError("snapshot version went back from %d to %d" % (version, snapshot.version))
+            version = snapshot.version
+            nearest_nodes(snapshot.nodes, queries)
+            reads[index] += 1
+
+    readers = [threading.Thread(target=reader, args=(i,)) for i in range(num_readers)]
+    for thread in readers:
+        thread.start()
+    first_version = memory.snapshot().version
+    start = time.time()
+    writes = [memory.write(vectors[i:i + write_size]) for i in range(0, len(vectors), write_size)]
+    last_version = max(write.result() for write in writes)
+    duration = time.time() - start
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    return len(vectors) / duration, sum(reads) / duration, last_version - first_version
+
+
+def main(argv=None):
+    vectors = np.array(fact_embedder.read_cached_vectors(FLAGS.fact_vectors_dir))
+    if FLAGS.graph_memory_nodes:
+        nodes = np.load(FLAGS.graph_memory_nodes)
+    else:
+        nodes, vectors = vectors[:FLAGS.graph_memory_size], vectors[FLAGS.graph_memory_size:]
+
+    memory = GraphMemory(nodes, FLAGS.graph_memory_alpha, FLAGS.graph_memory_batch,
+                         FLAGS.graph_memory_timeout_ms / 1000)
+    speed, reads, versions = absorb(memory, vectors, FLAGS.graph_memory_write_size, FLAGS.graph_memory_readers)
+    np.save(FLAGS.graph_memory_output, memory.snapshot().nodes)
+    print("%d facts written in %d versions: %.1f facts/s (%.1f facts/s of updates), %d readers: %.1f snapshots/s"
+          % (len(vectors), versions, speed, memory.throughput(), FLAGS.graph_memory_readers, reads))
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
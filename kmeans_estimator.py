@@ -71,37 +71,14 @@ def main(argv=None):
         cluster_estimator.train(kmeans_input_fn_generator(True, train_concepts), max_steps=FLAGS.embed_steps)
 
         # embed the edges
-        edges_updates = np.zeros([FLAGS.graph_size, FLAGS.graph_size])
-        edges = np.zeros([FLAGS.graph_size, FLAGS.graph_size])
-        cluster_indices = list(cluster_estimator.predict_cluster_index(kmeans_input_fn_generator(False, train_concepts)))
-        previous_index = -1
-        relationship_index = 0
+        cluster_indices = np.array(list(cluster_estimator.predict_cluster_index(
+            kmeans_input_fn_generator(False, train_concepts))))
         cluster_centers = cluster_estimator.cluster_centers()
-        for i, concept in enumerate(train_concepts):
-            print("------------------------------")
-            if train_connections[i] == []:
-                relationship_index += 1
-                previous_index = -1
-            cluster_index = cluster_indices[i]
-            center = cluster_centers[cluster_index]
-            print("clustered score (with cluster " + str(cluster_index) + ": " + str(scipy.spatial.distance.cosine(center, concept)))
-            distances = []
-            minimum = scipy.spatial.distance.cosine(center, concept)
-            for i in range(len(cluster_centers)):
-                result = scipy.spatial.distance.cosine(cluster_centers[i], concept)
-                if i == cluster_index:
-                    print("result during second calculation: " + str(result))
-                distances.append(result)
-                if result < minimum:
-                    minimum == result
-            print("Minimum result in all clusters: " + str(minimum))
-            #Minimum distance in euclidean distance also gives the minimum distance in cosine distance
-            if previous_index != -1:
-                edges_updates[previous_index, cluster_index] += 1
-                edges[previous_index, cluster_index] = 1
-            previous_index = cluster_index
-
-            # 'point:', point, 'is in cluster', cluster_index, 'centered at', center
+        distances = [scipy.spatial.distance.cosine(cluster_centers[cluster_index], concept)
+                     for cluster_index, concept in zip(cluster_indices, train_concepts)]
+        print("mean cosine distance to the cluster centers: " + str(np.mean(distances)))
+        edges, edges_updates = text_processor.relationship_edges(cluster_indices, train_connections,
+                                                                 FLAGS.graph_size)
 
         np.save("GraphEdges", edges)
 
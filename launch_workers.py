@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+
+import tensorflow as tf
+
+import gnn_estimator
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_integer("num_workers", default=2,
+      help="number of training processes, the chief included")
+flags.DEFINE_integer("num_ps", default=1,
+      help="number of parameter servers with the parameter_server distribution")
+flags.DEFINE_integer("base_port", default=23456,
+      help="first of the local ports of the tasks")
+flags.DEFINE_string("worker_log_dir", default="worker_logs/",
+      help="directory of the output of every task")
+
+FLAGS = flags.FLAGS
+
+LAUNCHER_FLAGS = ["num_workers", "num_ps", "base_port", "worker_log_dir"]
+
+
+def local_cluster(num_workers, num_ps, distribution, base_port):
+    """The cluster of `num_workers` training processes on this host: workers only with multi_worker, whose first
+    worker is the chief, a chief, workers and `num_ps` parameter servers with parameter_server."""
+    addresses = ["localhost:%d" % port for port in range(base_port, base_port + num_workers + num_ps)]
+    if distribution == "multi_worker":
+        return {"worker": addresses[:num_workers]}
+    return {"chief": addresses[:1], "worker": addresses[1:num_workers], "ps": addresses[num_workers:]}
+
+
+def start_tasks(command, cluster, log_dir):
+    """Starts `command` once per task of `cluster`, with the task in TF_CONFIG and its output in `log_dir`.
+
+    Returns the training processes (the chief first) and the parameter servers, which never exit by themselves.
+    """
+    tf.io.gfile.makedirs(log_dir)
+    workers, parameter_servers = [], []
+    for task_type in ["chief", "worker", "ps"]:
+        for index in range(len(cluster.get(task_type, []))):
+            environment = dict(os.environ, TF_CONFIG=json.dumps({
+                "cluster": cluster,
+                "task": {"type": task_type, "index": index}}))
+            log = open(os.path.join(log_dir, "%s-%d.log" % (task_type, index)), "w")
+            process = subprocess.Popen(command, env=environment, stdout=log, stderr=subprocess.STDOUT,
+                                       universal_newlines=True)
+            (parameter_servers if task_type == "ps" else workers).append(process)
+
+    return workers, parameter_servers
+
+
+def wait_for_tasks(workers, parameter_servers):
+    """Waits for the training processes, then stops the parameter servers. Returns the exit codes of the workers."""
+    exit_codes = [process.wait() for process in workers]
+    for process in parameter_servers:
+        process.terminate()
+        process.wait()
+    return exit_codes
+
+
+def task_arguments(argv):
+    """The command line arguments of this script meant for the tasks, those of the launcher left out."""
+    arguments = []
+    skip_value = False
+    for argument in argv:
+        if skip_value:
+            skip_value = False
+            continue
+        if argument.startswith("-") and argument.lstrip("-").split("=")[0] in LAUNCHER_FLAGS:
+            # The launcher flags all take a value, given either as --flag=value or as --flag value
+            skip_value = "=" not in argument
+            continue
+        arguments.append(argument)
+
+    return arguments
+
+
+def main(argv=None):
+    if FLAGS.distribution == "mirrored":
+        raise ValueError("Choose the multi_worker or parameter_server distribution to launch several workers")
+
+    cluster = local_cluster(FLAGS.num_workers, FLAGS.num_ps, FLAGS.distribution, FLAGS.base_port)
+    command = [sys.executable, gnn_estimator.__file__] + task_arguments(sys.argv[1:])
+    print("Launching " + json.dumps(cluster) + ", logs in " + FLAGS.worker_log_dir)
+
+    exit_codes = wait_for_tasks(*start_tasks(command, cluster, FLAGS.worker_log_dir))
+    for index, exit_code in enumerate(exit_codes):
+        if exit_code:
+            print("Task %d exited with code %d" % (index, exit_code))
+    sys.exit(max(exit_codes))
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
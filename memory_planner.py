@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_float("memory_budget_mb", default=0,
+      help="memory available to training, in MB; 0 for no budget")
+flags.DEFINE_enum("auto_batch_size", default="none", enum_values=["none", "batch", "micro_batch"],
+      help="what is chosen to fit memory_budget_mb before training starts: nothing, the largest batch_size (a "
+           "multiple of accumulation_steps), or the fewest accumulation_steps that split batch_size into micro-batches "
+           "that fit")
+
+FLAGS = flags.FLAGS
+
+# Every estimate counts the float32 tensors that gnn_estimator.QuestionGraphNetwork holds at the peak of a step, from
+# their shapes (see estimate_memory). OVERHEAD accounts for what the count leaves out, the temporaries of the kernels
+# and the fragmentation of the allocator; it is fitted to the allocator peak of benchmark.py --benchmark=gnn_step
+# (see --benchmark=memory), so that the steps of a few hundred MB and more are not underestimated.
+OVERHEAD = 1.1
+
+
+def mb(num_floats):
+    return num_floats * 4 / 2 ** 20
+
+
+def graph_shapes(params):
+    """The vocabulary size, number of nodes and of edges and the depth of the model of `params`, read from the
+    headers of the table files and from the edges."""
+    vocab_size, depth = np.load(params['word_embedding'], mmap_mode='r').shape
+    num_nodes = np.load(params['graph_nodes'], mmap_mode='r').shape[0]
+    num_edges = int(np.count_nonzero(params['graph_edges']))
+    return vocab_size, num_nodes, num_edges, depth
+
+
+def num_parameters(depth):
+    """The number of trainable parameters of gnn_estimator.QuestionGraphNetwork with the current flags."""
+    lstm = 4 * depth * (2 * depth + 1)
+    dense = depth * (depth + 1)
+    layernorm = 2 * depth
+    parameters = lstm + dense + layernorm + depth + 1  # the question encoder, the globals and the readout
+    if FLAGS.recurrences > 0:
+        parameters += dense + layernorm  # the node MLP
+    if FLAGS.halting == "learned":
+        parameters += depth + 1
+    return parameters
+
+
+def estimate_memory(params, num_choices, batch_size, accumulation_steps=1, training=True):
+    """Estimates the peak memory of a training step, or of an evaluation batch, of `batch_size` questions.
+
+    The estimate follows the shapes of the network for the current flags (seq_len or stem_len and choice_len,
+    recurrences, halting, recompute and encoder_chunk) and the graph of `params`, in float32. Returns a dict of the
+    MB of the tables, the parameters, the optimizer (Adam slots and gradients), the activations and their total.
+    """
+    vocab_size, num_nodes, num_edges, depth = graph_shapes(params)
+    num_graphs = batch_size // accumulation_steps * num_choices
+    if FLAGS.split_stem:
+        question_len = FLAGS.stem_len + FLAGS.choice_len
+        encoded_tokens = num_graphs // num_choices * FLAGS.stem_len + num_graphs * FLAGS.choice_len
+    else:
+        question_len = FLAGS.seq_len
+        encoded_tokens = num_graphs * FLAGS.seq_len
+    recompute = training and FLAGS.recompute
+    passes = FLAGS.recurrences
+
+    # The tensors of each kind: the node features of a micro-batch [graphs * nodes, depth], the messages on its edges
+    # [graphs * edges, depth], its globals [graphs, global_size], its tokens [graphs * question_len, depth] once they
+    # are encoded and masked, their distances to the nodes [graphs * question_len, nodes] and the embedded inputs of
+    # the question encoder [encoded_tokens, depth].
+    nodes = num_graphs * num_nodes * depth
+    edges = num_graphs * num_edges * depth
+    globals_ = num_graphs * FLAGS.global_size
+    tokens = num_graphs * question_len * depth
+    distances = num_graphs * question_len * num_nodes
+    inputs = encoded_tokens * depth
+
+    if training:
+        # Kept for backpropagation: the LSTM keeps the inputs and, for every step, its states h and c, its four gates
+        # and tanh(c); with recompute, only the first chunk of encoder_chunk tokens keeps its steps. Each pass keeps
+        # the input of the node MLP, the input of the node layernorm and the dropout mask, and the inputs of the
+        # global dense layer and layernorm; a recomputed pass (all but the first) only keeps its nodes and globals.
+        # A pass of adaptive halting also keeps its output nodes and the nodes it replaces, whose shapes the
+        # gradient of tf.where needs.
+        chunk = min(encoded_tokens, num_graphs * FLAGS.encoder_chunk) * depth if recompute else inputs
+        kept = inputs + 7 * chunk
+        if recompute and passes > 0:
+            kept += 3 * nodes + 2 * globals_ + (passes - 1) * (nodes + globals_)
+        else:
+            kept += passes * (3 * nodes + 2 * globals_)
+        if FLAGS.halting != "none":
+            kept += passes * 2 * nodes
+        # The peak is either at the end of the forward pass, when the distances are computed, or during the
+        # backpropagation of a pass, which holds the gradients of its nodes and the messages on its edges and their
+        # gradient, and with recompute the activations of the recomputed pass (and of an encoder chunk).
+        backpropagation = 2 * nodes + 2 * edges
+        if recompute:
+            backpropagation += max(3 * nodes + 2 * globals_, 7 * chunk)
+        activations = kept + max(tokens + 2 * distances, backpropagation)
+    else:
+        # Nothing is kept; the peak is the largest stage: the inputs and outputs of the encoder, the masked tokens and
+        # their distances, the nodes scattered onto a zero batch of graphs, or a pass (its input, the outputs of the
+        # node MLP and its layernorm and the messages on the edges), with halting also holding the state of the batch.
+        halting_state = nodes if FLAGS.halting != "none" else 0
+        activations = max(2 * inputs, tokens + 2 * distances, 2 * nodes,
+                          3 * nodes + edges + 2 * globals_ + halting_state)
+
+    parameters = num_parameters(depth)
+    estimate = {
+        'tables': mb((vocab_size + num_nodes) * depth),
+        'parameters': mb(parameters),
+        'optimizer': mb(3 * parameters) if training else 0.0,
+        'activations': mb(OVERHEAD * activations)
+    }
+    estimate['total'] = sum(estimate.values())
+    return estimate
+
+
+def largest_batch_size(params, num_choices, budget_mb, accumulation_steps):
+    """The largest batch size, a multiple of `accumulation_steps`, whose training step fits in `budget_mb`; 0 if
+    not even the smallest one does."""
+    def fits(batch_size):
+        return estimate_memory(params, num_choices, batch_size, accumulation_steps)['total'] <= budget_mb
+
+    # The estimate grows with the batch size: double it until it does not fit, then bisect.
+    low, high = 0, accumulation_steps
+    while fits(high):
+        low, high = high, high * 2
+    while high - low > accumulation_steps:
+        middle = (low + high) // 2 // accumulation_steps * accumulation_steps
+        low, high = (middle, high) if fits(middle) else (low, middle)
+    return low
+
+
+def fewest_accumulation_steps(params, num_choices, budget_mb, batch_size):
+    """The fewest micro-batches, a divisor of `batch_size`, whose training step fits in `budget_mb`; 0 if even
+    single questions do not fit."""
+    for accumulation_steps in range(1, batch_size + 1):
+        if batch_size % accumulation_steps == 0 and estimate_memory(
+                params, num_choices, batch_size, accumulation_steps)['total'] <= budget_mb:
+            return accumulation_steps
+    return 0
+
+
+def print_estimate(name, estimate):
+    print(name + ": " + ", ".join("%s %.0f MB" % (part, size) for part, size in estimate.items()))
+
+
+def plan(params, num_choices, batch_size, accumulation_steps):
+    """Fits `batch_size` or `accumulation_steps` to memory_budget_mb as auto_batch_size asks, then prints the memory
+    estimates of a training step and of an evaluation batch. Meant to run before the input functions are built;
+    returns the batch size and the number of micro-batches to train with."""
+    budget_mb = FLAGS.memory_budget_mb
+    if FLAGS.auto_batch_size != "none":
+        if budget_mb <= 0:
+            raise ValueError("auto_batch_size needs a memory_budget_mb")
+        if FLAGS.auto_batch_size == "batch":
+            batch_size = largest_batch_size(params, num_choices, budget_mb, accumulation_steps)
+            if not batch_size:
+                raise ValueError("A batch of %d questions does not fit in %.0f MB" % (accumulation_steps, budget_mb))
+            print("Batch size for %.0f MB: %d" % (budget_mb, batch_size))
+        else:
+            accumulation_steps = fewest_accumulation_steps(params, num_choices, budget_mb, batch_size)
+            if not accumulation_steps:
+                raise ValueError("Not even a single question fits in %.0f MB" % budget_mb)
+            print("Micro-batches for %.0f MB: %d of %d questions" % (
+                budget_mb, accumulation_steps, batch_size // accumulation_steps))
+
+    training = estimate_memory(params, num_choices, batch_size, accumulation_steps)
+    evaluation = estimate_memory(params, num_choices, FLAGS.eval_batch_size, training=False)
+    print_estimate("Estimated memory of a training step", training)
+    print_estimate("Estimated memory of an evaluation batch", evaluation)
+    if budget_mb > 0:
+        for name, estimate in [("training step", training), ("evaluation batch", evaluation)]:
+            if estimate['total'] > budget_mb:
+                print("Warning: the %s may not fit in %.0f MB" % (name, budget_mb))
+
+    return batch_size, accumulation_steps
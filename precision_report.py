@@ -0,0 +1,180 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import fact_embedder
+import gnn_estimator
+import gnn_server
+import transformer_model
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_integer("report_batches", default=0,
+      help="number of validation batches scored by every engine, 0 for all of them")
+flags.DEFINE_string("encoder_export_dir", default="encoder_export/",
+      help="directory of the exported transformer encoders")
+
+FLAGS = flags.FLAGS
+
+
+def validation_batches():
+    stem_length, choice_length = (FLAGS.stem_len, FLAGS.choice_len) if FLAGS.split_stem else (None, None)
+    input_fn = gnn_estimator.file_based_input_fn_builder(
+        input_file="validating_questions",
+        sequence_length=FLAGS.seq_len,
+        batch_size=FLAGS.eval_batch_size,
+        is_training=False,
+        drop_remainder=False,
+        stem_length=stem_length,
+        choice_length=choice_length)
+
+    batches = [{name: feature.numpy() for name, feature in batch.items()} for batch in input_fn({})]
+    return batches[:FLAGS.report_batches] if FLAGS.report_batches else batches
+
+
+def size_mb(path):
+    """Size of a file, or of all the files under a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) / 2 ** 20
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names) / 2 ** 20
+
+
+def score_batches(scorer, batches, inputs):
+    """Scores `batches` with the `inputs` of each, returns the outputs and the mean time per batch. A first batch is
+    scored beforehand, so that the one-time costs (graph optimization, tensor allocation) are left out."""
+    scorer.score({name: batches[0][name] for name in inputs})
+    start = time.time()
+    outputs = [scorer.score({name: batch[name] for name in inputs}) for batch in batches]
+    return outputs, (time.time() - start) / len(batches)
+
+
+def gnn_scorers():
+    """The exported GNN as run by each engine, with the size of its model. The int8 conversion is saved next to
+    the SavedModel versions of export_dir."""
+    scorer = gnn_server.QuestionScorer(FLAGS.export_dir)
+    float_scorer = gnn_server.TFLiteScorer(*scorer.to_tflite(quantize=False))
+    int8_scorer = gnn_server.TFLiteScorer(*scorer.to_tflite(quantize=True))
+    with open(os.path.join(FLAGS.export_dir, "gnn_int8.tflite"), "wb") as model_file:
+        model_file.write(int8_scorer.model_content)
+
+    return [("float32", scorer, size_mb(scorer.model_path)),
+            ("bfloat16", gnn_server.QuestionScorer(FLAGS.export_dir, gnn_estimator.bfloat16_session_config()),
+             size_mb(scorer.model_path)),
+            ("tflite float32", float_scorer, len(float_scorer.model_content) / 2 ** 20),
+            ("tflite int8", int8_scorer, len(int8_scorer.model_content) / 2 ** 20)]
+
+
+def report_gnn(batches):
+    """Accuracy of the GNN on the validation questions and its latency, for each engine. The agreement is the
+    fraction of the predictions that are the same as in float32."""
+    inputs = ["input_ids", "stem_ids", "choice_ids"] if FLAGS.split_stem else ["input_ids"]
+    real_examples = [batch['is_real_example'] == 1 for batch in batches]
+    answers = np.concatenate([batch['answer_id'].reshape(-1)[real] for batch, real in zip(batches, real_examples)])
+    num_questions = len(answers)
+
+    engines = gnn_scorers()
+    print("%-16s %10s %10s %12s %14s %10s" % ("GNN engine", "accuracy", "agreement", "ms/batch", "questions/s",
+                                              "model MB"))
+    reference = None
+    for name, scorer, model_size in engines:
+        outputs, batch_time = score_batches(scorer, batches, inputs)
+        predictions = np.concatenate([output['prediction'][real] for output, real in zip(outputs, real_examples)])
+        if reference is None:
+            reference = predictions
+        print("%-16s %10.4f %10.4f %12.1f %14.1f %10.1f" % (
+            name, np.mean(predictions == answers), np.mean(predictions == reference), batch_time * 1000,
+            num_questions / len(batches) / batch_time, model_size))
+
+
+def validation_sentences(vocab_size):
+    """The sentences of the validation questions of data_dir, each choice after its stem, tokenized as the facts the
+    transformer is trained on (see fact_embedder.encode_text_facts) and padded or cut to seq_len tokens, in batches
+    of the sentences of eval_batch_size questions."""
+    data = pd.read_json(os.path.join(FLAGS.data_dir, "dev.jsonl"), lines=True)
+    texts = [question['stem'] + " " + choice['text'] for question in data['question']
+             for choice in question['choices']]
+
+    sentences = np.zeros([len(texts), FLAGS.seq_len], np.int32)
+    for i, tokens in enumerate(fact_embedder.encode_text_facts(texts, FLAGS.fact_tokenizer)):
+        tokens = tokens[:FLAGS.seq_len]
+        sentences[i, :len(tokens)] = tokens
+    if sentences.max() >= vocab_size:
+        raise ValueError("The tokenizer " + FLAGS.fact_tokenizer + " has more words than the vocabulary of the "
+                         "encoder, " + str(vocab_size))
+
+    batch_size = FLAGS.eval_batch_size * gnn_estimator.num_choices
+    batches = [{"sentences": sentences[start:start + batch_size]} for start in range(0, len(sentences), batch_size)]
+    return batches[:FLAGS.report_batches] if FLAGS.report_batches else batches
+
+
+def export_encoder(vocab_size):
+    """Exports the encoder of the transformer, with the weights of encoder_checkpoint, as a new SavedModel version
+    of encoder_export_dir which maps sentences of seq_len tokens to their encoding."""
+    with tf.Graph().as_default():
+        sentences = tf.compat.v1.placeholder(tf.int32, [None, FLAGS.seq_len], "sentences")
+        model = transformer_model.TED_generator(vocab_size, fact_embedder.encoder_hyperparameters(), encoder_only=True,
+                                                max_length=FLAGS.encoder_max_length)
+        encoded, _, _ = model(sentences, False)
+
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            if FLAGS.encoder_checkpoint:
+                tf.compat.v1.train.Saver().restore(session, FLAGS.encoder_checkpoint)
+            builder = tf.compat.v1.saved_model.Builder(os.path.join(FLAGS.encoder_export_dir, str(int(time.time()))))
+            signature = tf.compat.v1.saved_model.predict_signature_def({"sentences": sentences}, {"encoded": encoded})
+            builder.add_meta_graph_and_variables(session, [tf.saved_model.SERVING],
+                                                 signature_def_map={gnn_estimator.SIGNATURE_NAME: signature})
+            builder.save()
+
+
+def report_encoder(vocab_size):
+    """Latency of the transformer encoder on the validation sentences (see validation_sentences) for each engine,
+    and how close its encodings are to those in float32: the mean cosine similarity of the token encodings."""
+    sentences = validation_sentences(vocab_size)
+    export_encoder(vocab_size)
+    scorer = gnn_server.QuestionScorer(FLAGS.encoder_export_dir)
+    int8_scorer = gnn_server.TFLiteScorer(*scorer.to_tflite(quantize=True))
+    with open(os.path.join(FLAGS.encoder_export_dir, "encoder_int8.tflite"), "wb") as model_file:
+        model_file.write(int8_scorer.model_content)
+    engines = [("float32", scorer, size_mb(scorer.model_path)),
+               ("bfloat16", gnn_server.QuestionScorer(FLAGS.encoder_export_dir,
+                                                      gnn_estimator.bfloat16_session_config()),
+                size_mb(scorer.model_path)),
+               ("tflite int8", int8_scorer, len(int8_scorer.model_content) / 2 ** 20)]
+
+    print("%-16s %10s %12s %14s %10s" % ("Encoder engine", "cosine", "ms/batch", "sentences/s", "model MB"))
+    reference = None
+    for name, scorer, model_size in engines:
+        outputs, batch_time = score_batches(scorer, sentences, ["sentences"])
+        encoded = np.concatenate([output['encoded'] for output in outputs])
+        encoded /= np.maximum(np.linalg.norm(encoded, axis=-1, keepdims=True), 1e-12)
+        if reference is None:
+            reference = encoded
+        print("%-16s %10.4f %12.1f %14.1f %10.1f" % (name, np.mean(np.sum(encoded * reference, -1)),
+                                                     batch_time * 1000, len(encoded) / len(sentences) / batch_time,
+                                                     model_size))
+
+
+def main(argv=None):
+    if FLAGS.export:
+        estimator, _ = gnn_estimator.build_estimator()
+        estimator.export_saved_model(FLAGS.export_dir, gnn_estimator.serving_input_receiver_fn)
+
+    batches = validation_batches()
+    report_gnn(batches)
+
+    vocab_size = FLAGS.encoder_vocab_size or fact_embedder.checkpoint_vocab_size(FLAGS.encoder_checkpoint)
+    report_encoder(vocab_size)
+
+
+if __name__ == '__main__':
+    tf.compat.v1.app.run()
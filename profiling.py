@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+flags = tf.compat.v1.flags
+
+# Configuration
+flags.DEFINE_string("step_stats_file", default="",
+      help="JSON or CSV file (by its extension) to which the time, input wait and speed of every training step are "
+           "written at the end of training, empty for none; the steps are those of the GNN, of the transformer of "
+           "benchmark.py --benchmark=fact_batching (one file per batching) or the batches of fact_embedder")
+flags.DEFINE_string("profile_dir", default="",
+      help="directory to which a TensorFlow profiler trace of profile_steps training steps is written (see the "
+           "profile tab of TensorBoard), empty for no trace")
+flags.DEFINE_integer("profile_start_step", default=10,
+      help="number of training steps before the trace starts, so that it leaves out the slower first steps")
+flags.DEFINE_integer("profile_steps", default=5,
+      help="number of training steps traced")
+
+FLAGS = flags.FLAGS
+
+
+def step_stats(step, start, input_ready, end, batch_size):
+    """The stats of step number `step` of `batch_size` examples, which started at `start`, had its inputs at
+    `input_ready` (everything before counts as input wait) and ended at `end`."""
+    input_time = min(max(input_ready - start, 0.0), end - start)
+    return {
+        'step': step,
+        'step_ms': (end - start) * 1000,
+        'input_ms': input_time * 1000,
+        'compute_ms': (end - start - input_time) * 1000,
+        'examples_per_sec': batch_size / max(end - start, 1e-9),
+        'input_fraction': input_time / max(end - start, 1e-9)
+    }
+
+
+def write_step_stats(path, step_stats):
+    """Writes the stats of steps (see step_stats) to `path`: a CSV file with a row per step, or a JSON file with the
+    steps and their means."""
+    with tf.io.gfile.GFile(path, "w") as stats_file:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(stats_file, fieldnames=list(step_stats[0].keys()))
+            writer.writeheader()
+            writer.writerows(step_stats)
+        else:
+            summary = {name: float(np.mean([step[name] for step in step_stats])) for name in step_stats[0]
+                       if name != 'step'}
+            summary['steps'] = len(step_stats)
+            json.dump({'summary': summary, 'steps': step_stats}, stats_file, indent=1)
+
+
+class TraceWindow(object):
+    """Captures a TensorFlow profiler trace to `log_dir` of `num_steps` steps of a loop, after its first `start_step`
+    steps. The loop calls before_step and after_step around each of its steps, and stop once it is done."""
+
+    def __init__(self, log_dir, start_step, num_steps):
+        self._log_dir = log_dir
+        self._start_step = start_step
+        self._num_steps = num_steps
+        self._steps = 0
+        self._tracing = False
+
+    def before_step(self):
+        if self._steps == self._start_step and self._num_steps > 0:
+            tf.profiler.experimental.start(self._log_dir)
+            self._tracing = True
+
+    def after_step(self):
+        self._steps += 1
+        if self._tracing and self._steps == self._start_step + self._num_steps:
+            self.stop()
+
+    def stop(self):
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+            print("Profiler trace of steps %d to %d written to %s" % (self._start_step + 1, self._steps,
+                                                                      self._log_dir))
+
+
+class StepMonitor(object):
+    """The step stats and the profiler trace of the training loop of an estimator (see gnn_estimator.StepTimingHook
+    and ProfilerTraceHook), for loops that run their own steps.
+
+    Each step runs between begin_step and end_step, which is given the time its inputs were ready, when they are not
+    ready as the step begins. close writes the stats of the steps to `stats_file`, if any, and ends the trace of the
+    steps from `profile_start_step` on to `profile_dir`, if any.
+    """
+
+    def __init__(self, stats_file="", profile_dir="", profile_start_step=0, profile_steps=0):
+        self._stats_file = stats_file
+        self._trace = TraceWindow(profile_dir, profile_start_step, profile_steps) if profile_dir else None
+        self._step_stats = []
+        self._start = None
+
+    def begin_step(self):
+        if self._trace:
+            self._trace.before_step()
+        self._start = time.time()
+
+    def end_step(self, batch_size, input_ready=None):
+        end = time.time()
+        if self._trace:
+            self._trace.after_step()
+        if self._stats_file:
+            self._step_stats.append(step_stats(len(self._step_stats) + 1, self._start,
+                                               self._start if input_ready is None else input_ready, end, batch_size))
+
+    def close(self):
+        if self._trace:
+            self._trace.stop()
+        if self._stats_file and self._step_stats:
+            write_step_stats(self._stats_file, self._step_stats)
+
+
+def step_monitor(name=""):
+    """The StepMonitor of the step_stats_file and profile flags. A `name` tells the loops of a run apart: it is added
+    to the name of the stats file, before its extension, and is the subdirectory of profile_dir of the trace."""
+    stats_file, profile_dir = FLAGS.step_stats_file, FLAGS.profile_dir
+    if name and stats_file:
+        root, extension = os.path.splitext(stats_file)
+        stats_file = root + "." + name + extension
+    if name and profile_dir:
+        profile_dir = os.path.join(profile_dir, name)
+    return StepMonitor(stats_file, profile_dir, FLAGS.profile_start_step, FLAGS.profile_steps)
@@ -59,29 +59,13 @@ def text_processor(data_path, seq_len, vocab_level, processed_path):
     if not os.path.exists(processed_path):
         os.makedirs(processed_path)
 
+    # The tokenizer is kept to tokenize facts the same way later, e.g. by fact_embedder
+    tokenizer.save_to_file(processed_path + "/tokenizer")
+
     def write_tfrecords(samples, facts, data_name):
         full_path = processed_path + "/" + data_name + ".tfrecords"
         if not os.path.exists(full_path):
-
-            writer = tf.io.TFRecordWriter(full_path)
-
-            for sample, fact in zip(samples, facts):
-                encoded_fact = encode(sample)
-                # lengths[len(encoded_fact)] += 1
-                fact_length = len(encoded_fact)
-                padding = seq_len - fact_length
-
-                if (padding >= 0 and fact_length >= 3):
-                    feature = np.pad(encoded_fact, (0, padding), 'constant')
-                    example = {}
-                    example["input_ids"] = create_int_feature(feature)
-                    example["input_len"] = create_int_feature([fact_length])
-                    example["input_fact"] = create_int_feature([fact])
-
-                    tf_example = tf.train.Example(features=tf.train.Features(feature=example))
-                    writer.write(tf_example.SerializeToString())
-
-            writer.close()
+            write_fact_records(full_path, [encode(sample) for sample in samples], facts, seq_len)
 
     write_tfrecords(samples[:-2000], facts_indicator[:-2000], "training")
     write_tfrecords(samples[-2000:], facts_indicator[-2000:], "testing")
@@ -115,6 +99,83 @@ def text_processor(data_path, seq_len, vocab_level, processed_path):
     return vocab_size, tokenizer
 
 
+def write_fact_records(full_path, encoded_samples, facts, seq_len):
+    """Writes the encoded samples of at least 3 and at most seq_len tokens, padded to seq_len, with their length and
+    whether they are facts."""
+    writer = tf.io.TFRecordWriter(full_path)
+
+    for encoded_fact, fact in zip(encoded_samples, facts):
+        fact_length = len(encoded_fact)
+        padding = seq_len - fact_length
+
+        if (padding >= 0 and fact_length >= 3):
+            feature = np.pad(encoded_fact, (0, padding), 'constant')
+            example = {}
+            example["input_ids"] = create_int_feature(feature)
+            example["input_len"] = create_int_feature([fact_length])
+            example["input_fact"] = create_int_feature([fact])
+
+            tf_example = tf.train.Example(features=tf.train.Features(feature=example))
+            writer.write(tf_example.SerializeToString())
+
+    writer.close()
+
+
+def fact_input_fn_builder(input_files, seq_len, batch_size, is_training, bucket_width=0, max_tokens=0,
+                          shuffle_buffer=10000):
+    """Returns the input function of the samples written by text_processor, e.g. to train the transformer.
+
+    By default every batch has batch_size samples of seq_len tokens, as they are written. With a `bucket_width`,
+    the samples are grouped by their input_len into buckets of bucket_width lengths and each batch is only padded to
+    its longest sample, so that the transformer does not run over the padding of short samples. With `max_tokens`
+    as well, each bucket batches as many samples as fit in max_tokens tokens at its longest length, rather than
+    batch_size.
+
+    The batches have "input_ids" (batch, length), "input_len" (batch) and "input_fact" (batch).
+    """
+    name_to_features = {
+        "input_ids": tf.io.FixedLenFeature([seq_len], tf.int64),
+        "input_len": tf.io.FixedLenFeature([1], tf.int64),
+        "input_fact": tf.io.FixedLenFeature([1], tf.int64)
+    }
+
+    def _decode_record(records):
+        """Decodes a batch of records, or a single one, with its lengths and fact indicators as scalars."""
+        example = tf.io.parse_example(records, name_to_features)
+        return {name: tf.cast(tf.squeeze(t, -1) if name != "input_ids" else t, tf.int32)
+                for name, t in example.items()}
+
+    def _trim(example):
+        """Drops the padding of a single sample, bucketing pads it again only to the longest of its batch."""
+        example["input_ids"] = example["input_ids"][:example["input_len"]]
+        return example
+
+    def input_fn(params=None):
+        d = tf.data.TFRecordDataset(tf.io.gfile.glob(input_files))
+        if is_training:
+            d = d.shuffle(buffer_size=shuffle_buffer)
+            d = d.repeat()
+
+        if not bucket_width:
+            d = d.batch(batch_size=batch_size)
+            d = d.map(_decode_record, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            # Bucket i holds the lengths in [boundaries[i - 1], boundaries[i])
+            boundaries = list(range(bucket_width + 1, seq_len + 1, bucket_width))
+            if max_tokens:
+                bucket_batch_sizes = [max(1, max_tokens // (longest - 1)) for longest in boundaries]
+                bucket_batch_sizes.append(max(1, max_tokens // seq_len))
+            else:
+                bucket_batch_sizes = [batch_size] * (len(boundaries) + 1)
+
+            d = d.map(lambda record: _trim(_decode_record(record)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            d = d.bucket_by_sequence_length(lambda example: example["input_len"], boundaries, bucket_batch_sizes)
+
+        return d.prefetch(tf.data.experimental.AUTOTUNE)
+
+    return input_fn
+
+
 def get_tokenizer(texts, vocab_level):
     input_vocab_size = 2 ** vocab_level
 
@@ -141,7 +202,7 @@ def openbook_processor():
         f.write(fact)
     f.close()
 
-def openbook_question_processor(word_embedding_path, processed_path, max_length):
+def openbook_question_processor(word_embedding_path, processed_path, max_length, stem_length, choice_length):
 
     # Get the list of words in GloVE
     full_word_dict = {}
@@ -192,8 +253,13 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
     if not os.path.exists(processed_path):
         os.makedirs(processed_path)
 
+    # Besides the full "stem + choice" sequences, every question is also written as its stem (padded to
+    # stem_length) and its four choices (each padded to choice_length), so that the stem can be encoded once
+    # per question. Stems and choices longer than these lengths are truncated.
     def write_tfrecords(data_path, data_name):
         max = 0
+        max_stem = 0
+        max_choice = 0
         full_path = processed_path + "/" + data_name + ".tfrecords"
         embedding_size = [len(actual_embedding)]
 
@@ -209,6 +275,7 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
                 choices = question['choices']
                 # print("choices: " + str(choices))
                 choices_tokens = []
+                split_choices_tokens = []
                 stem = []
 
                 question_stem = question['stem'].lower().split()
@@ -248,13 +315,19 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
                             choice.append(0)
                     full_choice = stem + choice
 
+                    if max_choice < len(choice):
+                        max_choice = len(choice)
+                    choice = np.array(choice[:choice_length], dtype=np.int64)
+                    choice = np.pad(choice, (0, choice_length - len(choice)), 'constant', constant_values=(0, 1))
+                    split_choices_tokens += list(choice)
+
                     # print("full choice: " + str(full_choice))
                     # print("Decoded: " + str([decoder[i] for i in list(full_choice)]))
 
-                    choice_length = len(full_choice)
-                    if max < choice_length:
-                        max = choice_length
-                    padding = max_length - choice_length
+                    full_choice_length = len(full_choice)
+                    if max < full_choice_length:
+                        max = full_choice_length
+                    padding = max_length - full_choice_length
                     full_choice = np.pad(full_choice, (0, padding), 'constant', constant_values=(0, 1))
                     # print("full_choice: " + str(full_choice))
                     # print("choices_tokens: " + str(choices_tokens))
@@ -267,8 +340,15 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
                 elif answer == 'D':
                     answerValue = 3
 
+                if max_stem < len(stem):
+                    max_stem = len(stem)
+                stem = np.array(stem[:stem_length], dtype=np.int64)
+                stem_tokens = np.pad(stem, (0, stem_length - len(stem)), 'constant', constant_values=(0, 1))
+
                 example = {}
                 example["input_ids"] = create_int_feature(choices_tokens)
+                example["stem_ids"] = create_int_feature(stem_tokens)
+                example["choice_ids"] = create_int_feature(split_choices_tokens)
                 example["answer_id"] = create_int_feature([answerValue])
 
                 tf_example = tf.train.Example(features=tf.train.Features(feature=example))
@@ -276,6 +356,8 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
 
             writer.close()
             print("Maximum choice length: " + str(max))
+            print("Maximum stem length: " + str(max_stem))
+            print("Maximum answer length: " + str(max_choice))
 
     write_tfrecords("data/train.jsonl", "training_questions")
     write_tfrecords("data/test.jsonl", "testing_questions")
@@ -285,6 +367,47 @@ def openbook_question_processor(word_embedding_path, processed_path, max_length)
 
     return np.array(actual_embedding), decoder
 
+def tokenize_question(stem, choices, vocabulary, max_length, stem_length, choice_length):
+    """Tokenizes a question the same way openbook_question_processor does, with a fixed vocabulary.
+
+    Keyword arguments:
+    stem -- the question stem
+    choices -- the text of each choice
+    vocabulary -- maps a word to its index in the word embedding, unknown words get index 0
+    """
+    def _word_index(word):
+        return vocabulary.get(word, 0)
+
+    stem = [_word_index(word) for word in stem.lower().split()]
+    stem_tokens = np.array(stem[:stem_length], dtype=np.int64)
+    stem_tokens = np.pad(stem_tokens, (0, stem_length - len(stem_tokens)), 'constant', constant_values=(0, 1))
+
+    choices_tokens = []
+    split_choices_tokens = []
+    for text in choices:
+        choice = []
+        for word in text.lower().split():
+            if word[0] == '\'' and word[-1] == '\'':
+                word = word[1:-1]
+            if word in vocabulary or '\'' not in word:
+                choice.append(_word_index(word))
+            else:
+                index = word.index('\'')
+                choice.append(_word_index(word[:index]))
+                choice.append(_word_index(word[index:]))
+
+        full_choice = np.array((stem + choice)[:max_length], dtype=np.int64)
+        choices_tokens.append(np.pad(full_choice, (0, max_length - len(full_choice)), 'constant',
+                                     constant_values=(0, 1)))
+        choice = np.array(choice[:choice_length], dtype=np.int64)
+        split_choices_tokens.append(np.pad(choice, (0, choice_length - len(choice)), 'constant',
+                                           constant_values=(0, 1)))
+
+    return {"input_ids": np.stack(choices_tokens),
+            "stem_ids": stem_tokens,
+            "choice_ids": np.stack(split_choices_tokens)}
+
+
 def relationship_processor(embedding_path, data_path):
 
     # Process the word embedding
@@ -366,7 +489,29 @@ def relationship_processor(embedding_path, data_path):
     # originals: an array where each element is the original relationship in string
 
     print("concepts: " + str(np.shape(concepts)))
-    print("connections: " + str(np.shape(connections)))
-    print("originals: " + str(np.shape(originals)))
+    print("connections: " + str(len(connections)))
+    print("originals: " + str(len(originals)))
 
     return concepts, connections, originals
+
+
+def relationship_edges(cluster_indices, connections, graph_size):
+    """Connects the clusters of consecutive concepts of the same relationship.
+
+    Keyword arguments:
+    cluster_indices -- the cluster of each concept returned by relationship_processor
+    connections -- the connections returned by relationship_processor, empty at the first concept of a relationship
+    graph_size -- the number of clusters
+
+    Returns the adjacency matrix of the clusters and the number of times each of its edges was found.
+    """
+    cluster_indices = np.asarray(cluster_indices)
+    continues_relationship = np.array([len(connection) > 0 for connection in connections[1:len(cluster_indices)]],
+                                      dtype=bool)
+    senders = cluster_indices[:-1][continues_relationship]
+    receivers = cluster_indices[1:][continues_relationship]
+
+    edges_updates = np.zeros([graph_size, graph_size])
+    np.add.at(edges_updates, (senders, receivers), 1)
+    edges = (edges_updates > 0).astype(edges_updates.dtype)
+    return edges, edges_updates
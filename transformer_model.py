@@ -5,7 +5,59 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np
 
-def TED_generator(vocab_size, FLAGS):
+
+def node_segments(indices, num_nodes):
+    """The segment of each of the node `indices` (batch_size, seq_len) of the nodes of a graph of `num_nodes`
+    nodes, which tells apart the same node in different examples: example * num_nodes + node."""
+    return indices + tf.expand_dims(tf.range(tf.shape(indices)[0]) * num_nodes, 1)
+
+
+# normalize the duplicated values in each row of indices. For example, if three positions of a row contain the same
+# number, then return a y whose values in those positions are 1/3 = 0.33. The whole batch is counted at once, with one
+# segment per node of each example, rather than row by row with unique_with_counts.
+
+def normalize_unique(indices, num_nodes):
+    segments = node_segments(indices, num_nodes)
+    counts = tf.math.unsorted_segment_sum(tf.ones_like(segments, tf.float32), segments,
+                                          tf.shape(indices)[0] * num_nodes)
+    return 1 / tf.gather(counts, segments)  # (batch_size, seq_len)
+
+
+def scatter_unique_mean(indices, signals, num_nodes, nodes=None):
+    """Projects the `signals` (batch_size, seq_len, depth) onto the nodes of their `indices` (batch_size, seq_len):
+    each node of each example gets the mean of the signals projected onto it, i.e. their sum normalized by
+    normalize_unique, and the others 0, or, with the `nodes` (num_nodes, depth) of the graph, that mean added to its
+    node. Returns (batch_size, num_nodes, depth)."""
+    batch_size = tf.shape(indices)[0]
+    depth = tf.shape(signals)[-1]
+    # Normalized first, the signals are summed by one scatter, without a second pass over the output for the counts
+    normalized = tf.reshape(signals * tf.expand_dims(normalize_unique(indices, num_nodes), -1), [-1, depth])
+    segments = tf.reshape(node_segments(indices, num_nodes), [-1])
+    if nodes is None:
+        sums = tf.math.unsorted_segment_sum(normalized, segments, batch_size * num_nodes)
+    else:
+        sums = tf.tensor_scatter_nd_add(tf.tile(nodes, [batch_size, 1]), tf.expand_dims(segments, 1), normalized)
+    return tf.reshape(sums, [batch_size, num_nodes, depth])
+
+
+def TED_generator(vocab_size, FLAGS, encoder_only=False, sparse=False, chunk_size=0, return_attention=True,
+                  tied_output=False, num_sampled=0, max_length=1024, fused_qkv=False):
+    """Returns the function that builds the transformer. With `sparse`, every attention is over only the
+    FLAGS.sparse_lim keys of highest logit of each query (see top_k_attention). With a `chunk_size`, every attention is
+    exact but computed over blocks of chunk_size keys (see chunked_attention), which never builds the attention weights:
+    `return_attention` must then be False, which leaves the attention weights of every layer out of the outputs of the
+    encoder and the decoder. With `tied_output`, the output layer uses the weights of the embedding (see
+    TiedOutputLayer) and, with `num_sampled` as well, the training loss is a softmax over num_sampled classes sampled
+    from the vocabulary rather than over all of it. Sentences, and decoded ones, are at most `max_length` tokens. With
+    `fused_qkv`, self-attention projects its queries, keys and values with a single matmul (see MultiHeadAttention),
+    which changes its variables."""
+    if sparse and chunk_size:
+        raise ValueError("sparse and chunk_size are different attentions, pick one")
+    if chunk_size and return_attention:
+        raise ValueError("chunked attention has no attention weights to return, set return_attention=False")
+    if num_sampled and not tied_output:
+        raise ValueError("the sampled softmax needs the output layer tied to the embedding, set tied_output=True")
+
     def get_angles(pos, i, d_model):
         angle_rates = 1 / np.power(10000, (2 * (i // 2)) / np.float32(d_model))
         return pos * angle_rates
@@ -57,18 +109,6 @@ def TED_generator(vocab_size, FLAGS):
         return mask  # (seq_len, seq_len)
 
 
-    # normalize the duplicated values in x. For example, if three positions in x contains the same number,
-    # then return a y whose values in those positions are 1/3 = 0.33.
-
-    def normalize_unique(x):
-        # print("normalize_unique: " + str(x))
-        with tf.device('/cpu:0'):
-            ___, idx, count = tf.unique_with_counts(x)
-        counts = tf.gather(count, idx)
-        # print("counts: " + str(tf.cast(1/counts, tf.float32)))
-        return tf.cast(1/counts, tf.float32)
-
-
     # attention: the attention weights, need to be squeezed
     # k: the number of positions to keep
 
@@ -120,6 +160,11 @@ def TED_generator(vocab_size, FLAGS):
           output, attention_weights
         """
 
+        if sparse:
+            return top_k_attention(q, k, v, mask, FLAGS.sparse_lim)
+        if chunk_size:
+            return chunked_attention(q, k, v, mask, chunk_size), None
+
         matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
 
         # scale matmul_qk
@@ -134,26 +179,173 @@ def TED_generator(vocab_size, FLAGS):
         # add up to 1.
         attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
 
-        if sparse:
-            # max_weights = tf.math.reduce_max(attention_weights, axis=-1)
-            # attention_weights /= tf.expand_dims(max_weights, -1)
-            # attention_weights = tf.keras.layers.ReLU(1.0, 0, FLAGS.sparse_thresh)(attention_weights)
-            print("************Using Sparse Attention**********************")
-            top_values, top_indices = tf.math.top_k(attention_weights, FLAGS.sparse_lim)
-            positions = tf.where(tf.not_equal(top_indices, 99999))
-            top_indices = tf.reshape(top_indices, [tf.size(top_indices), 1])
-            positions = tf.slice(positions, [0,0], [-1, 3]) # we only want the first 3 dimensions, since the last dimension is incorrect
-            positions = tf.cast(positions, tf.int32)
-            actual_indices = tf.concat([positions, top_indices], -1)
-            top_values = tf.reshape(top_values, [tf.size(top_values)])
-            attention_weights = tf.scatter_nd(actual_indices, top_values,
-                                              tf.constant(attention_weights.get_shape().as_list()))
-
         output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
 
         return output, attention_weights
 
 
+    def top_k_attention(q, k, v, mask, top_k, block_size=128):
+        """Attention of each query over only the `top_k` keys of highest logit, the others get no weight.
+
+        The keys are selected block by block of `block_size` keys, keeping the top_k logits so far, so that the dense
+        (..., seq_len_q, seq_len_k) logits are never held at once; the softmax and the weighted sum of the values only
+        run over the selected keys, so they cost O(seq_len_q * top_k) instead of O(seq_len_q * seq_len_k). The logits
+        of the selected keys are those of the selection, and their gradient is computed block by block too, so only
+        the values of the selected keys are gathered for every query, not their keys.
+
+        Returns the output (..., seq_len_q, depth_v) and the attention weights of the selected keys
+        (..., seq_len_q, top_k).
+        """
+        seq_len_k = tf.shape(k)[-2]
+        top_k = tf.minimum(top_k, seq_len_k)
+        block_size = max(block_size, FLAGS.sparse_lim)
+        dk = tf.cast(tf.shape(k)[-1], tf.float32)
+
+        # The selection is not differentiated, see selected_logits for the gradient of the logits it selects
+        def block_logits(start):
+            end = tf.minimum(start + block_size, seq_len_k)
+            logits = tf.matmul(tf.stop_gradient(q), tf.stop_gradient(k[..., start:end, :]),
+                               transpose_b=True) / tf.math.sqrt(dk)  # (..., seq_len_q, block_size)
+            if mask is not None:
+                logits += mask[..., start:end] * -1e9
+            return logits, tf.broadcast_to(tf.range(start, end), tf.shape(logits))
+
+        def select(start, top_logits, top_indices):
+            logits, indices = block_logits(start)
+            top_logits, top = tf.math.top_k(tf.concat([top_logits, logits], -1), top_k)
+            return start + block_size, top_logits, tf.gather(tf.concat([top_indices, indices], -1), top,
+                                                             batch_dims=len(q.shape) - 1)
+
+        logits, indices = block_logits(0)
+        top_logits, top = tf.math.top_k(logits, top_k)
+        loop_vars = (tf.constant(block_size), top_logits, tf.gather(indices, top, batch_dims=len(q.shape) - 1))
+        _, top_logits, top_indices = tf.while_loop(
+            lambda start, *_: start < seq_len_k, select, loop_vars,
+            shape_invariants=tf.nest.map_structure(lambda tensor: tf.TensorShape([None] * tensor.shape.rank),
+                                                   loop_vars))
+
+        rank = len(k.shape)
+        num_blocks = (seq_len_k + block_size - 1) // block_size
+
+        @tf.custom_gradient
+        def selected_logits(q, k, top_logits, top_indices):
+            """The logits of the selected keys (masked keys keep their masked logits). Their gradient is summed block
+            by block into the (..., seq_len_q, block_size) gradient of the logits of the block, which is multiplied
+            with the keys and the queries like dense logits would be."""
+            def grad(d_logits):
+                rows_shape = tf.shape(top_indices)[:-1]
+                num_rows = tf.reduce_prod(rows_shape)
+                rows = tf.reshape(tf.range(num_rows), tf.concat([rows_shape, [1]], 0))
+                d_logits /= tf.math.sqrt(dk)
+                padded_k = tf.pad(k, [[0, 0]] * (rank - 2) + [[0, num_blocks * block_size - seq_len_k], [0, 0]])
+
+                def backpropagate(i, d_q, d_k):
+                    # The selected keys of the block, each to its position in the block; the others are dropped
+                    positions = top_indices - i * block_size
+                    segments = tf.where((positions >= 0) & (positions < block_size), rows * block_size + positions, -1)
+                    d_block = tf.reshape(tf.math.unsorted_segment_sum(d_logits, segments, num_rows * block_size),
+                                         tf.concat([rows_shape, [block_size]], 0))  # (..., seq_len_q, block_size)
+                    k_block = padded_k[..., i * block_size:(i + 1) * block_size, :]
+                    return i + 1, d_q + tf.matmul(d_block, k_block), d_k.write(i, tf.matmul(d_block, q,
+                                                                                             transpose_a=True))
+
+                _, d_q, d_k = tf.while_loop(lambda i, *_: i < num_blocks, backpropagate,
+                                            (tf.constant(0), tf.zeros_like(q), tf.TensorArray(k.dtype, num_blocks)))
+                # (num_blocks, ..., block_size, depth) to the shape of k
+                d_k = tf.transpose(d_k.stack(), list(range(1, rank - 1)) + [0, rank - 1, rank])
+                d_k = tf.reshape(d_k, tf.shape(padded_k))[..., :seq_len_k, :]
+                return d_q, d_k, None, None
+
+            return tf.identity(top_logits), grad
+
+        logits = selected_logits(q, k, top_logits, top_indices)  # (..., seq_len_q, top_k)
+        top_values = tf.gather(v, top_indices, batch_dims=rank - 2)  # (..., seq_len_q, top_k, depth_v)
+
+        attention_weights = tf.nn.softmax(logits, axis=-1)
+        output = tf.einsum('...qk,...qkd->...qd', attention_weights, top_values)  # (..., seq_len_q, depth_v)
+        return output, attention_weights
+
+
+    def chunked_attention(q, k, v, mask, block_size):
+        """The same attention as the dense one, computed over blocks of `block_size` keys with an online softmax: each
+        block rescales the sum of the weighted values and of the weights so far to the running maximum logit of each
+        query, and the sums are divided at the end.
+
+        Only the (..., seq_len_q, block_size) logits of one block are held at a time, so memory grows linearly with
+        the sequence length. The gradient does the same: it keeps only the output and the log-sum-exp of the logits of
+        each query, and recomputes the weights of each block from them, instead of keeping the weights of every block
+        as the gradient of the loop would.
+
+        Returns the output (..., seq_len_q, depth_v).
+        """
+        rank = len(k.shape)
+        seq_len_k = tf.shape(k)[-2]
+        num_blocks = (seq_len_k + block_size - 1) // block_size
+        # The queries are scaled once rather than the logits of every block
+        q = q / tf.math.sqrt(tf.cast(tf.shape(k)[-1], tf.float32))
+
+        # The keys are padded to whole blocks, and the padding masked out
+        padding = num_blocks * block_size - seq_len_k
+        k = tf.pad(k, [[0, 0]] * (rank - 2) + [[0, padding], [0, 0]])
+        v = tf.pad(v, [[0, 0]] * (rank - 2) + [[0, padding], [0, 0]])
+        if mask is None:
+            mask = tf.zeros([seq_len_k])
+        mask = tf.pad(mask, [[0, 0]] * (len(mask.shape) - 1) + [[0, padding]], constant_values=1) * -1e9
+
+        def block(tensor, i):
+            return tensor[..., i * block_size:(i + 1) * block_size, :]
+
+        def block_logits(q, k, i):
+            logits = tf.matmul(q, block(k, i), transpose_b=True)  # (..., seq_len_q, block_size)
+            return logits + mask[..., i * block_size:(i + 1) * block_size]
+
+        def blocks_loop(body, loop_vars):
+            return tf.while_loop(lambda i, *_: i < num_blocks, body, (tf.constant(0),) + loop_vars)[1:]
+
+        @tf.custom_gradient
+        def attention(q, k, v):
+            def accumulate(i, output, row_max, row_sum):
+                logits = block_logits(q, k, i)
+                new_max = tf.maximum(row_max, tf.reduce_max(logits, -1, keepdims=True))
+                weights = tf.exp(logits - new_max)
+                rescale = tf.exp(row_max - new_max)
+                return (i + 1, output * rescale + tf.matmul(weights, block(v, i)), new_max,
+                        row_sum * rescale + tf.reduce_sum(weights, -1, keepdims=True))
+
+            rows = tf.shape(q)[:-1]
+            output, row_max, row_sum = blocks_loop(accumulate, (
+                tf.zeros(tf.concat([rows, tf.shape(v)[-1:]], 0)), tf.fill(tf.concat([rows, [1]], 0), -np.inf),
+                tf.zeros(tf.concat([rows, [1]], 0))))
+            output /= row_sum
+            log_sum_exp = row_max + tf.math.log(row_sum)
+
+            def grad(d_output):
+                d_rows = tf.reduce_sum(d_output * output, -1, keepdims=True)
+
+                def backpropagate(i, d_q, d_k, d_v):
+                    weights = tf.exp(block_logits(q, k, i) - log_sum_exp)
+                    d_logits = weights * (tf.matmul(d_output, block(v, i), transpose_b=True) - d_rows)
+                    return (i + 1, d_q + tf.matmul(d_logits, block(k, i)),
+                            d_k.write(i, tf.matmul(d_logits, q, transpose_a=True)),
+                            d_v.write(i, tf.matmul(weights, d_output, transpose_a=True)))
+
+                d_q, d_k, d_v = blocks_loop(backpropagate, (
+                    tf.zeros_like(q), tf.TensorArray(k.dtype, num_blocks), tf.TensorArray(v.dtype, num_blocks)))
+
+                def unblock(blocks, like):
+                    # (num_blocks, ..., block_size, depth) to the shape of `like`
+                    blocks = tf.transpose(blocks.stack(), list(range(1, rank - 1)) + [0, rank - 1, rank])
+                    return tf.reshape(blocks, tf.shape(like))
+
+                return d_q, unblock(d_k, k), unblock(d_v, v)
+
+            return output, grad
+
+        output = attention(q, k, v)
+        output.set_shape(q.shape[:-1].concatenate(v.shape[-1:]))
+        return output
+
+
     # As the softmax normalization is done on K, its values decide the amount of importance given to Q.
     #
     # The output represents the multiplication of the attention weights and the V (value) vector. This ensures that the words we want to focus on are kept as is and the irrelevant words are flushed out.
@@ -181,18 +373,22 @@ def TED_generator(vocab_size, FLAGS):
 
 
     class MultiHeadAttention(tf.keras.layers.Layer):
-        def __init__(self, d_model, num_heads):
+        def __init__(self, d_model, num_heads, fused_qkv=False):
             super(MultiHeadAttention, self).__init__()
             self.num_heads = num_heads
             self.d_model = d_model
+            self.fused_qkv = fused_qkv
 
             assert d_model % self.num_heads == 0
 
             self.depth = d_model // self.num_heads
 
-            self.wq = tf.keras.layers.Dense(d_model)
-            self.wk = tf.keras.layers.Dense(d_model)
-            self.wv = tf.keras.layers.Dense(d_model)
+            if fused_qkv:
+                self.wqkv = tf.keras.layers.Dense(3 * d_model)
+            else:
+                self.wq = tf.keras.layers.Dense(d_model)
+                self.wk = tf.keras.layers.Dense(d_model)
+                self.wv = tf.keras.layers.Dense(d_model)
 
             self.dense = tf.keras.layers.Dense(d_model)
 
@@ -203,21 +399,41 @@ def TED_generator(vocab_size, FLAGS):
             x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
             return tf.transpose(x, perm=[0, 2, 1, 3])
 
-        def call(self, v, k, q, mask, sparse=False):
+        def call(self, v, k, q, mask, sparse=False, cache=None, static_cache=False):
+            """With a `cache` dict, the keys and values of earlier calls are kept in it, in place, so that a decoding
+            step only projects its new tokens: those of `k` and `v` are appended to its "k" and "v" or, with
+            `static_cache` (`k` and `v` are the same at every step, e.g. the encoder output), only computed by the
+            first call and reused by the next ones. With fused_qkv, the layer is a self-attention: `v`, `k` and `q`
+            are the same tensor, projected by one matmul and split into heads by one transpose."""
             batch_size = tf.shape(q)[0]
 
-            q = self.wq(q)  # (batch_size, seq_len, d_model)
-            k = self.wk(k)  # (batch_size, seq_len, d_model)
-            v = self.wv(v)  # (batch_size, seq_len, d_model)
+            if self.fused_qkv:
+                qkv = tf.reshape(self.wqkv(q), (batch_size, -1, 3, self.num_heads, self.depth))
+                q, k, v = tf.unstack(tf.transpose(qkv, perm=[2, 0, 3, 1, 4]))  # (batch_size, num_heads, seq_len, depth)
+            else:
+                q = self.wq(q)  # (batch_size, seq_len, d_model)
+                q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
+
+                if not (cache and static_cache):
+                    k = self.wk(k)  # (batch_size, seq_len, d_model)
+                    v = self.wv(v)  # (batch_size, seq_len, d_model)
 
-            q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-            k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-            v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+                    k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
+                    v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+
+            if cache and static_cache:
+                k, v = cache["k"], cache["v"]
+            elif cache is not None:
+                if cache:
+                    k = tf.concat([cache["k"], k], axis=2)  # (batch_size, num_heads, cached + seq_len_k, depth)
+                    v = tf.concat([cache["v"], v], axis=2)
+                cache["k"], cache["v"] = k, v
 
             # scaled_attention.shape == (batch_size, num_heads, seq_len_v, depth)
             # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
-            scaled_attention, attention_weights = scaled_dot_product_attention(
-                q, k, v, mask, sparse)
+            with tf.name_scope("scaled_dot_product_attention"):
+                scaled_attention, attention_weights = scaled_dot_product_attention(
+                    q, k, v, mask, sparse)
 
             scaled_attention = tf.transpose(scaled_attention,
                                             perm=[0, 2, 1, 3])  # (batch_size, seq_len_v, num_heads, depth)
@@ -277,7 +493,7 @@ def TED_generator(vocab_size, FLAGS):
         def __init__(self, d_model, num_heads, dff, rate=0.1):
             super(EncoderLayer, self).__init__()
 
-            self.mha = MultiHeadAttention(d_model, num_heads)
+            self.mha = MultiHeadAttention(d_model, num_heads, fused_qkv)
             self.ffn = point_wise_feed_forward_network(d_model, dff)
 
             self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -287,7 +503,7 @@ def TED_generator(vocab_size, FLAGS):
             self.dropout2 = tf.keras.layers.Dropout(rate)
 
         def call(self, x, training, mask):
-            attn_output, attention_weights = self.mha(x, x, x, mask)  # (batch_size, input_seq_len, d_model)
+            attn_output, attention_weights = self.mha(x, x, x, mask, sparse)  # (batch_size, input_seq_len, d_model)
             attn_output = self.dropout1(attn_output, training=training)
             out1 = self.layernorm1(x + attn_output)  # (batch_size, input_seq_len, d_model)
 
@@ -302,7 +518,7 @@ def TED_generator(vocab_size, FLAGS):
         def __init__(self, d_model, num_heads, dff, rate=0.1):
             super(DecoderLayer, self).__init__()
 
-            self.mha1 = MultiHeadAttention(d_model, num_heads)
+            self.mha1 = MultiHeadAttention(d_model, num_heads, fused_qkv)
             self.mha2 = MultiHeadAttention(d_model, num_heads)
 
             self.ffn = point_wise_feed_forward_network(d_model, dff)
@@ -315,16 +531,19 @@ def TED_generator(vocab_size, FLAGS):
             self.dropout2 = tf.keras.layers.Dropout(rate)
             self.dropout3 = tf.keras.layers.Dropout(rate)
 
-        def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
+        def call(self, x, enc_output, training, look_ahead_mask, padding_mask, cache=None):
             # enc_output.shape == (batch_size, input_seq_len, d_model)
             # x = the output of previous decoder layer (initially it will just be the target sequence)
+            # cache = the keys and values of the "self" and "cross" attention of the earlier decoding steps, if any
 
-            attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask)  # (batch_size, target_seq_len, d_model)
+            attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask, sparse,
+                                                   cache=cache and cache["self"])  # (batch_size, target_seq_len, d_model)
             attn1 = self.dropout1(attn1, training=training)
             out1 = self.layernorm1(attn1 + x)
 
             attn2, attn_weights_block2 = self.mha2(
-                enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
+                enc_output, enc_output, out1, padding_mask, sparse,
+                cache=cache and cache["cross"], static_cache=True)  # (batch_size, target_seq_len, d_model)
             attn2 = self.dropout2(attn2, training=training)
             out2 = self.layernorm2(attn2 + out1)  # (batch_size, target_seq_len, d_model)
 
@@ -348,7 +567,7 @@ def TED_generator(vocab_size, FLAGS):
 
 
     class Encoder(tf.keras.layers.Layer):
-        def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
+        def __init__(self, num_layers, d_model, num_heads, dff, pos_encoding,
                      embedding, rate=0.1):
             super(Encoder, self).__init__()
 
@@ -356,7 +575,7 @@ def TED_generator(vocab_size, FLAGS):
             self.num_layers = num_layers
 
             self.embedding = embedding
-            self.pos_encoding = positional_encoding(input_vocab_size, self.d_model)
+            self.pos_encoding = pos_encoding
 
             # dff is basically the number of units in the intermediate dense layer
             self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate)
@@ -371,20 +590,22 @@ def TED_generator(vocab_size, FLAGS):
             # adding embedding and position encoding.
             x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
             embedder_out = x
-            x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-            x += self.pos_encoding[:, :seq_len, :]
+            with tf.name_scope("positional_encoding"):
+                x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+                x += self.pos_encoding[:, :seq_len, :]
 
             x = self.dropout(x, training=training)
 
             for i in range(self.num_layers):
                 x, encoder_attention_weight = self.enc_layers[i](x, training, mask)
-                encoder_attention_weights.append(encoder_attention_weight)
+                if return_attention:
+                    encoder_attention_weights.append(encoder_attention_weight)
 
             return x, encoder_attention_weights, embedder_out  # (batch_size, input_seq_len, d_model)
 
 
     class Decoder(tf.keras.layers.Layer):
-        def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size,
+        def __init__(self, num_layers, d_model, num_heads, dff, pos_encoding, look_ahead_mask,
                      embedding, rate=0.1):
             super(Decoder, self).__init__()
 
@@ -392,88 +613,351 @@ def TED_generator(vocab_size, FLAGS):
             self.num_layers = num_layers
 
             self.embedding = embedding
-            self.pos_encoding = positional_encoding(target_vocab_size, self.d_model)
+            self.pos_encoding = pos_encoding
+            self.look_ahead_mask = look_ahead_mask
 
             self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate)
                                for _ in range(num_layers)]
             self.dropout = tf.keras.layers.Dropout(rate)
 
         def call(self, x, enc_output, training,
-                 look_ahead_mask, padding_mask):
+                 look_ahead_mask, padding_mask, cache=None):
+            """With a `cache`, a list of a dict per layer (empty before the first step), `x` are the tokens that
+            follow those already decoded into it, see Transformer.decode_cached."""
             seq_len = tf.shape(x)[1]
             attention_weights = {}
 
+            start = 0
+            if cache is not None:
+                if cache[0]["self"]:
+                    start = tf.shape(cache[0]["self"]["k"])[2]
+                start = check_length(start, start + seq_len, "The decoded sentences (their cached tokens included)")
+                # The new tokens see all the cached ones and those before them
+                look_ahead_mask = self.look_ahead_mask[start:start + seq_len, :start + seq_len]
+
             x = self.embedding(x)  # (batch_size, target_seq_len, d_model). The targets.
-            x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-            x += self.pos_encoding[:, :seq_len, :]
+            with tf.name_scope("positional_encoding"):
+                x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+                x += self.pos_encoding[:, start:start + seq_len, :]
 
             x = self.dropout(x, training=training)
 
             for i in range(self.num_layers):
                 x, block1, block2 = self.dec_layers[i](x, enc_output, training,
-                                                       look_ahead_mask, padding_mask)
+                                                       look_ahead_mask, padding_mask,
+                                                       cache=None if cache is None else cache[i])
 
-                attention_weights['decoder_layer{}_block1'.format(i + 1)] = block1
-                attention_weights['decoder_layer{}_block2'.format(i + 1)] = block2
+                if return_attention:
+                    attention_weights['decoder_layer{}_block1'.format(i + 1)] = block1
+                    attention_weights['decoder_layer{}_block2'.format(i + 1)] = block2
 
             # x.shape == (batch_size, target_seq_len, d_model)
             return x, attention_weights
 
 
+    def check_length(tensor, length, what):
+        """`tensor`, once `length` is checked to be at most max_length: the tables of the positional encoding and of
+        the look-ahead mask end there, and their slices would silently be cut short of longer sentences."""
+        message = "%s are longer than max_length (%d tokens)" % (what, max_length)
+        if isinstance(length, int) and length > max_length:
+            raise ValueError(message)
+        with tf.control_dependencies([tf.debugging.assert_less_equal(length, max_length, message=message)]):
+            return tf.identity(tensor)
+
+
     # ## Create the Transformer
 
     # Transformer consists of the encoder, decoder and a final linear layer. The output of the decoder is the input to the linear layer and its output is returned.
 
     # In[ ]:
 
-    def create_masks(inp, tar):
+    def create_masks(inp, tar, look_ahead_mask):
         # Encoder padding mask
         enc_padding_mask = create_padding_mask(inp)
 
         # Used in the 2nd attention block in the decoder.
-        # This padding mask is used to mask the encoder outputs.
-        dec_padding_mask = create_padding_mask(inp)
+        # This padding mask is used to mask the encoder outputs, it is the same as that of the encoder.
+        dec_padding_mask = enc_padding_mask
 
         # Used in the 1st attention block in the decoder.
         # It is used to pad and mask future tokens in the input received by
-        # the decoder.
-        look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+        # the decoder. The look-ahead mask of the length of tar is a slice of the table `look_ahead_mask`.
+        size = tf.shape(tar)[1]
         dec_target_padding_mask = create_padding_mask(tar)
-        combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+        combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask[:size, :size])
 
         return enc_padding_mask, combined_mask, dec_padding_mask
 
 
+    # The output layer can share the weights of the embedding: the logit of a word is the dot product of the decoder
+    # output with its embedding. The vocabulary then costs no more parameters, and the sampled softmax only gathers the
+    # embeddings of the target and sampled words, so a training step does not grow with the size of the vocabulary.
+
+    class TiedOutputLayer(tf.keras.layers.Layer):
+        def __init__(self, embedding):
+            super(TiedOutputLayer, self).__init__()
+            self.embedding = embedding
+
+        def build(self, input_shape):
+            self.bias = self.add_weight("bias", [self.embedding.input_dim], initializer="zeros")
+
+        def call(self, x, targets=None):
+            """The logits of `x` (..., d_model) over the vocabulary or, with its `targets` (num_tokens,) and `x` of
+            shape (num_tokens, d_model), the cross entropy of each target with a softmax over num_sampled words."""
+            if targets is None:
+                return tf.matmul(x, self.embedding.embeddings, transpose_b=True) + self.bias
+            return tf.nn.sampled_softmax_loss(self.embedding.embeddings, self.bias,
+                                              tf.expand_dims(tf.cast(targets, tf.int64), -1), x, num_sampled,
+                                              self.embedding.input_dim)
+
+
     class Transformer(tf.keras.Model):
         def __init__(self, num_layers, d_model, num_heads, dff, vocab_size, rate=0.1):
             super(Transformer, self).__init__()
 
             self.embedding = tf.keras.layers.Embedding(vocab_size, d_model)
 
+            # The positional encoding and the look-ahead mask are tables of max_length positions, computed once and
+            # shared by the encoder and the decoder, of which every call takes the slice of its length
+            self.pos_encoding = positional_encoding(max_length, d_model)
+            self.look_ahead_mask = create_look_ahead_mask(max_length)
+
             self.encoder = Encoder(num_layers, d_model, num_heads, dff,
-                                   vocab_size, self.embedding, rate)
+                                   self.pos_encoding, self.embedding, rate)
 
             self.decoder = Decoder(num_layers, d_model, num_heads, dff,
-                                   vocab_size, self.embedding, rate)
+                                   self.pos_encoding, self.look_ahead_mask, self.embedding, rate)
 
-            self.final_layer = tf.keras.layers.Dense(vocab_size)
+            if tied_output:
+                self.final_layer = TiedOutputLayer(self.embedding)
+            else:
+                self.final_layer = tf.keras.layers.Dense(vocab_size)
+
+        def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, cache=None, targets=None):
+            """With `targets`, the next token of each of `tar`, the first output is their loss (see target_loss)
+            rather than the logits. Without `tar`, only the encoder runs, and its outputs are returned."""
+            if cache is not None:
+                return self.decode_cached(inp, tar, training, enc_padding_mask, cache)
+            if tar is None:
+                return self.encoder(inp, training, enc_padding_mask)
 
-        def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask):
             enc_output, encoder_attention_weights, embedder_out = self.encoder(inp, training, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
 
             dec_output, _ = self.decoder(tar, enc_output, training, look_ahead_mask, enc_padding_mask)
 
+            if targets is not None:
+                loss = self.target_loss(dec_output, targets, training)
+                return loss, encoder_attention_weights, enc_output, embedder_out
+
             final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
 
             return final_output, encoder_attention_weights, enc_output, embedder_out
 
-    def model(sentences, is_training):
-        predicted = tf.slice(sentences, [0, 0], [-1, sentences.get_shape()[1] - 1])
-        """Constructs the ResNet model given the inputs."""
+        def target_loss(self, dec_output, targets, training):
+            """The mean cross entropy of the `targets` (batch_size, tar_seq_len), their padding left out. In training
+            with num_sampled, the softmax is over num_sampled sampled words; otherwise, e.g. in evaluation, it is the
+            exact softmax over the whole vocabulary."""
+            real = tf.not_equal(targets, 0)
+            dec_output = tf.boolean_mask(dec_output, real)  # (num_tokens, d_model)
+            targets = tf.boolean_mask(targets, real)  # (num_tokens,)
+            if training and num_sampled:
+                losses = self.final_layer(dec_output, targets=targets)
+            else:
+                losses = tf.nn.sparse_softmax_cross_entropy_with_logits(targets, self.final_layer(dec_output))
+            return tf.reduce_mean(losses)
+
+        def decode_cached(self, inp, tar, training, enc_padding_mask, cache):
+            """Decodes the tokens `tar` that follow those already decoded into `cache`, a dict that is empty before the
+            first step. The cache keeps the encoder output of `inp`, computed by the first step only, and for each
+            decoder layer the keys and values of self-attention of the decoded tokens and of cross-attention of the
+            encoder output, so that a step runs only its new tokens through the decoder and attends over the cached
+            ones. Only called through `call`, so that the variables are named as in training.
+
+            Returns the logits of `tar` (batch_size, tar_seq_len, target_vocab_size) and the updated cache.
+            """
+            cache = dict(cache)
+            if "encoder_output" not in cache:
+                cache["encoder_output"], _, _ = self.encoder(inp, training, enc_padding_mask)
+                cache["layers"] = [{"self": {}, "cross": {}} for _ in range(self.decoder.num_layers)]
+            else:
+                cache["layers"] = [{name: dict(attention) for name, attention in layer.items()}
+                                   for layer in cache["layers"]]
+
+            dec_output, _ = self.decoder(tar, cache["encoder_output"], training, None, enc_padding_mask,
+                                         cache=cache["layers"])
+            return self.final_layer(dec_output), cache
+
+    # ## Decoding
+
+    # The sentences of text_processor end with the last token of the vocabulary. Every decoding step only runs the
+    # decoder on the new token of each unfinished sentence, with the keys and values of the earlier ones cached (see
+    # Transformer.decode_cached); the sentences that are done are dropped from the batch of the next steps.
 
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(sentences, predicted)
+    NEG_INF = -1e9
 
-        transformer = Transformer(FLAGS.layers, FLAGS.depth, FLAGS.heads, FLAGS.feedforward, vocab_size, FLAGS.dropout)
+    def gather_rows(structure, indices):
+        return tf.nest.map_structure(lambda tensor: tf.gather(tensor, indices), structure)
+
+    def loop_invariants(structure):
+        # The batch shrinks as sentences finish and the cached keys and values grow by a token per step
+        return tf.nest.map_structure(lambda tensor: tf.TensorShape([None] * tensor.shape.rank), structure)
+
+    def greedy_decode(transformer, sentences, enc_padding_mask, max_length, end_token):
+        """Reconstructs `sentences` from their encoding, starting from their first (start) token, each next token the
+        most likely one, until the end token or max_length tokens.
+
+        Returns the tokens (batch_size, max_length), padded after the end token, and their log probability.
+        """
+        batch_size = tf.shape(sentences)[0]
+        tokens = tf.zeros([batch_size, max_length], sentences.dtype)
+        scores = tf.zeros([batch_size])
+
+        def choose(step, rows, logits, inputs, tokens, scores):
+            """Picks the next token of the unfinished sentences `rows`, returns those that did not end with it."""
+            log_probs = tf.nn.log_softmax(logits[:, -1])
+            next_tokens = tf.argmax(log_probs, -1, output_type=sentences.dtype)
+            tokens = tf.tensor_scatter_nd_update(tokens, tf.stack([rows, tf.fill(tf.shape(rows), step)], 1),
+                                                 next_tokens)
+            scores = tf.tensor_scatter_nd_add(scores, rows[:, None], tf.reduce_max(log_probs, -1))
+            unfinished = tf.where(tf.not_equal(next_tokens, end_token))[:, 0]
+            return gather_rows((rows, next_tokens[:, None], inputs), unfinished) + (tokens, scores)
+
+        logits, cache = transformer(sentences, sentences[:, :1], False, enc_padding_mask, None, cache={})
+        rows, last_tokens, inputs, tokens, scores = choose(0, tf.range(batch_size), logits,
+                                                           (sentences, enc_padding_mask, cache), tokens, scores)
+
+        def step(step, rows, last_tokens, inputs, tokens, scores):
+            sentences, enc_padding_mask, cache = inputs
+            logits, cache = transformer(sentences, last_tokens, False, enc_padding_mask, None, cache=cache)
+            return (step + 1,) + choose(step, rows, logits, (sentences, enc_padding_mask, cache), tokens, scores)
+
+        loop_vars = (tf.constant(1), rows, last_tokens, inputs, tokens, scores)
+        _, _, _, _, tokens, scores = tf.while_loop(
+            lambda step, rows, *_: tf.logical_and(step < max_length, tf.size(rows) > 0), step, loop_vars,
+            shape_invariants=loop_invariants(loop_vars))
+        return tokens, scores
+
+    def beam_search(transformer, sentences, enc_padding_mask, max_length, end_token, beam_size, length_penalty):
+        """Reconstructs `sentences` from their encoding, starting from their first (start) token, keeping the
+        `beam_size` most likely unfinished sentences at every step. A sentence is finished by the end token or at
+        max_length tokens and scored by its log probability over ((5 + length) / 6) ** length_penalty; the search for
+        a sentence stops once none of its unfinished ones can beat its best finished one.
+
+        Returns the tokens (batch_size, max_length) of the best finished sentences, padded after the end token, and
+        their scores.
+        """
+        batch_size = tf.shape(sentences)[0]
+        tokens = tf.zeros([batch_size, max_length], sentences.dtype)
+        scores = tf.fill([batch_size], NEG_INF)
+
+        def penalty(length):
+            return ((5.0 + tf.cast(length, tf.float32)) / 6.0) ** length_penalty
+
+        def beam_rows(rows):
+            # The rows of the decoder batch of the beams of `rows`, beam_size consecutive ones per sentence
+            return tf.reshape(rows[:, None] * beam_size + tf.range(beam_size), [-1])
+
+        def choose(step, rows, beams, log_probs, logits, inputs, tokens, scores):
+            """Extends the beams of the unfinished sentences `rows`, keeps the best finished sentence of each, returns
+            the sentences that may still improve on it."""
+            num_rows = tf.shape(rows)[0]
+            log_probs = log_probs[:, :, None] + tf.reshape(tf.nn.log_softmax(logits[:, -1]), [num_rows, beam_size, -1])
+            # Twice as many candidates as beams, so that beam_size of them remain when some end
+            candidate_log_probs, candidates = tf.math.top_k(tf.reshape(log_probs, [num_rows, -1]), 2 * beam_size)
+            candidate_beams = candidates // vocab_size
+            candidate_tokens = tf.cast(candidates % vocab_size, tokens.dtype)
+            candidate_sentences = tf.concat([tf.gather(beams, candidate_beams, batch_dims=1),
+                                             candidate_tokens[:, :, None]], 2)
+            ends = tf.logical_or(tf.equal(candidate_tokens, end_token), step + 1 >= max_length)
+
+            finished_scores = tf.where(ends, candidate_log_probs / penalty(step + 1), NEG_INF)
+            best = tf.argmax(finished_scores, -1, output_type=tf.int32)
+            best_scores = tf.gather(finished_scores, best, batch_dims=1)
+            improved = tf.where(best_scores > tf.gather(scores, rows))[:, 0]
+            best_sentences = tf.pad(tf.gather(candidate_sentences, best, batch_dims=1),
+                                    [[0, 0], [0, max_length - step - 1]])
+            tokens = tf.tensor_scatter_nd_update(tokens, tf.gather(rows, improved)[:, None],
+                                                 tf.gather(best_sentences, improved))
+            scores = tf.tensor_scatter_nd_update(scores, tf.gather(rows, improved)[:, None],
+                                                 tf.gather(best_scores, improved))
+
+            log_probs, alive = tf.math.top_k(tf.where(ends, NEG_INF, candidate_log_probs), beam_size)
+            beams = tf.gather(candidate_sentences, alive, batch_dims=1)
+            sentences, enc_padding_mask, cache = inputs
+            cache = gather_rows(cache, tf.reshape(tf.range(num_rows)[:, None] * beam_size +
+                                                  tf.gather(candidate_beams, alive, batch_dims=1), [-1]))
+
+            # Log probabilities only decrease, so no beam can score more than its own at max_length
+            unfinished = tf.cast(tf.where(log_probs[:, 0] / penalty(max_length) > tf.gather(scores, rows))[:, 0],
+                                 tf.int32)
+            inputs = gather_rows((sentences, enc_padding_mask), beam_rows(unfinished)) + (
+                gather_rows(cache, beam_rows(unfinished)),)
+            return gather_rows((rows, beams, log_probs), unfinished) + (inputs, tokens, scores)
+
+        # The start token is decoded once per sentence, its cache then copied to every beam, of which only the first
+        # is extended by the first step
+        logits, cache = transformer(sentences, sentences[:, :1], False, enc_padding_mask, None, cache={})
+        inputs = tf.nest.map_structure(lambda tensor: tf.repeat(tensor, beam_size, axis=0),
+                                       (sentences, enc_padding_mask, cache))
+        beams = tf.zeros([batch_size, beam_size, 0], sentences.dtype)
+        log_probs = tf.tile(tf.constant([[0.0] + [NEG_INF] * (beam_size - 1)]), [batch_size, 1])
+        loop_vars = (tf.constant(1),) + choose(0, tf.range(batch_size), beams, log_probs, tf.repeat(logits, beam_size, axis=0),
+                                  inputs, tokens, scores)
+
+        def step(step, rows, beams, log_probs, inputs, tokens, scores):
+            sentences, enc_padding_mask, cache = inputs
+            logits, cache = transformer(sentences, tf.reshape(beams[:, :, -1:], [-1, 1]), False, enc_padding_mask,
+                                        None, cache=cache)
+            return (step + 1,) + choose(step, rows, beams, log_probs, logits, (sentences, enc_padding_mask, cache),
+                                        tokens, scores)
+
+        _, _, _, _, _, tokens, scores = tf.while_loop(
+            lambda step, rows, *_: tf.logical_and(step < max_length, tf.size(rows) > 0), step, loop_vars,
+            shape_invariants=loop_invariants(loop_vars))
+        return tokens, scores
+
+    transformers = []
+
+    def model(sentences, is_training, decode_length=0, beam_size=1, length_penalty=0.6, end_token=None,
+              with_loss=False):
+        """Constructs the ResNet model given the inputs. With a `decode_length`, the sentences are reconstructed
+        instead, by greedy_decode, or by beam_search with a `beam_size` over 1, until the `end_token` (by default the
+        last of the vocabulary) or decode_length tokens. Decoding only uses tf ops and loops, so it also runs in a
+        tf.function. The sentences may be of any length, e.g. batches padded only to their longest sentence. With
+        `with_loss`, the first output is the loss of predicting each next token of the sentences (see
+        Transformer.target_loss) instead of the logits, which are never built by the sampled softmax. The sentences,
+        and decode_length, are at most max_length tokens."""
+        if decode_length > max_length:
+            raise ValueError("decode_length (%d) is longer than max_length (%d)" % (decode_length, max_length))
+        sentences = check_length(sentences, sentences.shape[1] or tf.shape(sentences)[1], "The sentences")
+        predicted = sentences[:, :-1]
+
+        # In graph mode every graph gets its own transformer. Under TF2 it is built once, outside of any tf.function
+        # (its positional encoding and look-ahead mask are constants), and reused by every call, so that all traces
+        # share its variables
+        if not transformers or not tf.compat.v1.executing_eagerly_outside_functions():
+            with tf.init_scope():
+                transformers[:] = [Transformer(FLAGS.layers, FLAGS.depth, FLAGS.heads, FLAGS.feedforward, vocab_size,
+                                               FLAGS.dropout)]
+        transformer = transformers[0]
+
+        # The ops of each stage are in a name scope (the layers in their own), to tell them apart in profiler traces
+        with tf.name_scope("masks"):
+            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(sentences, predicted,
+                                                                             transformer.look_ahead_mask)
+        if encoder_only:
+            # Only the encoder (and the embedding it shares with the decoder) is built, e.g. to export it, with the
+            # variable names of the whole transformer so that it restores its checkpoints
+            return transformer(sentences, None, is_training, enc_padding_mask, None)
+        if decode_length:
+            end_token = vocab_size - 1 if end_token is None else end_token
+            if beam_size > 1:
+                return beam_search(transformer, sentences, enc_padding_mask, decode_length, end_token, beam_size,
+                                   length_penalty)
+            return greedy_decode(transformer, sentences, enc_padding_mask, decode_length, end_token)
+        if with_loss:
+            return transformer(sentences, predicted, is_training, enc_padding_mask, combined_mask,
+                               targets=sentences[:, 1:])
         return transformer(sentences, predicted, is_training, enc_padding_mask, combined_mask)
 
     return model